@@ -0,0 +1,91 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import argparse
+import json
+import pathlib
+import random
+import sys
+import time
+import numpy as np
+
+import match
+import qulac
+import question_generation
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=pathlib.Path, default="data/qulac.test.json")
+    parser.add_argument(
+        "--model", type=pathlib.Path, default="data/yesno_tsv_paper_qulac/transformer"
+    )
+    parser.add_argument("--threshold-user", type=float, default=0.5)
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-pairs", type=int, default=2000)
+    parser.add_argument("--min-agreement", type=float)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # the pairs the user simulator scores: its facet against questions asked
+    # about each candidate facet of the topic
+    dataset = qulac.Qulac(args.dataset.open())
+    question_generator = question_generation.DummyQuestionGenerator()
+    pairs = [
+        (
+            topic.query + " . " + facet.desc,
+            question_generator.generate_question(topic, asked),
+        )
+        for topic in dataset.topics
+        for facet in topic.facets
+        for asked in topic.facets
+    ]
+    random.seed(args.seed)
+    if len(pairs) > args.max_pairs:
+        pairs = random.sample(pairs, args.max_pairs)
+
+    matchers = {
+        "pytorch": match.TransformerSentenceMatcher(
+            args.model, batch_size=args.batch_size
+        ),
+        "onnx": match.ONNXTransformerSentenceMatcher(
+            args.model,
+            batch_size=args.batch_size,
+            int8=args.int8,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+        ),
+    }
+    scores = {}
+    out = {"pairs": len(pairs), "threshold_user": args.threshold_user}
+    for name, matcher in matchers.items():
+        start = time.perf_counter()
+        scores[name] = np.array(matcher.similarity_batch(pairs))
+        seconds = time.perf_counter() - start
+        out[name] = {
+            "seconds": seconds,
+            "pairs_per_second": len(pairs) / seconds,
+            "yes_rate": float(np.mean(scores[name] >= args.threshold_user)),
+        }
+    yes = {name: s >= args.threshold_user for name, s in scores.items()}
+    diff = np.abs(scores["onnx"] - scores["pytorch"])
+    out["agreement"] = float(np.mean(yes["onnx"] == yes["pytorch"]))
+    out["only_pytorch_yes"] = int(np.sum(yes["pytorch"] & ~yes["onnx"]))
+    out["only_onnx_yes"] = int(np.sum(yes["onnx"] & ~yes["pytorch"]))
+    out["max_abs_diff"] = float(diff.max()) if len(diff) else 0.0
+    out["mean_abs_diff"] = float(diff.mean()) if len(diff) else 0.0
+    json.dump(out, sys.stdout, indent=4)
+    print()
+    if args.min_agreement is not None and out["agreement"] < args.min_agreement:
+        sys.exit(1)
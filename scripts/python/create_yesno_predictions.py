@@ -39,6 +39,10 @@ if __name__ == "__main__":
         extrasaction="ignore",
     )
     w.writeheader()
-    for data in r:
-        data["prediction"] = matcher.similarity(data["facet"], data["q"])
+    rows = list(r)
+    predictions = matcher.similarity_batch(
+        [(data["facet"], data["q"]) for data in rows]
+    )
+    for data, prediction in zip(rows, predictions):
+        data["prediction"] = prediction
         w.writerow(data)
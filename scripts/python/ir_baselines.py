@@ -32,7 +32,7 @@ if __name__ == "__main__":
     parser.add_argument("--dataset", type=str, default="data/qulac.test.json")
     args = parser.parse_args()
     dataset = qulac.Qulac(open(args.dataset))
-    ir_metric_calculator = ir.TrecToolsMetricCalculator("data/faceted.qrel")
+    ir_metric_calculator = ir.NativeMetricCalculator("data/faceted.qrel")
     ir_system = ir.QLInformationRetriever(ql.QL.QL(True, True, "data/ql/"))
     # topic-only is equivalent to no intent refinement (use only user's initial query)
     # facet is an upper bound where the correct intent is always identified
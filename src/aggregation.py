@@ -0,0 +1,188 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import math
+import typing as tp
+import numpy as np
+
+MEDIANS = ["exact", "tdigest"]
+
+
+class ExactQuantiles:
+    """Keeps every value, for exact medians on runs that fit in memory."""
+
+    def __init__(self):
+        self.values = []  # type: tp.List[float]
+        self.weights = []  # type: tp.List[float]
+
+    def add(self, value: float, weight: float = 1.0):
+        self.values.append(value)
+        self.weights.append(weight)
+
+    def merge(self, other: "ExactQuantiles"):
+        self.values.extend(other.values)
+        self.weights.extend(other.weights)
+
+    def quantile(self, q: float) -> float:
+        if not self.values:
+            return math.nan
+        # weighted quantile; with unit weights, the median is that of np.median
+        order = np.argsort(self.values, kind="stable")
+        values = np.asarray(self.values)[order]
+        cumulative = np.cumsum(np.asarray(self.weights)[order])
+        target = q * cumulative[-1]
+        i = min(int(np.searchsorted(cumulative, target)), len(values) - 1)
+        if np.isclose(cumulative[i], target) and i + 1 < len(values):
+            return float((values[i] + values[i + 1]) / 2)
+        return float(values[i])
+
+
+class TDigest:
+    """Merging t-digest (Dunning & Ertl): values are buffered and periodically
+    folded into at most ~compression centroids, which are kept small near the
+    tails by the arcsine scale function. Memory is bounded whatever the number
+    of values, and digests of separate shards can be merged."""
+
+    def __init__(self, compression: float = 100, buffer_size: int = 500):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []  # type: tp.List[tp.Tuple[float, float]]
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float, weight: float = 1.0):
+        self.buffer.append((value, weight))
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other: "TDigest"):
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self.buffer.extend(other.buffer)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k: float) -> float:
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def compress(self):
+        buffer = np.asarray(self.buffer, dtype=float).reshape(-1, 2)
+        means = np.concatenate([self.means, buffer[:, 0]])
+        weights = np.concatenate([self.weights, buffer[:, 1]])
+        self.buffer = []
+        if not len(means):
+            return
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        merged_means, merged_weights = [means[0]], [weights[0]]
+        q0 = 0.0
+        q_limit = self._k_inverse(self._k(q0) + 1)
+        for mean, weight in zip(means[1:], weights[1:]):
+            if q0 + (merged_weights[-1] + weight) / total <= q_limit:
+                merged_weights[-1] += weight
+                delta = mean - merged_means[-1]
+                merged_means[-1] += delta * weight / merged_weights[-1]
+            else:
+                q0 += merged_weights[-1] / total
+                q_limit = self._k_inverse(self._k(q0) + 1)
+                merged_means.append(mean)
+                merged_weights.append(weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def quantile(self, q: float) -> float:
+        self.compress()
+        if not len(self.means):
+            return math.nan
+        if len(self.means) == 1:
+            return float(self.means[0])
+        # interpolate between centroid centers, and towards min/max at the tails
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0], centers, [self.weights.sum()]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * self.weights.sum(), positions, values))
+
+
+class RunningStats:
+    """Mean and (population) standard deviation with Welford's method, plus a
+    median from either exact quantiles or a t-digest. Values may be weighted
+    (e.g. by their probability), in which case count is the total weight.
+    Stats of shards are combined with merge (Chan et al.'s pairwise update)."""
+
+    def __init__(self, median: str = "exact"):
+        self.count = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.quantiles = ExactQuantiles() if median == "exact" else TDigest()
+
+    def add(self, value: float, weight: float = 1.0):
+        value = float(value)
+        self.count += weight
+        delta = value - self.mean
+        self.mean += delta * weight / self.count
+        self.m2 += weight * delta * (value - self.mean)
+        self.quantiles.add(value, weight)
+
+    def merge(self, other: "RunningStats"):
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.quantiles.merge(other.quantiles)
+
+    def result(self) -> tp.Dict[str, float]:
+        if not self.count:
+            return {"mean": math.nan, "median": math.nan, "std": math.nan}
+        return {
+            "mean": self.mean,
+            "median": self.quantiles.quantile(0.5),
+            "std": math.sqrt(max(self.m2, 0.0) / self.count),
+        }
+
+
+class MetricAggregator:
+    """RunningStats per metric name, in insertion order."""
+
+    def __init__(self, median: str = "exact"):
+        if median not in MEDIANS:
+            raise ValueError("unknown median method %r" % median)
+        self.median = median
+        self.stats = {}  # type: tp.Dict[str, RunningStats]
+
+    def add(self, metric: str, value: float, weight: float = 1.0):
+        if metric not in self.stats:
+            self.stats[metric] = RunningStats(self.median)
+        self.stats[metric].add(value, weight)
+
+    def update(self, values: tp.Dict[str, float], weight: float = 1.0):
+        for metric, value in values.items():
+            self.add(metric, value, weight)
+
+    def merge(self, other: "MetricAggregator"):
+        for metric, stats in other.stats.items():
+            if metric not in self.stats:
+                self.stats[metric] = RunningStats(self.median)
+            self.stats[metric].merge(stats)
+
+    def result(self) -> tp.Dict[str, tp.Dict[str, float]]:
+        return {metric: stats.result() for metric, stats in self.stats.items()}
@@ -19,6 +19,10 @@ from yes_no_detection import YesNoDetector
 
 
 class AnswerGenerator(ABC):
+    # whether answer_distribution lists every answer generate_answer may return,
+    # so that dialogues can be enumerated exactly or answers drawn in batches
+    enumerable = False
+
     @abstractmethod
     def generate_answer(
         self,
@@ -29,8 +33,21 @@ class AnswerGenerator(ABC):
     ) -> str:
         pass
 
+    def answer_distribution(
+        self,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        cooperativeness: float,
+        similarity: float,
+    ) -> tp.List[tp.Tuple[str, float]]:
+        # answers generate_answer may return, with their probabilities; only
+        # called when enumerable is set
+        raise NotImplementedError
+
 
 class QulacAnswerGenerator(AnswerGenerator):
+    enumerable = True
+
     def __init__(
         self,
         yes_no_detector: YesNoDetector,
@@ -60,6 +77,23 @@ class QulacAnswerGenerator(AnswerGenerator):
             return random.choice(answers["no"])
         return self.no_answer
 
+    def answer_distribution(
+        self,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        cooperativeness: float,
+        similarity: float,
+    ) -> tp.List[tp.Tuple[str, float]]:
+        answers = self.parse_answers(facet)
+        if similarity >= self.perfect_match_threshold:
+            if answers["yes"]:
+                return [(a, 1 / len(answers["yes"])) for a in answers["yes"]]
+            return [(self.yes_answer, 1.0)]
+        if not answers["no"]:
+            return [(self.no_answer, 1.0)]
+        p = cooperativeness / len(answers["no"])
+        return [(a, p) for a in answers["no"]] + [(self.no_answer, 1 - cooperativeness)]
+
     def parse_answers(self, facet: clarify_types.Facet) -> tp.Dict[str, tp.List[str]]:
         answers = defaultdict(list)
         for q, a in facet.questions_answers:
@@ -0,0 +1,307 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import argparse
+import json
+import pathlib
+import platform
+import random
+import subprocess
+import sys
+import time
+import typing as tp
+import numpy as np
+
+import clarify_types
+import facet_ranking
+import informative_no_extraction
+import ir
+import main
+import match
+import qulac
+import synthetic
+import yes_no_detection
+
+BENCHMARKS = [
+    "qulac",
+    "qulac_stream",
+    "qulac_snapshot",
+    "similarity",
+    "rank_facets",
+    "ql_search",
+    "ql_search_mmap",
+    "metrics_trectools",
+    "metrics_native",
+    "end_to_end",
+]
+
+
+def measure(
+    setup: tp.Callable[[], tp.Tuple[tp.Callable, tp.List]], repeat: int
+) -> tp.Dict:
+    """Times every call of fn on its items. setup builds fn and the items
+    afresh for each repeat and is not timed, so caches do not carry over."""
+    latencies = []
+    for _ in range(repeat):
+        fn, items = setup()
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    total = float(latencies.sum() / 1000)
+    return {
+        "calls": len(latencies),
+        "seconds": total,
+        "per_second": len(latencies) / total if total else None,
+        "ms": {
+            "mean": float(latencies.mean()),
+            "median": float(np.median(latencies)),
+            "p95": float(np.percentile(latencies, 95)),
+            "min": float(latencies.min()),
+            "max": float(latencies.max()),
+        },
+    }
+
+
+def spread(items: tp.List, n: int) -> tp.List:
+    # at most n items, evenly spaced so that every topic is represented
+    if len(items) <= n:
+        return items
+    return [items[i * len(items) // n] for i in range(n)]
+
+
+def topic_questions(
+    topics: tp.List[clarify_types.Topic],
+) -> tp.List[tp.Tuple[clarify_types.Topic, str]]:
+    return [
+        (topic, question)
+        for topic in topics
+        for question in dict.fromkeys(
+            q for facet in topic.facets for q, _ in facet.questions_answers
+        )
+    ]
+
+
+def after_first_turn(topic: clarify_types.Topic) -> clarify_types.ClarifyState:
+    # the state after the first facet was rejected with an informative no,
+    # so that both of the ranker's contexts are non-empty
+    state = clarify_types.ClarifyState(topic, [(facet, 0.0) for facet in topic.facets])
+    facet = topic.facets[0]
+    state.candidates.remove(facet)
+    state.dead_facets_db.append((facet, 0.0))
+    for _, answer in facet.questions_answers:
+        if yes_no_detection.DummyYesNoDetector().stance(answer) == "no":
+            extractor = informative_no_extraction.DummyInformativeNoExtractor()
+            state.informative_no_db.append(extractor.extract(answer))
+            break
+    return state
+
+
+def run_benchmark(
+    name: str, args: argparse.Namespace, topics: tp.List[clarify_types.Topic]
+) -> tp.Dict:
+    if name in ["qulac", "qulac_stream", "qulac_snapshot"]:
+        options = {
+            "stream": name == "qulac_stream",
+            "snapshot": name == "qulac_snapshot",
+        }
+        if options["snapshot"]:
+            # written on the first load, which is not timed
+            qulac.Qulac.load(args.dataset, snapshot=True)
+        return measure(
+            lambda: (lambda path: qulac.Qulac.load(path, **options), [args.dataset]),
+            args.repeat,
+        )
+    if name == "similarity":
+        pairs = spread(
+            [
+                (topic.query + " . " + facet.desc, question)
+                for topic in topics
+                for facet in topic.facets
+                for question, _ in facet.questions_answers
+            ],
+            args.max_calls,
+        )
+
+        def setup():
+            matcher = match.CachingSentenceMatcher(main.load_matcher(args, "user"))
+            return lambda pair: matcher.similarity(*pair), pairs
+
+        return measure(setup, args.repeat)
+    if name == "rank_facets":
+
+        def setup():
+            ranker = facet_ranking.SimilarityFacetRanker(
+                match.CachingSentenceMatcher(main.load_matcher(args, "clarify")),
+                alpha=args.facet_ranker_alpha,
+            )
+            states = [after_first_turn(topic) for topic in topics if topic.facets]
+            return ranker.rank_facets, spread(states, args.max_calls)
+
+        return measure(setup, args.repeat)
+    if name in ["ql_search", "ql_search_mmap"]:
+        ql_index = "mmap" if name == "ql_search_mmap" else "pickle"
+        ir_args = argparse.Namespace(**{**vars(args), "ql_index": ql_index})
+        queries = spread(topic_questions(topics), args.max_calls)
+
+        def setup():
+            ir_system = main.load_ir_system(ir_args)
+            return lambda item: ir_system.search(*item), queries
+
+        return measure(setup, args.repeat)
+    if name in ["metrics_trectools", "metrics_native"]:
+        calculator_cls = {
+            "metrics_trectools": ir.TrecToolsMetricCalculator,
+            "metrics_native": ir.NativeMetricCalculator,
+        }[name]
+        calculator = calculator_cls(args.qrel)
+        items = spread(
+            [
+                (topic, facet, question)
+                for topic, question in topic_questions(topics)
+                for facet in topic.facets
+            ],
+            args.max_calls,
+        )
+        # rankings are computed up front so that only the metrics are timed
+        ir_system = ir.CachingInformationRetriever(main.load_ir_system(args))
+        for topic, _, question in items:
+            ir_system.search(topic, question)
+            ir_system.search_arrays(topic, [question])
+        return measure(
+            lambda: (
+                lambda item: calculator.calculate_metrics(ir_system, *item),
+                items,
+            ),
+            args.repeat,
+        )
+    if name == "end_to_end":
+        return end_to_end(args)
+    raise ValueError("unknown benchmark %s" % name)
+
+
+def end_to_end(args: argparse.Namespace) -> tp.Dict:
+    # resources are reloaded for every repeat, so that each run starts cold
+    runs = []
+    for _ in range(args.repeat):
+        seed = args.seed if args.seed is not None else 0
+        random.seed(seed)
+        np.random.seed(seed)
+        start = time.perf_counter()
+        resources = main.load_resources(args)
+        clarif = main.build_clarify(args, resources)
+        loaded = time.perf_counter()
+        topics = resources["dataset"].topics
+        clarif.run(
+            args.epochs,
+            topics,
+            workers=args.workers,
+            seed=args.seed,
+            median=args.median,
+            exact=args.simulation == "exact",
+            batched=args.batch_epochs,
+        )
+        end = time.perf_counter()
+        facets = sum(len(topic.facets) for topic in topics)
+        runs.append(
+            {
+                "load_seconds": loaded - start,
+                "run_seconds": end - loaded,
+                "facets": facets,
+                "dialogues": facets * args.epochs,
+            }
+        )
+    best = min(runs, key=lambda run: run["run_seconds"])
+    return {
+        "runs": runs,
+        "dialogues_per_second": best["dialogues"] / best["run_seconds"],
+        "facets_per_second": best["facets"] / best["run_seconds"],
+    }
+
+
+def git_commit() -> tp.Dict[str, tp.Any]:
+    root = pathlib.Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, check=True
+        ).stdout.decode()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root,
+            capture_output=True,
+            check=True,
+        ).stdout.decode()
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit.strip(), "dirty": bool(status.strip())}
+
+
+def compare(results: tp.Dict, baseline: tp.Dict) -> tp.Dict[str, float]:
+    # speedup of each benchmark over the baseline (> 1 is faster)
+    speedups = {}
+    for name, result in results["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if old is None:
+            continue
+        key = "dialogues_per_second" if name == "end_to_end" else "per_second"
+        if result.get(key) and old.get(key):
+            speedups[name] = result[key] / old[key]
+    return speedups
+
+
+if __name__ == "__main__":
+    # the simulation is configured with main.py's arguments; dataset, qrels and
+    # QL paths point into --data and matchers default to hashed-bov, so that
+    # everything runs without downloaded models or indexes
+    parser = main.build_parser()
+    parser.add_argument("--data", type=pathlib.Path, default="data/synthetic")
+    parser.add_argument("--out", type=pathlib.Path, default="benchmark.json")
+    parser.add_argument("--baseline", type=pathlib.Path)
+    parser.add_argument(
+        "--benchmarks", nargs="+", default=BENCHMARKS, choices=BENCHMARKS
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-calls", type=int, default=200)
+    synthetic.add_arguments(parser)
+    # hashed-bov scores a question about the user's facet around 0.75 and one
+    # about another facet around 0.5
+    parser.set_defaults(
+        matcher_user="hashed-bov", matcher_clarify="hashed-bov", threshold_user=0.65
+    )
+    args = parser.parse_args()
+
+    if not (args.data / "manifest.json").exists():
+        synthetic.generate_from_args(args.data, args)
+    args.dataset = args.data / "qulac.json"
+    args.qrel = args.data / "faceted.qrel"
+    args.ql_data_root = str(args.data / "ql")
+    args.ql_index_path = args.data / "ql" / "topic_indexes_npy"
+    topics = qulac.Qulac.load(args.dataset).topics
+
+    results = {
+        **git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "data": json.loads((args.data / "manifest.json").read_text()),
+        "args": vars(args),
+        "benchmarks": {},
+    }
+    for name in args.benchmarks:
+        print("running %s" % name, file=sys.stderr)
+        results["benchmarks"][name] = run_benchmark(name, args, topics)
+    if args.baseline is not None:
+        results["speedup"] = compare(results, json.loads(args.baseline.read_text()))
+    with args.out.open("w") as f:
+        json.dump(results, f, default=str, indent=4)
+    json.dump(results.get("speedup", results["benchmarks"]), sys.stdout, indent=4)
@@ -10,10 +10,13 @@
 #  and limitations under the License.
 
 from collections import defaultdict
+import functools
+import multiprocessing
 import typing as tp
-import random
+import numpy as np
 import tqdm
 
+import aggregation
 import clarify_types
 import facet_retrieval
 import facet_ranking
@@ -22,9 +25,35 @@ import user_simulator
 import informative_no_extraction
 import yes_no_detection
 import ir
+import profiling
 import utils
 
 
+class DialogueTreeTooLarge(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=4096)
+def count_orders(elements: tp.Tuple, ties: tp.Tuple) -> int:
+    """Number of orders of elements in which the winner of each (winner, losers)
+    tie comes before all of its losers, by dynamic programming over the sets of
+    elements placed first."""
+    index = {element: i for i, element in enumerate(elements)}
+    before = [0] * len(elements)
+    for winner, losers in ties:
+        for loser in losers:
+            before[index[loser]] |= 1 << index[winner]
+    counts = [0] * (1 << len(elements))
+    counts[0] = 1
+    for placed in range(len(counts)):
+        if not counts[placed]:
+            continue
+        for i in range(len(elements)):
+            if not placed >> i & 1 and before[i] & placed == before[i]:
+                counts[placed | 1 << i] += counts[placed]
+    return counts[-1]
+
+
 class Clarify:
     def __init__(
         self,
@@ -37,6 +66,9 @@ class Clarify:
         ir_system: ir.InformationRetriever,
         ir_metric_calculator: ir.MetricCalculator,
         cooperativeness_fn: tp.Callable[[int], float],
+        max_tree_nodes: int = 100000,
+        max_tie_facets: int = 12,
+        profile: tp.Optional[profiling.Profile] = None,
     ):
         self.user_simulator = user_simulator
         self.question_generator = question_generator
@@ -48,20 +80,47 @@ class Clarify:
         self.ir_system = ir_system
         self.cooperativeness_fn = cooperativeness_fn
         self.ir_metric_calculator = ir_metric_calculator
+        # retrieved facets and initial ranking per topic id, see build_state
+        self.prepared = {}  # type: tp.Dict[str, tp.Tuple[tp.List, tp.Any]]
+        # limits of the exact simulation, past which dialogues are sampled
+        self.max_tree_nodes = max_tree_nodes
+        self.max_tie_facets = max_tie_facets
+        # timings recorded by forked workers are merged into it
+        self.profile = profile
+
+    def topic_facets(
+        self, topic: clarify_types.Topic
+    ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        if topic.id not in self.prepared:
+            facets = self.facet_retriever.facets_for_topic(topic)
+            self.prepared[topic.id] = (facets, None)
+        return self.prepared[topic.id][0]
 
-    def build_state(self, topic: clarify_types.Topic):
-        facets = self.facet_retriever.facets_for_topic(topic)
-        state = clarify_types.ClarifyState(topic, facets)
-        state.candidate_facets_db = self.rank_facets(state)
-        if len(state.candidate_facets_db) == 0:
+    def build_state(
+        self,
+        topic: clarify_types.Topic,
+        tiebreaks: tp.Optional[tp.Sequence[float]] = None,
+    ):
+        # facets are retrieved (and, for a deterministic ranker, ranked) on the
+        # first dialogue of a topic only; later dialogues get a fresh queue over
+        # the same ranking, which draws its tie-breaks exactly as before
+        facets = self.topic_facets(topic)
+        ranking = self.prepared[topic.id][1]
+        state = clarify_types.ClarifyState(topic, facets, tiebreaks=tiebreaks)
+        if ranking is None:
+            ranking = self.facet_ranker.rank_facets(state)
+            self.prepared[topic.id] = (
+                facets,
+                ranking if self.facet_ranker.deterministic else None,
+            )
+        state.candidates.rescore(ranking)
+        if len(state.candidates) == 0:
             # facet retriever failed to find any facets for this topic
             state.state = clarify_types.ClarifyState.FAILED_STATE
         return state
 
-    def rank_facets(self, state):
-        facets = self.facet_ranker.rank_facets(state)
-        facets = sorted(facets, key=lambda x: (x[1], random.random()), reverse=True)
-        return facets
+    def rank_facets(self, state: clarify_types.ClarifyState):
+        state.candidates.rescore(self.facet_ranker.rank_facets(state))
 
     def step(
         self,
@@ -69,86 +128,507 @@ class Clarify:
         user_simulator_state: user_simulator.UserSimulatorState,
     ) -> tp.Tuple[int, str, str, float, float]:
         assert state.state == clarify_types.ClarifyState.ONGOING_STATE
-        guessed_facet, clarify_score = state.candidate_facets_db.pop(0)
+        guessed_facet, clarify_score = state.candidates.pop()
         state.dead_facets_db.append((guessed_facet, clarify_score))
         question = self.question_generator.generate_question(state.topic, guessed_facet)
         user_feedback = self.user_simulator.feedback(user_simulator_state, question)
+        return self.observe(
+            state, guessed_facet, clarify_score, question, user_feedback
+        )
+
+    def observe(
+        self,
+        state: clarify_types.ClarifyState,
+        guessed_facet: clarify_types.Facet,
+        clarify_score: float,
+        question: str,
+        user_feedback: tp.Dict,
+    ) -> tp.Dict:
         answer = user_feedback["answer"]
-        user_simulator_state = user_feedback["state"]
-        user_score = user_feedback["similarity"]
-        if self.yes_no_detector.stance(answer) == "yes":
-            state.state = clarify_types.ClarifyState.SUCCESS_STATE
+        if self.take_answer(state, answer):
             clarify_score = 1
         else:
-            informative_no = self.informative_no_extractor.extract(answer)
-            if informative_no:
-                state.informative_no_db.append(informative_no)
-            state.candidate_facets_db = self.rank_facets(state)
-            if (
-                len(state.candidate_facets_db) == 0
-                or user_simulator_state.ran_out_of_patience()
-            ):
-                state.state = clarify_types.ClarifyState.FAILED_STATE
+            self.rank_facets(state)
+            self.check_failure(state, user_feedback["state"])
         return {
             "state": state,
             "question": question,
             "answer": answer,
-            "user_score": user_score,
+            "user_score": user_feedback["similarity"],
             "clarify_score": clarify_score,
             "guessed_facet": guessed_facet,
         }
 
-    def run(self, epochs: int, topics: clarify_types.Topic):
+    def take_answer(self, state: clarify_types.ClarifyState, answer: str) -> bool:
+        # whether the answer is a yes; a no may add to the informative no's
+        if self.yes_no_detector.stance(answer) == "yes":
+            state.state = clarify_types.ClarifyState.SUCCESS_STATE
+            return True
+        informative_no = self.informative_no_extractor.extract(answer)
+        if informative_no:
+            state.informative_no_db.append(informative_no)
+        return False
+
+    def check_failure(
+        self,
+        state: clarify_types.ClarifyState,
+        user_simulator_state: user_simulator.UserSimulatorState,
+    ):
+        if len(state.candidates) == 0 or user_simulator_state.ran_out_of_patience():
+            state.state = clarify_types.ClarifyState.FAILED_STATE
+
+    def run(
+        self,
+        epochs: int,
+        topics: tp.List[clarify_types.Topic],
+        workers: int = 1,
+        seed: tp.Optional[int] = None,
+        writer: tp.Optional[tp.Callable[[tp.Dict], None]] = None,
+        median: str = "exact",
+        exact: bool = False,
+        batched: bool = False,
+    ):
+        # without a writer every dialogue is returned in json_out; with one,
+        # records are handed to it as they complete and only metrics are kept
         json_out = {}
-        json_out["topics"] = []
-        global_metrics = defaultdict(list)
-        for topic in tqdm.tqdm(topics):
-            topic_out = {}
-            json_out["topics"].append(topic_out)
-            topic_out["topic"] = topic
-            topic_out["facets"] = []
-            for facet in topic.facets:
-                facet_out = {}
-                topic_out["facets"].append(facet_out)
-                facet_out["facet_id"] = facet.id
-                facet_out["dialogues"] = []
-                facet_metrics = defaultdict(list)
-                for _ in range(epochs):
-                    dialogue_out = self.run_dialogue(topic, facet)
-                    facet_metrics["turns"].append(len(dialogue_out["turns"]))
-                    facet_metrics["subj_success"].append(dialogue_out["subj_success"])
-                    facet_metrics["real_success"].append(dialogue_out["real_success"])
-                    for metric, value in dialogue_out["metrics"].items():
-                        facet_metrics[metric].append(value)
-                    facet_out["dialogues"].append(dialogue_out)
-                facet_out["metrics"] = utils.compute_metrics(facet_metrics)
-                for metric, value in facet_out["metrics"].items():
-                    global_metrics[metric].append(value["mean"])
-        json_out["metrics"] = utils.compute_metrics(global_metrics)
+        if writer is None:
+            json_out["topics"] = []
+        global_metrics = aggregation.MetricAggregator(median)
+        facet_kwargs = {"median": median, "exact": exact, "batched": batched}
+        simulations = defaultdict(int)
+        topic_outs = []  # type: tp.List[tp.Optional[tp.Dict]]
+        for topic in topics:
+            topic_out = None
+            if writer is None:
+                topic_out = {}
+                json_out["topics"].append(topic_out)
+                topic_out["topic"] = topic
+                topic_out["facets"] = []
+            topic_outs.append(topic_out)
+        if workers > 1:
+            # fork so that workers inherit loaded models instead of unpickling them
+            pool = multiprocessing.get_context("fork").Pool(
+                workers,
+                initializer=_init_worker,
+                initargs=(self, topics, epochs, seed, facet_kwargs),
+            )
+            # all facets of a topic go to the same worker, so each topic index is
+            # loaded by a single process
+            results = self.worker_results(
+                pool.imap(_run_topic_worker, range(len(topics)))
+            )
+        else:
+            pool = None
+            results = (
+                self.run_topic(epochs, topic, seed, writer, **facet_kwargs)
+                for topic in topics
+            )
+        for topic_out, topic, (facet_outs, topic_metrics) in tqdm.tqdm(
+            zip(topic_outs, topics, results), total=len(topics)
+        ):
+            if writer is None:
+                topic_out["facets"].extend(facet_outs)
+            elif pool is not None:
+                # workers run without a writer, so their topic's records are
+                # written once it is done, in the order a serial run writes them
+                writer(self.topic_record(topic))
+                for facet, facet_out in zip(topic.facets, facet_outs):
+                    dialogue_outs = facet_out.pop("dialogues", [])
+                    for epoch, dialogue_out in enumerate(dialogue_outs):
+                        writer(self.dialogue_record(topic, facet, epoch, dialogue_out))
+                    writer(self.facet_record(topic, facet_out))
+            if exact:
+                for facet_out in facet_outs:
+                    simulations[facet_out["simulation"]] += 1
+            # topics are shards of the global metrics, merged in topic order
+            # whichever process ran them
+            global_metrics.merge(topic_metrics)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        json_out["metrics"] = global_metrics.result()
+        if exact:
+            json_out["simulations"] = dict(simulations)
         return json_out
 
+    def worker_results(self, topic_results: tp.Iterable[tp.Tuple[tp.Tuple, tp.Any]]):
+        for result, drained in topic_results:
+            if drained is not None:
+                self.profile.merge(drained)
+            yield result
+
+    def run_topic(
+        self,
+        epochs: int,
+        topic: clarify_types.Topic,
+        seed: tp.Optional[int] = None,
+        writer: tp.Optional[tp.Callable[[tp.Dict], None]] = None,
+        median: str = "exact",
+        exact: bool = False,
+        batched: bool = False,
+    ) -> tp.Tuple[tp.List[tp.Dict], aggregation.MetricAggregator]:
+        """The output of each facet of topic, with its metrics, and the topic's
+        share of the global metrics: the mean of each metric for every facet."""
+        if writer is not None:
+            writer(self.topic_record(topic))
+        facet_outs = []
+        topic_metrics = aggregation.MetricAggregator(median)
+        for facet in topic.facets:
+            facet_out, facet_metrics = self.run_facet(
+                epochs, topic, facet, seed, writer, median, exact, batched
+            )
+            facet_out["metrics"] = facet_metrics.result()
+            for metric, value in facet_out["metrics"].items():
+                topic_metrics.add(metric, value["mean"])
+            if writer is not None:
+                # its dialogues were already written as they completed
+                facet_out.pop("dialogues", None)
+                writer(self.facet_record(topic, facet_out))
+            facet_outs.append(facet_out)
+        return facet_outs, topic_metrics
+
+    def run_facet(
+        self,
+        epochs: int,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        seed: tp.Optional[int] = None,
+        writer: tp.Optional[tp.Callable[[tp.Dict], None]] = None,
+        median: str = "exact",
+        exact: bool = False,
+        batched: bool = False,
+    ):
+        if exact and self.user_simulator.answer_generator.enumerable:
+            try:
+                return self.run_facet_exact(topic, facet, median)
+            except DialogueTreeTooLarge:
+                pass
+        facet_out = {}
+        facet_out["facet_id"] = facet.id
+        if exact:
+            facet_out["simulation"] = "sampled"
+        facet_out["dialogues"] = []
+        facet_metrics = aggregation.MetricAggregator(median)
+        if batched:
+            facet_seed = None
+            if seed is not None:
+                facet_seed = utils.derive_seed(seed, topic.id, facet.id)
+                utils.seed_everything(facet_seed)
+            dialogues = self.run_dialogues_batched(
+                epochs, topic, facet, np.random.default_rng(facet_seed)
+            )
+        else:
+            dialogues = self.sampled_dialogues(epochs, topic, facet, seed)
+        for epoch, dialogue_out in enumerate(dialogues):
+            facet_metrics.add("turns", len(dialogue_out["turns"]))
+            facet_metrics.add("subj_success", dialogue_out["subj_success"])
+            facet_metrics.add("real_success", dialogue_out["real_success"])
+            facet_metrics.update(dialogue_out["metrics"])
+            if writer is None:
+                facet_out["dialogues"].append(dialogue_out)
+            else:
+                writer(self.dialogue_record(topic, facet, epoch, dialogue_out))
+        return facet_out, facet_metrics
+
+    def sampled_dialogues(
+        self,
+        epochs: int,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        seed: tp.Optional[int] = None,
+    ) -> tp.Iterator[tp.Dict]:
+        for epoch in range(epochs):
+            if seed is not None:
+                # every dialogue gets its own stream so results do not depend on
+                # the order (or process) in which dialogues are run
+                utils.seed_everything(
+                    utils.derive_seed(seed, topic.id, facet.id, epoch)
+                )
+            yield self.run_dialogue(topic, facet)
+
+    def run_dialogues_batched(
+        self,
+        epochs: int,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        rng: np.random.Generator,
+    ) -> tp.List[tp.Dict]:
+        """All epochs of a facet advanced in lockstep, one turn at a time: the
+        user similarities of every ongoing dialogue are one matcher batch, the
+        answers are drawn from rng with vectorized sampling and the re-ranking
+        after a no is batched by the facet ranker. The tie-break keys of all
+        dialogues are a single (epochs x facets) draw."""
+        n_facets = len(self.topic_facets(topic))
+        states = [
+            self.build_state(topic, tiebreaks)
+            for tiebreaks in rng.random((epochs, n_facets))
+        ]
+        user_states = [
+            self.user_simulator.build_state(topic, facet) for _ in range(epochs)
+        ]
+        dialogues = [
+            {"turns": [], "initial_candidate_facets_db": state.candidate_facets_db}
+            for state in states
+        ]
+        ongoing = [
+            i
+            for i, state in enumerate(states)
+            if state.state == clarify_types.ClarifyState.ONGOING_STATE
+        ]
+        while ongoing:
+            guesses = [states[i].candidates.pop() for i in ongoing]
+            questions = []
+            for i, (guessed_facet, clarify_score) in zip(ongoing, guesses):
+                states[i].dead_facets_db.append((guessed_facet, clarify_score))
+                questions.append(
+                    self.question_generator.generate_question(topic, guessed_facet)
+                )
+            feedbacks = self.user_simulator.feedback_batch(
+                [user_states[i] for i in ongoing], questions, rng
+            )
+            said_no = [
+                i
+                for i, feedback in zip(ongoing, feedbacks)
+                if not self.take_answer(states[i], feedback["answer"])
+            ]
+            rankings = self.facet_ranker.rank_facets_batch([states[i] for i in said_no])
+            for i, ranking in zip(said_no, rankings):
+                states[i].candidates.rescore(ranking)
+                self.check_failure(states[i], user_states[i])
+            for i, (guessed_facet, _), question, feedback in zip(
+                ongoing, guesses, questions, feedbacks
+            ):
+                dialogues[i]["turns"].append(
+                    self.turn_out(
+                        states[i],
+                        question,
+                        feedback["answer"],
+                        feedback["similarity"],
+                        guessed_facet,
+                    )
+                )
+            ongoing = [
+                i
+                for i in ongoing
+                if states[i].state == clarify_types.ClarifyState.ONGOING_STATE
+            ]
+        query_metrics = {}
+        for dialogue_out, state in zip(dialogues, states):
+            self.finish_dialogue(dialogue_out, state, topic, facet)
+            query = dialogue_out["query"]
+            if query not in query_metrics:
+                query_metrics[query] = self.ir_metric_calculator.calculate_metrics(
+                    self.ir_system, topic, facet, query
+                )
+            dialogue_out["metrics"] = dict(query_metrics[query])
+        return dialogues
+
+    def run_facet_exact(
+        self,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        median: str = "exact",
+    ):
+        facet_out = {}
+        facet_out["facet_id"] = facet.id
+        facet_out["simulation"] = "exact"
+        facet_out["outcomes"] = []
+        facet_metrics = aggregation.MetricAggregator(median)
+        query_metrics = {}
+        outcomes = self.enumerate_dialogues(topic, facet)
+        for (turns, subj_success, real_success, query), p in outcomes.items():
+            if query not in query_metrics:
+                query_metrics[query] = self.ir_metric_calculator.calculate_metrics(
+                    self.ir_system, topic, facet, query
+                )
+            facet_out["outcomes"].append(
+                {
+                    "probability": p,
+                    "turns": turns,
+                    "subj_success": subj_success,
+                    "real_success": real_success,
+                    "query": query,
+                    "metrics": query_metrics[query],
+                }
+            )
+            facet_metrics.add("turns", turns, p)
+            facet_metrics.add("subj_success", subj_success, p)
+            facet_metrics.add("real_success", real_success, p)
+            facet_metrics.update(query_metrics[query], p)
+        return facet_out, facet_metrics
+
+    def enumerate_dialogues(
+        self, topic: clarify_types.Topic, facet: clarify_types.Facet
+    ) -> tp.Dict[tp.Tuple[int, bool, bool, str], float]:
+        """Probability of each outcome (turns, subjective and real success, final
+        query) of a dialogue about facet, by walking the tree of every tie-break
+        and answer. Branches share the state of their common prefix and answers
+        that lead to the same state are merged. Raises DialogueTreeTooLarge past
+        max_tree_nodes turns or max_tie_facets facets involved in ties."""
+        if not self.facet_ranker.deterministic:
+            raise DialogueTreeTooLarge("facet ranker is not deterministic")
+        outcomes = defaultdict(float)
+        user_state = self.user_simulator.build_state(topic, facet)
+        stack = [(self.build_state(topic), user_state, 1.0, (), 0, None)]
+        nodes = 0
+        while stack:
+            state, user_state, probability, ties, turns, guessed = stack.pop()
+            if state.state != clarify_types.ClarifyState.ONGOING_STATE:
+                success = state.state == clarify_types.ClarifyState.SUCCESS_STATE
+                real_success = success and guessed.id == facet.id
+                query = guessed.desc if success else topic.query
+                outcomes[(turns, success, real_success, query)] += probability
+                continue
+            nodes += 1
+            if nodes > self.max_tree_nodes:
+                raise DialogueTreeTooLarge("more than %d turns" % self.max_tree_nodes)
+            tied = state.candidates.best()
+            for guessed, p_tie in zip(tied, self.tie_probabilities(ties, tied)):
+                if p_tie == 0:
+                    continue
+                branch = state.copy()
+                clarify_score = branch.candidates.remove(guessed)
+                branch.dead_facets_db.append((guessed, clarify_score))
+                question = self.question_generator.generate_question(topic, guessed)
+                branch_ties = ties
+                if len(tied) > 1:
+                    branch_ties += ((guessed, frozenset(tied) - {guessed}),)
+                for feedback, p_answer in self.merged_feedbacks(user_state, question):
+                    result = self.observe(
+                        branch.copy(), guessed, clarify_score, question, feedback
+                    )
+                    stack.append(
+                        (
+                            result["state"],
+                            feedback["state"],
+                            probability * p_tie * p_answer,
+                            branch_ties,
+                            turns + 1,
+                            guessed,
+                        )
+                    )
+        return outcomes
+
+    def merged_feedbacks(
+        self, user_state: user_simulator.UserSimulatorState, question: str
+    ) -> tp.List[tp.Tuple[tp.Dict, float]]:
+        # the dialogue only depends on an answer through its stance and its
+        # informative no, so answers that agree on both are one branch
+        merged = {}
+        for feedback, p in self.user_simulator.feedback_distribution(
+            user_state, question
+        ):
+            if p == 0:
+                continue
+            answer = feedback["answer"]
+            yes = self.yes_no_detector.stance(answer) == "yes"
+            key = (yes, None if yes else self.informative_no_extractor.extract(answer))
+            if key in merged:
+                p += merged[key][1]
+                feedback = merged[key][0]
+            merged[key] = (feedback, p)
+        return list(merged.values())
+
+    def tie_probabilities(
+        self, ties: tp.Tuple, tied: tp.List[clarify_types.Facet]
+    ) -> tp.List[float]:
+        """Probability of each tied facet being popped first, given the ties
+        earlier in the dialogue. Tie-break keys are drawn once per facet, so a
+        facet that lost a tie is likely to lose the next one; the probability is
+        the share of key orders agreeing with all ties so far that it wins."""
+        if len(tied) == 1:
+            return [1.0]
+        tied_set = frozenset(tied)
+        if all(tied_set <= losers or not tied_set & losers for _, losers in ties):
+            # earlier ties did not tell the tied facets apart
+            return [1 / len(tied)] * len(tied)
+        elements = tuple(
+            dict.fromkeys(tied + [f for w, losers in ties for f in (w, *losers)])
+        )
+        if len(elements) > self.max_tie_facets:
+            raise DialogueTreeTooLarge("%d facets involved in ties" % len(elements))
+        total = count_orders(elements, ties)
+        return [
+            count_orders(elements, ties + ((f, tied_set - {f}),)) / total for f in tied
+        ]
+
+    def topic_record(self, topic: clarify_types.Topic) -> tp.Dict:
+        return {
+            "type": "topic",
+            "topic_id": topic.id,
+            "query": topic.query,
+            "facets": [facet.to_json() for facet in topic.facets],
+        }
+
+    def facet_record(self, topic: clarify_types.Topic, facet_out: tp.Dict) -> tp.Dict:
+        return {"type": "facet", "topic_id": topic.id, **facet_out}
+
+    def dialogue_record(
+        self,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        epoch: int,
+        dialogue_out: tp.Dict,
+    ) -> tp.Dict:
+        return {
+            "type": "dialogue",
+            "topic_id": topic.id,
+            "facet_id": facet.id,
+            "epoch": epoch,
+            **dialogue_out,
+        }
+
     def run_dialogue(self, topic: clarify_types.Topic, facet: clarify_types.Facet):
         dialogue_out = {}
         dialogue_out["turns"] = []
         state = self.build_state(topic)
-        dialogue_out["initial_candidate_facets_db"] = state.candidate_facets_db[:]
+        dialogue_out["initial_candidate_facets_db"] = state.candidate_facets_db
         user_sim_state = self.user_simulator.build_state(topic, facet)
         while state.state == clarify_types.ClarifyState.ONGOING_STATE:
             step_result = self.step(state, user_sim_state)
             state = step_result["state"]
             dialogue_out["turns"].append(
-                {
-                    "question": step_result["question"],
-                    "answer": step_result["answer"],
-                    "user_p": step_result["user_score"],
-                    "guessed_facet_id": step_result["guessed_facet"].id,
-                    "candidate_facets_db": [
-                        (facet.id, score) for facet, score in state.candidate_facets_db
-                    ],
-                    "informative_no_db": state.informative_no_db[:],
-                    "state": state.state,
-                }
+                self.turn_out(
+                    state,
+                    step_result["question"],
+                    step_result["answer"],
+                    step_result["user_score"],
+                    step_result["guessed_facet"],
+                )
             )
+        self.finish_dialogue(dialogue_out, state, topic, facet)
+        dialogue_out["metrics"] = self.ir_metric_calculator.calculate_metrics(
+            self.ir_system, topic, facet, dialogue_out["query"]
+        )
+        return dialogue_out
+
+    def turn_out(
+        self,
+        state: clarify_types.ClarifyState,
+        question: str,
+        answer: str,
+        user_score: float,
+        guessed_facet: clarify_types.Facet,
+    ) -> tp.Dict:
+        return {
+            "question": question,
+            "answer": answer,
+            "user_p": user_score,
+            "guessed_facet_id": guessed_facet.id,
+            "candidate_facets_db": [
+                (facet.id, score) for facet, score in state.candidate_facets_db
+            ],
+            "informative_no_db": state.informative_no_db[:],
+            "state": state.state,
+        }
+
+    def finish_dialogue(
+        self,
+        dialogue_out: tp.Dict,
+        state: clarify_types.ClarifyState,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+    ):
         dialogue_out["subj_success"] = False
         dialogue_out["real_success"] = False
         if state.state == clarify_types.ClarifyState.SUCCESS_STATE:
@@ -163,7 +643,26 @@ class Clarify:
             ][0]
         else:
             dialogue_out["query"] = topic.query
-        dialogue_out["metrics"] = self.ir_metric_calculator.calculate_metrics(
-            self.ir_system, topic, facet, dialogue_out["query"]
-        )
-        return dialogue_out
+
+
+_worker_args = None
+
+
+def _init_worker(
+    clarify: Clarify,
+    topics,
+    epochs: int,
+    seed: tp.Optional[int],
+    facet_kwargs: tp.Dict,
+):
+    global _worker_args
+    _worker_args = (clarify, topics, epochs, seed, facet_kwargs)
+    if clarify.profile is not None:
+        clarify.profile.start_worker()
+
+
+def _run_topic_worker(topic_idx: int):
+    clarify, topics, epochs, seed, facet_kwargs = _worker_args
+    result = clarify.run_topic(epochs, topics[topic_idx], seed, **facet_kwargs)
+    drained = clarify.profile.drain() if clarify.profile is not None else None
+    return result, drained
@@ -9,10 +9,17 @@
 #  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
 #  and limitations under the License.
 
+import copy
+import heapq
+import itertools
+import random
 import typing as tp
 
 
 class Facet:
+    # there are many thousands of facets with graph-bing
+    __slots__ = ["id", "desc", "questions_answers", "_enhanced_rep", "_full_rep"]
+
     def __init__(
         self, id: str, desc: str, questions_answers: tp.List[tp.Tuple[str, str]]
     ):
@@ -20,6 +27,7 @@ class Facet:
         self.desc = desc
         self.questions_answers = questions_answers
         self._enhanced_rep = ""
+        self._full_rep = None  # type: tp.Optional[str]
 
     @property
     def enhanced_rep(self):
@@ -28,10 +36,14 @@ class Facet:
     @enhanced_rep.setter
     def enhanced_rep(self, value):
         self._enhanced_rep = value
+        self._full_rep = None
 
     @property
     def full_rep(self):
-        return self.desc + "\n" + self.enhanced_rep
+        # rankers ask for it on every turn, so it is only built once
+        if self._full_rep is None:
+            self._full_rep = self.desc + "\n" + self.enhanced_rep
+        return self._full_rep
 
     def __repr__(self):
         return self.desc
@@ -41,6 +53,8 @@ class Facet:
 
 
 class Topic:
+    __slots__ = ["id", "query", "facets"]
+
     def __init__(self, id: str, query: str, facets: tp.List[Facet]):
         self.id = id
         self.query = query
@@ -57,6 +71,87 @@ class Topic:
         }
 
 
+class CandidateQueue:
+    """Max-priority queue of candidate facets. Ties are broken by a random key
+    drawn once per facet when it is first queued, so the order among equally
+    scored facets is stable for the rest of the dialogue. Updated facets are
+    re-pushed and their old heap entries skipped when popped. The keys can
+    also be given, one per facet of scored_facets."""
+
+    def __init__(
+        self,
+        scored_facets: tp.Iterable[tp.Tuple[Facet, float]] = (),
+        tiebreaks: tp.Optional[tp.Sequence[float]] = None,
+    ):
+        self.heap = []  # type: tp.List[tp.List]
+        self.entries = {}  # type: tp.Dict[Facet, tp.List]
+        self.tiebreaks = {}  # type: tp.Dict[Facet, float]
+        if tiebreaks is not None:
+            scored_facets = list(scored_facets)
+            self.tiebreaks = {
+                facet: float(tiebreak)
+                for (facet, _), tiebreak in zip(scored_facets, tiebreaks)
+            }
+        self.counter = itertools.count()
+        self.rescore(scored_facets)
+
+    def _entry(self, facet: Facet, score: float) -> tp.List:
+        if facet not in self.tiebreaks:
+            self.tiebreaks[facet] = random.random()
+        return [-score, -self.tiebreaks[facet], next(self.counter), facet]
+
+    def update(self, facet: Facet, score: float):
+        if facet in self.entries:
+            self.entries[facet][-1] = None
+        entry = self._entry(facet, score)
+        self.entries[facet] = entry
+        heapq.heappush(self.heap, entry)
+
+    def rescore(self, scored_facets: tp.Iterable[tp.Tuple[Facet, float]]):
+        # replaces all candidates at once, in O(n) rather than O(n log n)
+        self.entries = {
+            facet: self._entry(facet, score) for facet, score in scored_facets
+        }
+        self.heap = list(self.entries.values())
+        heapq.heapify(self.heap)
+
+    def pop(self) -> tp.Tuple[Facet, float]:
+        while self.heap:
+            neg_score, _, _, facet = heapq.heappop(self.heap)
+            if facet is not None:
+                del self.entries[facet]
+                return facet, -neg_score
+        raise IndexError("pop from empty candidate queue")
+
+    def remove(self, facet: Facet) -> float:
+        entry = self.entries.pop(facet)
+        entry[-1] = None
+        return -entry[0]
+
+    def best(self) -> tp.List[Facet]:
+        # the facets that share the highest score, one of which pop returns
+        top = min(entry[0] for entry in self.entries.values())
+        return [facet for facet, entry in self.entries.items() if entry[0] == top]
+
+    def facets(self) -> tp.List[Facet]:
+        return list(self.entries)
+
+    def snapshot(self) -> tp.List[tp.Tuple[Facet, float]]:
+        return [(facet, -entry[0]) for facet, entry in self.sorted_entries()]
+
+    def sorted_entries(self) -> tp.List[tp.Tuple[Facet, tp.List]]:
+        return sorted(self.entries.items(), key=lambda x: x[1][:3])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def copy(self) -> "CandidateQueue":
+        queue = CandidateQueue()
+        queue.tiebreaks = dict(self.tiebreaks)
+        queue.rescore(self.snapshot())
+        return queue
+
+
 class ClarifyState:
     ONGOING_STATE = 0
     SUCCESS_STATE = 1
@@ -67,11 +162,29 @@ class ClarifyState:
         topic: Topic,
         candidate_facets_db: tp.List[tp.Tuple[Facet, float]],
         max_turns: int = 0,
+        tiebreaks: tp.Optional[tp.Sequence[float]] = None,
     ):
         self.topic = topic
-        self.candidate_facets_db = candidate_facets_db
+        self.candidates = CandidateQueue(candidate_facets_db, tiebreaks)
         self.informative_no_db: tp.List[str] = []
         self.dead_facets_db = []  # type: tp.List[tp.Tuple[Facet, float]]
         self.state = self.ONGOING_STATE  # type: int
         self.max_turns = max_turns
         self.turns_left = max_turns
+        # scratch space for rankers that update their scores incrementally
+        self.ranker_state = {}  # type: tp.Dict[str, tp.Any]
+
+    @property
+    def candidate_facets_db(self) -> tp.List[tp.Tuple[Facet, float]]:
+        # sorted copy of the candidates, best first
+        return self.candidates.snapshot()
+
+    def copy(self) -> "ClarifyState":
+        state = copy.copy(self)
+        state.candidates = self.candidates.copy()
+        state.informative_no_db = self.informative_no_db[:]
+        state.dead_facets_db = self.dead_facets_db[:]
+        # facets are shared, anything else the ranker keeps is copied
+        memo = {id(facet): facet for facet in self.candidates.tiebreaks}
+        state.ranker_state = copy.deepcopy(self.ranker_state, memo)
+        return state
@@ -20,55 +20,208 @@ from abc import ABC, abstractmethod
 
 import clarify_types
 import match
+import profiling
 
 
 class FacetRanker(ABC):
+    # whether the ranking only depends on the state, so that the initial ranking
+    # of a topic can be computed once and shared by all of its dialogues
+    deterministic = False
+
     @abstractmethod
     def rank_facets(
         self, state: clarify_types.ClarifyState
     ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
         pass
 
+    def rank_facets_batch(
+        self, states: tp.List[clarify_types.ClarifyState]
+    ) -> tp.List[tp.List[tp.Tuple[clarify_types.Facet, float]]]:
+        return [self.rank_facets(state) for state in states]
+
+
+class ProfiledFacetRanker(FacetRanker):
+    def __init__(self, ranker: FacetRanker, profile: profiling.Profile, name: str):
+        self.ranker = ranker
+        self.deterministic = ranker.deterministic
+        self.timings = {
+            method: profile.timing("%s.%s" % (name, method))
+            for method in ["rank_facets", "rank_facets_batch"]
+        }
+
+    def rank_facets(
+        self, state: clarify_types.ClarifyState
+    ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        with self.timings["rank_facets"]:
+            return self.ranker.rank_facets(state)
+
+    def rank_facets_batch(
+        self, states: tp.List[clarify_types.ClarifyState]
+    ) -> tp.List[tp.List[tp.Tuple[clarify_types.Facet, float]]]:
+        with self.timings["rank_facets_batch"]:
+            return self.ranker.rank_facets_batch(states)
+
 
 class RandomFacetRanker(FacetRanker):
     def rank_facets(
         self, state: clarify_types.ClarifyState
     ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
         return sorted(
-            [(facet, random.random()) for facet, _ in state.candidate_facets_db],
+            [(facet, random.random()) for facet in state.candidates.facets()],
             key=lambda x: x[1],
             reverse=True,
         )
 
 
 class SimilarityFacetRanker(FacetRanker):
-    def __init__(self, matcher: match.SentenceMatcher, alpha: float = 1.0):
+    deterministic = True
+
+    def __init__(
+        self,
+        matcher: match.SentenceMatcher,
+        alpha: float = 1.0,
+        reranker: tp.Optional[match.SentenceMatcher] = None,
+        rerank_top: int = 5,
+    ):
         self.matcher = matcher
         assert 0 <= alpha <= 1
         self.alpha = alpha
+        assert rerank_top >= 0
+        self.reranker = reranker
+        self.rerank_top = rerank_top
 
     def rank_facets(
         self, state: clarify_types.ClarifyState
     ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        facets = state.candidates.facets()
         # positive context
-        c_p = set(state.informative_no_db)
+        if self.alpha > 0:
+            pos_scores = self.context_scores(
+                state, "positive", state.informative_no_db, facets
+            )
+        else:
+            pos_scores = np.zeros(len(facets))
         # negative context
-        c_n = set(facet.full_rep for facet, _ in state.dead_facets_db)
-        scores = []
-        for facet, _ in state.candidate_facets_db:
-            if len(c_p) > 0 and self.alpha > 0:
-                pos_score = np.mean(
-                    [self.matcher.similarity(facet.full_rep, c) for c in c_p]
-                )
-            else:
-                pos_score = 0
-            if len(c_n) > 0 and self.alpha < 1:
-                neg_score = np.mean(
-                    [-self.matcher.similarity(facet.full_rep, c) for c in c_n]
-                )
-            else:
-                neg_score = 0
-            score = (1 - self.alpha) * neg_score + self.alpha * pos_score
-            scores.append((facet, score))
+        if self.alpha < 1:
+            neg_scores = -self.context_scores(
+                state,
+                "negative",
+                [facet.full_rep for facet, _ in state.dead_facets_db],
+                facets,
+            )
+        else:
+            neg_scores = np.zeros(len(facets))
+        scores = (1 - self.alpha) * neg_scores + self.alpha * pos_scores
+        scores = list(zip(facets, scores))
         scores = sorted(scores, key=lambda x: x[1], reverse=True)
+        if self.reranker is not None and self.rerank_top > 0:
+            scores = self.rerank(state, scores)
         return scores
+
+    def rerank(
+        self,
+        state: clarify_types.ClarifyState,
+        scores: tp.List[tp.Tuple[clarify_types.Facet, float]],
+    ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        """Reorders the rerank_top best facets by the same score computed with
+        the reranker. They keep the scores of the positions they move to, so
+        they stay ahead of the other facets, whose scores are on another scale."""
+        top = scores[: self.rerank_top]
+        facets = [facet.full_rep for facet, _ in top]
+        rescored = np.zeros(len(top))
+        contexts = [
+            (self.alpha, state.informative_no_db),
+            (self.alpha - 1, [facet.full_rep for facet, _ in state.dead_facets_db]),
+        ]
+        for weight, context in contexts:
+            items = list(dict.fromkeys(context))
+            if weight and items:
+                similarities = self.reranker.similarity_matrix(facets, items)
+                rescored += weight * similarities.mean(axis=1)
+        # a stable sort, so that ties keep the first ranking's order
+        order = sorted(range(len(top)), key=lambda i: rescored[i], reverse=True)
+        reranked = [(top[i][0], score) for i, (_, score) in zip(order, top)]
+        return reranked + scores[self.rerank_top :]
+
+    def rank_facets_batch(
+        self, states: tp.List[clarify_types.ClarifyState]
+    ) -> tp.List[tp.List[tp.Tuple[clarify_types.Facet, float]]]:
+        # states with the same dead facets and informative no's rank the same,
+        # so only one of each is ranked (the others' running sums catch up on
+        # their next rank_facets)
+        groups = {}  # type: tp.Dict[tp.Tuple, tp.List[int]]
+        for i, state in enumerate(states):
+            key = (
+                tuple(facet for facet, _ in state.dead_facets_db),
+                tuple(state.informative_no_db),
+            )
+            groups.setdefault(key, []).append(i)
+        ranked = [states[indices[0]] for indices in groups.values()]
+        # score every pair they are about to need in one matcher batch, so that
+        # rank_facets only reads them from the matcher's cache
+        if self.matcher.pair_cache:
+            pairs = [pair for state in ranked for pair in self.pending_pairs(state)]
+            if pairs:
+                self.matcher.similarity_batch(list(dict.fromkeys(pairs)))
+        rankings = [None] * len(states)  # type: tp.List[tp.Any]
+        for state, indices in zip(ranked, groups.values()):
+            ranking = self.rank_facets(state)
+            for i in indices:
+                rankings[i] = ranking
+        return rankings
+
+    def pending_pairs(
+        self, state: clarify_types.ClarifyState
+    ) -> tp.List[tp.Tuple[str, str]]:
+        # the pairs context_scores will score on the next rank_facets
+        contexts = []
+        if self.alpha > 0:
+            contexts.append(("positive", state.informative_no_db))
+        if self.alpha < 1:
+            contexts.append(
+                ("negative", [facet.full_rep for facet, _ in state.dead_facets_db])
+            )
+        facets = state.candidates.facets()
+        pairs = []
+        for which, context in contexts:
+            cache = state.ranker_state.get(which, {"seen": {}, "sums": {}})
+            new = [c for c in dict.fromkeys(context) if c not in cache["seen"]]
+            seen = list(cache["seen"]) + new
+            for facet in facets:
+                items = new if facet in cache["sums"] else seen
+                pairs.extend((facet.full_rep, item) for item in items)
+        return pairs
+
+    def context_scores(
+        self,
+        state: clarify_types.ClarifyState,
+        which: str,
+        context: tp.List[str],
+        facets: tp.List[clarify_types.Facet],
+    ) -> np.ndarray:
+        """Mean similarity of each facet to the distinct items of a context.
+        Contexts only grow during a dialogue, so per-facet sums are kept in the
+        state and each call only scores the items added since the last one."""
+        cache = state.ranker_state.setdefault(which, {"seen": {}, "sums": {}})
+        seen, sums = cache["seen"], cache["sums"]
+        new = [c for c in dict.fromkeys(context) if c not in seen]
+        tracked = [facet for facet in facets if facet in sums]
+        if new and tracked:
+            similarities = self.matcher.similarity_matrix(
+                [facet.full_rep for facet in tracked], new
+            ).sum(axis=1)
+            for facet, similarity in zip(tracked, similarities):
+                sums[facet] += similarity
+        seen.update(dict.fromkeys(new))
+        untracked = [facet for facet in facets if facet not in sums]
+        if untracked:
+            if seen:
+                similarities = self.matcher.similarity_matrix(
+                    [facet.full_rep for facet in untracked], list(seen)
+                ).sum(axis=1)
+            else:
+                similarities = np.zeros(len(untracked))
+            sums.update(zip(untracked, similarities))
+        if not seen:
+            return np.zeros(len(facets))
+        return np.array([sums[facet] for facet in facets], dtype=float) / len(seen)
@@ -10,6 +10,7 @@
 #  and limitations under the License.
 
 import typing as tp
+import asyncio
 import json
 import pathlib
 import http.client, urllib.parse
@@ -17,11 +18,16 @@ import time
 import string
 import collections
 import csv
+import os
+import sqlite3
 from abc import ABC, abstractmethod
+import aiohttp
 import tqdm
 
 import qulac
 import clarify_types
+import profiling
+import utils
 
 
 class FacetRetriever(ABC):
@@ -53,6 +59,20 @@ class EnhancedFacetsFacetRetriever(FacetRetriever):
         return facets
 
 
+class ProfiledFacetRetriever(FacetRetriever):
+    def __init__(
+        self, facet_retriever: FacetRetriever, profile: profiling.Profile, name: str
+    ):
+        self.facet_retriever = facet_retriever
+        self.timing = profile.timing("%s.facets_for_topic" % name)
+
+    def facets_for_topic(
+        self, topic: clarify_types.Topic
+    ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        with self.timing:
+            return self.facet_retriever.facets_for_topic(topic)
+
+
 class QulacFacetRetriever(FacetRetriever):
     def __init__(self, dataset: qulac.Qulac):
         self.dataset = dataset
@@ -70,6 +90,113 @@ class BingFacetNode:
         self.depth = depth
 
 
+class BingSuggestionCache:
+    """Bing suggestions by query in an SQLite file: lookups go through the
+    primary key index and every new query is one committed insert, so the
+    file stays consistent if a run is interrupted. Queries that were looked up
+    are also kept in memory. A cache in the former JSON format is imported once
+    into a database next to it, and the JSON file is left untouched."""
+
+    def __init__(self, path: pathlib.Path):
+        path = pathlib.Path(path)
+        self.json_path = None
+        if path.suffix == ".json":
+            self.json_path = path
+            path = path.with_suffix(".sqlite")
+        self.path = path
+        self.memory = {}  # type: tp.Dict[str, tp.List[str]]
+        if not self.path.exists() and self.json_path is not None:
+            if self.json_path.exists():
+                self._migrate()
+        self.conn = None
+        self.pid = None
+        # counted per process (a profile merges in those of forked workers)
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self, path: pathlib.Path) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(path), timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS suggestions ("
+            "query TEXT PRIMARY KEY, suggestions TEXT NOT NULL)"
+        )
+        conn.commit()
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork, so every process opens its own
+        if self.pid != os.getpid():
+            self.conn = self._connect(self.path)
+            self.pid = os.getpid()
+        return self.conn
+
+    def _migrate(self):
+        with self.json_path.open() as f:
+            cache = json.load(f)
+        # build the database aside and rename it, so a crash cannot leave half
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        if tmp.exists():
+            tmp.unlink()
+        conn = self._connect(tmp)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.executemany(
+            "INSERT OR REPLACE INTO suggestions VALUES (?, ?)",
+            [(query, json.dumps(suggestions)) for query, suggestions in cache.items()],
+        )
+        conn.commit()
+        conn.close()
+        tmp.rename(self.path)
+
+    def __contains__(self, query: str) -> bool:
+        # retrievers check membership before every lookup or request
+        found = self.get(query) is not None
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def __getitem__(self, query: str) -> tp.List[str]:
+        suggestions = self.get(query)
+        if suggestions is None:
+            raise KeyError(query)
+        return suggestions
+
+    def get(self, query: str) -> tp.Optional[tp.List[str]]:
+        if query not in self.memory:
+            cursor = self._connection().execute(
+                "SELECT suggestions FROM suggestions WHERE query = ?", (query,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            self.memory[query] = json.loads(row[0])
+        return self.memory[query]
+
+    def __setitem__(self, query: str, suggestions: tp.List[str]):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO suggestions VALUES (?, ?)",
+            (query, json.dumps(suggestions)),
+        )
+        conn.commit()
+        self.memory[query] = suggestions
+
+    def __len__(self) -> int:
+        conn = self._connection()
+        return conn.execute("SELECT COUNT(*) FROM suggestions").fetchone()[0]
+
+    def stats(self) -> tp.Dict[str, float]:
+        return utils.hit_stats(self.hits, self.misses)
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+        self.pid = None
+
+
 class BingFacetRetriever(FacetRetriever):
     def __init__(
         self,
@@ -87,24 +214,16 @@ class BingFacetRetriever(FacetRetriever):
         self.key = key
         self.cache_path = pathlib.Path(cache_path)
         self.max_depth = max_depth
-        if self.cache_path.exists():
-            with self.cache_path.open() as f:
-                self.cache = json.load(f)
-        else:
-            self.cache = {}
+        self.cache = BingSuggestionCache(self.cache_path)
         self.last_call_at = 0.0
         self.bing_sleep = bing_sleep
         self.chars = chars
 
-    def write_cache(self):
-        with self.cache_path.open("w") as f:
-            json.dump(self.cache, f)
+    def expansion_queries(self, facet: str) -> tp.List[str]:
+        return [facet + " " + c if c else facet for c in [""] + self.chars]
 
     def expand_node(self, node: BingFacetNode):
-        for character in [""] + self.chars:
-            query = node.facet
-            if character:
-                query += " " + character
+        for query in self.expansion_queries(node.facet):
             for i, suggestion in enumerate(self._auto_suggest(query)):
                 facet_desc = suggestion.strip()
                 node.neighbors.append(BingFacetNode(facet_desc, node.depth + 1))
@@ -156,12 +275,153 @@ class BingFacetRetriever(FacetRetriever):
             raise Exception("Bing API returned status " + str(response.status))
         results = json.load(response)
         self.last_call_at = time.time()
+        suggestions = self._parse_suggestions(results)
+        self.cache[query] = suggestions
+        return suggestions
+
+    def _parse_suggestions(self, results: tp.Dict) -> tp.List[str]:
         suggestions = []
         for i, suggestion in enumerate(
             results["suggestionGroups"][0]["searchSuggestions"]
         ):
             expanded_query = suggestion["query"]
             suggestions.append(expanded_query)
-        self.cache[query] = suggestions
-        self.write_cache()
         return suggestions
+
+
+class TokenBucket:
+    """Lets through rate requests per second on average, in bursts of at most
+    capacity. Must be created inside the event loop that uses it."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # waiters queue on the lock, so tokens are handed out in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncBingFacetRetriever(BingFacetRetriever):
+    """BingFacetRetriever whose suggestions are fetched ahead of time by
+    prefetch: every uncached expansion query of a whole depth level, for all
+    topics at once, is sent concurrently over a pool of keep-alive connections,
+    at most one request every bing_sleep seconds on average (with bursts of
+    burst requests). 429 and 5xx responses and connection errors are retried
+    with exponential backoff. facets_for_topic then runs from the cache and
+    falls back to the synchronous client for anything not prefetched."""
+
+    def __init__(
+        self,
+        key: str,
+        cache_path: pathlib.Path,
+        max_depth: int = 1,
+        endpoint: str = "api.bing.microsoft.com",
+        bing_sleep: float = 3,
+        chars: tp.List[str] = list(string.ascii_letters),
+        concurrency: int = 8,
+        burst: int = 1,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 30,
+    ):
+        super().__init__(
+            key,
+            cache_path,
+            max_depth=max_depth,
+            endpoint=endpoint,
+            bing_sleep=bing_sleep,
+            chars=chars,
+        )
+        assert concurrency > 0
+        self.concurrency = concurrency
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # a bare host means https, a full URL (e.g. a local stand-in) is kept
+        base = endpoint if "://" in endpoint else "https://" + endpoint
+        self.url = base.rstrip("/") + "/v7.0/Suggestions"
+
+    def prefetch(self, topics: tp.List[clarify_types.Topic]):
+        # breadth-first over all topics at once, one concurrent batch per depth
+        expanded = set()  # type: tp.Set[str]
+        frontier = {topic.query for topic in topics}
+        for _ in range(self.max_depth):
+            frontier -= expanded
+            expanded |= frontier
+            queries = [
+                query
+                for facet in sorted(frontier)
+                for query in self.expansion_queries(facet)
+            ]
+            asyncio.run(self._fetch_all(queries))
+            frontier = {
+                suggestion.strip()
+                for query in queries
+                for suggestion in self.cache[query]
+            }
+
+    async def _fetch_all(self, queries: tp.List[str]):
+        queries = [query for query in dict.fromkeys(queries) if query not in self.cache]
+        if not queries:
+            return
+        bucket = TokenBucket(1 / self.bing_sleep, self.burst)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Ocp-Apim-Subscription-Key": self.key},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        async with session:
+            # every response is stored as it arrives, so a failure in one query
+            # does not lose the others
+            results = await asyncio.gather(
+                *[self._fetch(session, bucket, query) for query in queries],
+                return_exceptions=True,
+            )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _fetch(
+        self, session: aiohttp.ClientSession, bucket: TokenBucket, query: str
+    ):
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            delay = self.backoff * 2**attempt
+            try:
+                async with session.get(
+                    self.url, params={"mkt": "en-US", "q": query}
+                ) as response:
+                    if response.status == 200:
+                        results = await response.json(content_type=None)
+                        self.cache[query] = self._parse_suggestions(results)
+                        return
+                    retryable = response.status == 429 or response.status >= 500
+                    if not retryable or attempt == self.max_retries:
+                        raise Exception(
+                            "Bing API returned status " + str(response.status)
+                        )
+                    # drain the body so that the connection can be reused
+                    await response.read()
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(delay)
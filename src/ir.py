@@ -9,13 +9,20 @@
 #  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
 #  and limitations under the License.
 
+import collections
+import multiprocessing
 import pathlib
+import pickle
 import tempfile
 import typing as tp
+import numpy as np
 import trectools
 import os
 
 import clarify_types
+import facet_retrieval
+import profiling
+import ql_index
 import thirdparty.ql.QL as QL
 from abc import ABC, abstractmethod
 
@@ -33,6 +40,17 @@ class InformationRetriever(ABC):
     ) -> tp.List[tp.Tuple[Document, float]]:
         pass
 
+    def search_arrays(
+        self, topic: clarify_types.Topic, queries: tp.List[str]
+    ) -> tp.List[tp.Tuple[np.ndarray, np.ndarray]]:
+        results = []
+        for query in queries:
+            ir_results = self.search(topic, query)
+            doc_ids = np.array([str(doc.id) for doc, _ in ir_results])
+            scores = np.array([score for _, score in ir_results], dtype=float)
+            results.append((doc_ids, scores))
+        return results
+
 
 class DummyInformationRetriever(InformationRetriever):
     def search(
@@ -41,14 +59,85 @@ class DummyInformationRetriever(InformationRetriever):
         return []
 
 
+class CachingInformationRetriever(InformationRetriever):
+    def __init__(self, ir_sys: InformationRetriever):
+        self.ir_sys = ir_sys
+        self.cache = {}
+        self.arrays_cache = {}
+
+    def search(
+        self, topic: clarify_types.Topic, query: str
+    ) -> tp.List[tp.Tuple[Document, float]]:
+        key = (topic.id, query)
+        if key not in self.cache:
+            if key in self.arrays_cache:
+                # already searched by search_arrays, e.g. while precomputing
+                doc_ids, scores = self.arrays_cache[key]
+                self.cache[key] = [
+                    (Document(doc_id, "dummy"), score)
+                    for doc_id, score in zip(doc_ids, scores)
+                ]
+            else:
+                self.cache[key] = self.ir_sys.search(topic, query)
+        return self.cache[key]
+
+    def search_arrays(
+        self, topic: clarify_types.Topic, queries: tp.List[str]
+    ) -> tp.List[tp.Tuple[np.ndarray, np.ndarray]]:
+        misses = list(
+            dict.fromkeys(q for q in queries if (topic.id, q) not in self.arrays_cache)
+        )
+        if misses:
+            for query, result in zip(misses, self.ir_sys.search_arrays(topic, misses)):
+                self.arrays_cache[(topic.id, query)] = result
+        return [self.arrays_cache[(topic.id, query)] for query in queries]
+
+
+class ProfiledInformationRetriever(InformationRetriever):
+    def __init__(
+        self, ir_sys: InformationRetriever, profile: profiling.Profile, name: str
+    ):
+        self.ir_sys = ir_sys
+        self.timings = {
+            method: profile.timing("%s.%s" % (name, method))
+            for method in ["search", "search_arrays"]
+        }
+
+    def search(
+        self, topic: clarify_types.Topic, query: str
+    ) -> tp.List[tp.Tuple[Document, float]]:
+        with self.timings["search"]:
+            return self.ir_sys.search(topic, query)
+
+    def search_arrays(
+        self, topic: clarify_types.Topic, queries: tp.List[str]
+    ) -> tp.List[tp.Tuple[np.ndarray, np.ndarray]]:
+        with self.timings["search_arrays"]:
+            return self.ir_sys.search_arrays(topic, queries)
+
+
 class QLInformationRetriever(InformationRetriever):
-    def __init__(self, ql_: QL.QL):
+    def __init__(self, ql_: QL.QL, cache_mb: float = 4096):
         self.ql = ql_
+        self.indexes = ql_index.TopicIndexCache(
+            self._load_inverted_index, ql_index.inverted_index_nbytes, cache_mb
+        )
+
+    def _load_inverted_index(self, topic_id: int) -> tp.Dict[str, tp.Dict]:
+        self.ql.current_topic_id = None
+        self.ql.load_topic_index(topic_id)
+        return self.ql._inverted_index
+
+    def load_topic_index(self, topic_id: int):
+        # looked up even for the current topic, so that every search is counted
+        # (cached indexes already had stopword counts removed when first loaded)
+        self.ql._inverted_index = self.indexes.get(topic_id)
+        self.ql.current_topic_id = topic_id
 
     def search(
         self, topic: clarify_types.Topic, query: str
     ) -> tp.List[tp.Tuple[Document, float]]:
-        self.ql.load_topic_index(int(topic.id))
+        self.load_topic_index(int(topic.id))
         self.ql.alpha = 0.5
         self.ql.update_query_lang_model(query=topic.query, question=query)
         df = self.ql.get_result_df(topk=1000, query_id="dummy")
@@ -58,6 +147,51 @@ class QLInformationRetriever(InformationRetriever):
         return results
 
 
+class MMapQLInformationRetriever(InformationRetriever):
+    """Scores with the same query language model as QLInformationRetriever, but
+    reads topic indexes converted by ql_index.py, which are memory-mapped instead
+    of unpickled and so shared between worker processes through the page cache."""
+
+    def __init__(
+        self,
+        ql_: QL.QL,
+        index_root: pathlib.Path,
+        topk: int = 1000,
+        cache_mb: float = 4096,
+    ):
+        self.ql = ql_
+        self.index_root = pathlib.Path(index_root)
+        self.topk = topk
+        self.indexes = ql_index.TopicIndexCache(
+            lambda topic_id: ql_index.TopicIndex(self.index_root / str(topic_id)),
+            lambda index: index.nbytes,
+            cache_mb,
+        )
+
+    def load_topic_index(self, topic_id: int) -> ql_index.TopicIndex:
+        return self.indexes.get(topic_id)
+
+    def search(
+        self, topic: clarify_types.Topic, query: str
+    ) -> tp.List[tp.Tuple[Document, float]]:
+        doc_ids, scores = self.search_arrays(topic, [query])[0]
+        return [
+            (Document(doc_id, "dummy"), score) for doc_id, score in zip(doc_ids, scores)
+        ]
+
+    def search_arrays(
+        self, topic: clarify_types.Topic, queries: tp.List[str]
+    ) -> tp.List[tp.Tuple[np.ndarray, np.ndarray]]:
+        index = self.load_topic_index(int(topic.id))
+        query_lms = [
+            ql_index.query_lang_model(self.ql, topic.query, query) for query in queries
+        ]
+        scores = ql_index.ql_scores(
+            index, query_lms, self.ql._term_stats, self.ql._total_terms, self.ql.mu
+        )
+        return [ql_index.top_k(index, row, self.topk) for row in scores]
+
+
 class MetricCalculator(ABC):
     @abstractmethod
     def calculate_metrics(
@@ -101,3 +235,218 @@ class TrecToolsMetricCalculator(MetricCalculator):
         )
         os.remove(f.name)
         return metrics
+
+
+class NativeMetricCalculator(MetricCalculator):
+    """Computes the same metrics as TrecToolsMetricCalculator in trec_eval mode,
+    but in memory: qrels are indexed once per topic-facet into sorted arrays and
+    each ranking is evaluated in a single vectorized pass."""
+
+    depths = [1, 5, 10, 20]
+    mrr_depth = 1000
+
+    def __init__(self, qrel_path: pathlib.Path):
+        judgments = collections.defaultdict(dict)
+        with open(qrel_path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                query_id, _, doc_id, rel = fields[:4]
+                judgments[query_id][doc_id] = float(rel)
+        self.qrels = {}  # type: tp.Dict[str, tp.Tuple[np.ndarray, np.ndarray]]
+        self.idcg = {}  # type: tp.Dict[str, tp.Dict[int, float]]
+        for query_id, docs in judgments.items():
+            doc_ids = np.array(sorted(docs))
+            rels = np.array([docs[doc_id] for doc_id in doc_ids])
+            self.qrels[query_id] = (doc_ids, rels)
+            ideal = np.sort(rels[rels > 0])[::-1]
+            ideal_dcg = np.cumsum(ideal / np.log2(np.arange(2, len(ideal) + 2)))
+            self.idcg[query_id] = {
+                depth: ideal_dcg[min(depth, len(ideal_dcg)) - 1] if len(ideal) else 0.0
+                for depth in self.depths
+            }
+
+    def calculate_metrics(
+        self,
+        ir_sys: InformationRetriever,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        query: str,
+    ) -> tp.Dict[str, float]:
+        doc_ids, scores = ir_sys.search_arrays(topic, [query])[0]
+        query_id = "%s-%s" % (topic.id, facet.id)
+        return self.metrics_from_ranking(query_id, doc_ids, scores)
+
+    def metrics_from_ranking(
+        self, query_id: str, doc_ids: np.ndarray, scores: np.ndarray
+    ) -> tp.Dict[str, float]:
+        metrics = {}
+        if len(doc_ids) == 0 or query_id not in self.qrels:
+            for v in self.depths:
+                metrics[f"p@{v}"] = 0.0
+                metrics[f"ndcg@{v}"] = 0.0
+            metrics["mrr"] = 0.0
+            return metrics
+        doc_ids = doc_ids.astype(str)
+        # trectools ranks by score descending, breaking ties by docid descending
+        # for precision and reciprocal rank but by docid ascending for ndcg
+        order = np.lexsort((doc_ids, scores))[::-1][: self.mrr_depth]
+        relevant = self._rels(query_id, doc_ids[order]) > 0
+        n_relevant = np.cumsum(relevant)
+        order = np.lexsort((doc_ids, -scores))[: max(self.depths)]
+        gains = self._rels(query_id, doc_ids[order]).clip(min=0)
+        dcg = np.cumsum(gains / np.log2(np.arange(2, len(gains) + 2)))
+        for v in self.depths:
+            metrics[f"p@{v}"] = float(n_relevant[min(v, len(n_relevant)) - 1] / v)
+            idcg = self.idcg[query_id][v]
+            ndcg = dcg[min(v, len(dcg)) - 1] / idcg if idcg else 0.0
+            metrics[f"ndcg@{v}"] = float(ndcg)
+        first_relevant = np.flatnonzero(relevant)
+        metrics["mrr"] = (
+            float(1 / (first_relevant[0] + 1)) if len(first_relevant) else 0.0
+        )
+        return metrics
+
+    def _rels(self, query_id: str, doc_ids: np.ndarray) -> np.ndarray:
+        qrel_doc_ids, qrel_rels = self.qrels[query_id]
+        idx = np.searchsorted(qrel_doc_ids, doc_ids).clip(max=len(qrel_doc_ids) - 1)
+        return np.where(qrel_doc_ids[idx] == doc_ids, qrel_rels[idx], 0.0)
+
+
+class ProfiledMetricCalculator(MetricCalculator):
+    def __init__(
+        self, metric_calculator: MetricCalculator, profile: profiling.Profile, name: str
+    ):
+        self.metric_calculator = metric_calculator
+        self.timing = profile.timing("%s.calculate_metrics" % name)
+
+    def calculate_metrics(
+        self,
+        ir_sys: InformationRetriever,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        query: str,
+    ) -> tp.Dict[str, float]:
+        with self.timing:
+            return self.metric_calculator.calculate_metrics(ir_sys, topic, facet, query)
+
+
+class PrecomputedMetricCalculator(MetricCalculator):
+    """The final query of a dialogue is either the topic query or the description
+    of one of the topic's candidate facets, so all metrics a simulation can ask
+    for are computed up front and looked up afterwards."""
+
+    def __init__(self, metric_calculator: MetricCalculator):
+        self.metric_calculator = metric_calculator
+        self.table = {}  # type: tp.Dict[tp.Tuple[str, str, str], tp.Dict[str, float]]
+        # shared memory, so that lookups in forked workers are counted too
+        self.hits = multiprocessing.Value("q", 0)
+        self.misses = multiprocessing.Value("q", 0)
+
+    def precompute(
+        self,
+        ir_sys: InformationRetriever,
+        topics: tp.List[clarify_types.Topic],
+        facet_retriever: facet_retrieval.FacetRetriever,
+        workers: int = 1,
+    ) -> int:
+        # facets are retrieved here rather than in the workers, so that each
+        # topic's are only fetched once
+        todo = []
+        for topic_idx, topic in enumerate(topics):
+            queries = [topic.query] + [
+                facet.desc for facet, _ in facet_retriever.facets_for_topic(topic)
+            ]
+            queries = list(dict.fromkeys(queries))
+            if any(
+                (topic.id, facet.id, query) not in self.table
+                for query in queries
+                for facet in topic.facets
+            ):
+                todo.append((topic_idx, queries))
+        args = (self.metric_calculator, ir_sys, topics)
+        if workers > 1:
+            with multiprocessing.get_context("fork").Pool(
+                workers, initializer=_init_precompute_worker, initargs=args
+            ) as pool:
+                results = pool.starmap(_precompute_topic_worker, todo)
+        else:
+            _init_precompute_worker(*args)
+            results = [_precompute_topic_worker(*item) for item in todo]
+        computed = 0
+        for entries in results:
+            self.table.update(entries)
+            computed += len(entries)
+        return computed
+
+    def calculate_metrics(
+        self,
+        ir_sys: InformationRetriever,
+        topic: clarify_types.Topic,
+        facet: clarify_types.Facet,
+        query: str,
+    ) -> tp.Dict[str, float]:
+        key = (topic.id, facet.id, query)
+        if key in self.table:
+            with self.hits.get_lock():
+                self.hits.value += 1
+        else:
+            with self.misses.get_lock():
+                self.misses.value += 1
+            self.table[key] = self.metric_calculator.calculate_metrics(
+                ir_sys, topic, facet, query
+            )
+        return dict(self.table[key])
+
+    def stats(self) -> tp.Dict[str, float]:
+        lookups = self.hits.value + self.misses.value
+        return {
+            "size": len(self.table),
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+            "hit_rate": self.hits.value / lookups if lookups else 0.0,
+        }
+
+    def reset_stats(self):
+        # the table is kept
+        for counter in [self.hits, self.misses]:
+            with counter.get_lock():
+                counter.value = 0
+
+    def load(self, path: pathlib.Path, signature: str) -> int:
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        # tables computed against other qrels or retrievers are stale
+        if saved["signature"] != signature:
+            return 0
+        self.table.update(saved["table"])
+        return len(saved["table"])
+
+    def save(self, path: pathlib.Path, signature: str):
+        with open(path, "wb") as f:
+            pickle.dump({"signature": signature, "table": self.table}, f)
+
+
+_precompute_args = None
+
+
+def _init_precompute_worker(*args):
+    global _precompute_args
+    _precompute_args = args
+
+
+def _precompute_topic_worker(topic_idx: int, queries: tp.List[str]):
+    metric_calculator, ir_sys, topics = _precompute_args
+    topic = topics[topic_idx]
+    # all of the topic's queries are searched at once and each ranking is then
+    # evaluated against every facet's qrels
+    ir_sys = CachingInformationRetriever(ir_sys)
+    ir_sys.search_arrays(topic, queries)
+    entries = {}
+    for query in queries:
+        for facet in topic.facets:
+            entries[(topic.id, facet.id, query)] = metric_calculator.calculate_metrics(
+                ir_sys, topic, facet, query
+            )
+    return entries
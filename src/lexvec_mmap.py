@@ -0,0 +1,174 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+import argparse
+import io
+import pathlib
+import typing as tp
+import numpy as np
+
+from thirdparty import lexvec
+
+FNV_OFFSET = 2166136261
+FNV_PRIME = 16777619
+
+# one mapping per file, shared by every matcher (and forked worker) in the process
+_models = {}  # type: tp.Dict[tp.Tuple[pathlib.Path, bool], MMapModel]
+
+
+def float32_path(path: pathlib.Path) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.with_name(path.name + ".f32.npy")
+
+
+def fnv1a(strings: tp.List[bytes]) -> np.ndarray:
+    # 32-bit FNV-1a of all strings at once, one byte column at a time
+    lengths = np.array([len(s) for s in strings], dtype=np.int64)
+    width = int(lengths.max()) if len(strings) else 0
+    buf = np.frombuffer(b"".join(s.ljust(width, b"\0") for s in strings), np.uint8)
+    buf = buf.reshape(len(strings), width).astype(np.uint64)
+    h = np.full(len(strings), FNV_OFFSET, dtype=np.uint64)
+    for j in range(width):
+        hashed = ((h ^ buf[:, j]) * np.uint64(FNV_PRIME)) & np.uint64(0xFFFFFFFF)
+        h = np.where(j < lengths, hashed, h)
+    return h
+
+
+class MMapModel:
+    """Drop-in for thirdparty.lexvec.Model that maps the embedding matrix once
+    instead of seeking and reading a vector per lookup. If a float32 sidecar
+    written by convert_float32 exists next to the model it is mapped instead,
+    halving memory. word_reps builds the vectors of a whole token list with one
+    vectorized n-gram hashing pass and one gather from the matrix."""
+
+    def __init__(
+        self, path: pathlib.Path, use_float32: bool = True, verify: bool = True
+    ):
+        self.path = pathlib.Path(path)
+        # lexvec only reads the header (dimensions and vocabulary) and the few
+        # vectors verify compares, and is closed right after
+        model = lexvec.Model(str(self.path))
+        try:
+            self._dim = model._dim
+            self._vocab = model._vocab
+            self._vocab_size = model._vocab_size
+            self._buckets = model._buckets
+            self._minn = model._minn
+            self._maxn = model._maxn
+            self.float32 = use_float32 and float32_path(self.path).exists()
+            if self.float32:
+                self.matrix = np.load(float32_path(self.path), mmap_mode="r")
+            else:
+                self.matrix = np.memmap(
+                    self.path,
+                    dtype=np.float64,
+                    mode="r",
+                    offset=model._matrix_base_offset,
+                    shape=(self._vocab_size + self._buckets, self._dim),
+                )
+            if verify:
+                self.verify(model)
+        finally:
+            close_model(model)
+
+    def subwords(self, w: str) -> tp.List[str]:
+        w = "<" + w + ">"
+        return [
+            w[i : i + n]
+            for n in range(self._minn, self._maxn + 1)
+            for i in range(len(w) - n + 1)
+        ]
+
+    def rows(self, tokens: tp.List[str]) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """Matrix rows averaged into each token's vector, as a flat index array
+        and the number of rows belonging to each token."""
+        in_vocab = np.array([token in self._vocab for token in tokens], dtype=bool)
+        subwords = [self.subwords(token) if self._buckets else [] for token in tokens]
+        counts = in_vocab + np.array([len(sws) for sws in subwords], dtype=np.int64)
+        ngrams = [sw.encode("utf-8") for sws in subwords for sw in sws]
+        buckets = fnv1a(ngrams) % max(self._buckets, 1)
+        # each token's word row (if in vocabulary) comes first, then its subwords
+        starts = np.cumsum(counts) - counts
+        is_word = np.zeros(counts.sum(), dtype=bool)
+        is_word[starts[in_vocab]] = True
+        flat = np.empty(counts.sum(), dtype=np.int64)
+        flat[is_word] = [self._vocab[t] for t, v in zip(tokens, in_vocab) if v]
+        flat[~is_word] = self._vocab_size + buckets.astype(np.int64)
+        return flat, counts
+
+    def word_reps(self, tokens: tp.List[str]) -> np.ndarray:
+        reps = np.zeros((len(tokens), self._dim))
+        flat, counts = self.rows(tokens)
+        if not len(flat):
+            return reps
+        # gather in row order so that reads through the mapping are sequential
+        order = np.argsort(flat, kind="stable")
+        vectors = np.empty((len(flat), self._dim))
+        vectors[order] = self.matrix[flat[order]]
+        nonempty = counts > 0
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        reps[nonempty] = np.add.reduceat(vectors, starts, axis=0)
+        reps[nonempty] /= counts[nonempty, None]
+        return reps
+
+    def word_rep(self, w: str) -> np.ndarray:
+        return self.word_reps([w])[0]
+
+    def verify(self, model, n_words: int = 5):
+        # the subword scheme is reimplemented here, so check it against lexvec
+        words = list(self._vocab)[:n_words] + ["cosearcherzz", "ünïcode"]
+        tol = 1e-5 if self.float32 else 1e-12
+        for word in words:
+            expected = model.word_rep(word)
+            if not np.allclose(self.word_rep(word), expected, rtol=tol, atol=tol):
+                raise ValueError(
+                    "memory-mapped vectors disagree with lexvec for %r" % word
+                )
+
+
+def close_model(model):
+    # lexvec.Model keeps its file open to read vectors one at a time
+    for value in vars(model).values():
+        if isinstance(value, io.IOBase):
+            value.close()
+
+
+def load(path: pathlib.Path, use_float32: bool = True) -> MMapModel:
+    key = (pathlib.Path(path).resolve(), use_float32)
+    if key not in _models:
+        _models[key] = MMapModel(path, use_float32=use_float32)
+    return _models[key]
+
+
+def convert_float32(path: pathlib.Path, chunk_rows: int = 1 << 16) -> pathlib.Path:
+    model = MMapModel(path, use_float32=False, verify=False)
+    out = float32_path(path)
+    tmp = out.with_name(out.name + ".tmp")
+    matrix = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=np.float32, shape=model.matrix.shape
+    )
+    for start in range(0, len(matrix), chunk_rows):
+        matrix[start : start + chunk_rows] = model.matrix[start : start + chunk_rows]
+    matrix.flush()
+    del matrix
+    tmp.rename(out)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        type=pathlib.Path,
+        default="data/embeddings/lexvec.commoncrawl.ngramsubwords.300d.W.pos.bin",
+    )
+    args = parser.parse_args()
+    print(convert_float32(args.model))
@@ -11,11 +11,14 @@
 
 import argparse
 import numpy as np
+import os
 import pathlib
 import random
 import json
 import sys
+import typing as tp
 
+import aggregation
 import clarify
 import qulac
 import facet_retrieval
@@ -27,14 +30,49 @@ import informative_no_extraction
 import yes_no_detection
 import match
 import ir
+import profiling
+import utils
 import thirdparty.ql as ql
 
-if __name__ == "__main__":
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("--qrel", default="data/faceted.qrel")
+    parser.add_argument("--ql-data-root", type=str, default="data/ql/")
+    parser.add_argument(
+        "--ql-index", type=str, default="pickle", choices=["pickle", "mmap"]
+    )
+    parser.add_argument(
+        "--ql-index-path", type=pathlib.Path, default="data/ql/topic_indexes_npy"
+    )
+    parser.add_argument("--ql-index-cache-mb", type=float, default=4096)
+    parser.add_argument(
+        "--metric-calculator",
+        type=str,
+        default="native",
+        choices=["native", "trectools"],
+    )
     parser.add_argument("--dataset", type=pathlib.Path, default="data/qulac.test.json")
+    parser.add_argument("--dataset-snapshot", action="store_true")
+    parser.add_argument("--dataset-stream", action="store_true")
     parser.add_argument("--seed", type=int)
     parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument(
+        "--simulation", type=str, default="sample", choices=["sample", "exact"]
+    )
+    parser.add_argument("--max-tree-nodes", type=int, default=100000)
+    parser.add_argument("--batch-epochs", action="store_true")
+    parser.add_argument(
+        "--output-format", type=str, default="json", choices=["json", "jsonl"]
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--median", type=str, default="exact", choices=aggregation.MEDIANS
+    )
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile-memory", action="store_true")
+    parser.add_argument("--precompute-metrics", action="store_true")
+    parser.add_argument("--metric-table", type=pathlib.Path)
 
     # facet provider
     parser.add_argument(
@@ -43,6 +81,9 @@ if __name__ == "__main__":
     parser.add_argument("--bing-key", type=str)
     parser.add_argument("--bing-endpoint", type=str, default="api.bing.microsoft.com")
     parser.add_argument("--bing-sleep", type=float, default=3)
+    parser.add_argument("--bing-async", action="store_true")
+    parser.add_argument("--bing-concurrency", type=int, default=8)
+    parser.add_argument("--bing-burst", type=int, default=1)
     parser.add_argument(
         "--bing-cache", type=pathlib.Path, default="data/bing_cache.json"
     )
@@ -84,22 +125,199 @@ if __name__ == "__main__":
         choices=["constant", "inc", "dec"],
     )
     parser.add_argument("--threshold-user", type=float, default=0.5)
+    parser.add_argument("--transformer-batch-size", type=int, default=32)
+    parser.add_argument("--onnx-int8", action="store_true")
+    parser.add_argument("--onnx-intra-op-threads", type=int, default=0)
+    parser.add_argument("--onnx-inter-op-threads", type=int, default=0)
+    parser.add_argument("--rerank-path", type=pathlib.Path)
+    parser.add_argument("--rerank-top", type=int, default=5)
+    parser.add_argument("--similarity-cache", type=pathlib.Path)
+    parser.add_argument("--similarity-cache-size", type=int, default=5000000)
     parser.add_argument("--patience", type=int, default=3)
     parser.add_argument("--cooperativeness", type=float, default=1)
-    args = parser.parse_args()
+    return parser
 
-    if args.seed is not None:
-        random.seed(args.seed)
-        np.random.seed(args.seed)
 
-    dataset = qulac.Qulac(args.dataset.open())
+def load_matcher(args: argparse.Namespace, which: str) -> match.SentenceMatcher:
+    which_matcher = vars(args)["matcher_%s" % which]
+    which_matcher_path = vars(args)["matcher_path_%s" % which]
+    matcher_kwargs = {}
+    if which_matcher == "random":
+        matcher_kwargs["seed"] = args.seed
+    if which_matcher in ["transformer", "transformer-onnx", "bi-encoder"]:
+        matcher_kwargs["batch_size"] = args.transformer_batch_size
+    if which_matcher == "transformer-onnx":
+        matcher_kwargs["int8"] = args.onnx_int8
+        matcher_kwargs["intra_op_threads"] = args.onnx_intra_op_threads
+        matcher_kwargs["inter_op_threads"] = args.onnx_inter_op_threads
+    return match.MATCHERS[which_matcher](which_matcher_path, **matcher_kwargs)
+
+
+def load_ir_system(args: argparse.Namespace) -> ir.InformationRetriever:
+    # QL builds its paths by appending to the data root
+    ql_data_root = os.path.join(args.ql_data_root, "")
+    if args.ql_index == "mmap":
+        return ir.MMapQLInformationRetriever(
+            ql.QL.QL(True, True, ql_data_root),
+            args.ql_index_path,
+            cache_mb=args.ql_index_cache_mb,
+        )
+    return ir.QLInformationRetriever(
+        ql.QL.QL(True, True, ql_data_root), cache_mb=args.ql_index_cache_mb
+    )
+
+
+def load_resources(args: argparse.Namespace, cache_metrics: bool = False) -> tp.Dict:
+    """Everything that is expensive to load and does not depend on the simulated
+    user or the facet ranker's parameters, so that it can be shared by runs."""
+    profile = profiling.Profile(enabled=args.profile, memory=args.profile_memory)
+    profile.begin_stage("load")
+    dataset = qulac.Qulac.load(
+        args.dataset, snapshot=args.dataset_snapshot, stream=args.dataset_stream
+    )
+
+    similarity_cache = None
+    if args.similarity_cache is not None:
+        similarity_cache = match.SqliteSimilarityCache(
+            args.similarity_cache, max_entries=args.similarity_cache_size
+        )
 
     matcher = {}
     for which in ["user", "clarify"]:
-        which_matcher = vars(args)["matcher_%s" % which]
-        which_matcher_path = vars(args)["matcher_path_%s" % which]
-        this_matcher = match.MATCHERS[which_matcher](which_matcher_path)
-        matcher[which] = match.CachingSentenceMatcher(this_matcher)
+        matcher[which] = match.CachingSentenceMatcher(
+            load_matcher(args, which), similarity_cache
+        )
+    if args.rerank_path is not None:
+        matcher["rerank"] = match.CachingSentenceMatcher(
+            match.TransformerSentenceMatcher(
+                args.rerank_path, batch_size=args.transformer_batch_size
+            ),
+            similarity_cache,
+        )
+
+    bing_retriever_cls = facet_retrieval.BingFacetRetriever
+    bing_kwargs = {}
+    if args.bing_async:
+        bing_retriever_cls = facet_retrieval.AsyncBingFacetRetriever
+        bing_kwargs = {"concurrency": args.bing_concurrency, "burst": args.bing_burst}
+    facet_retriever = {
+        "qulac": lambda: facet_retrieval.QulacFacetRetriever(dataset),
+        "bing": lambda: bing_retriever_cls(
+            args.bing_key,
+            args.bing_cache,
+            max_depth=1,
+            chars=[],
+            bing_sleep=args.bing_sleep,
+            endpoint=args.bing_endpoint,
+            **bing_kwargs,
+        ),
+        "graph-bing": lambda: bing_retriever_cls(
+            args.bing_key,
+            args.bing_cache,
+            max_depth=1,
+            bing_sleep=args.bing_sleep,
+            endpoint=args.bing_endpoint,
+            **bing_kwargs,
+        ),
+    }[args.facet]()
+    if args.bing_async and args.facet != "qulac":
+        facet_retriever.prefetch(dataset.topics)
+    if args.enhanced_rep:
+        facet_retriever = facet_retrieval.EnhancedFacetsFacetRetriever(
+            args.enhanced_rep_path, facet_retriever
+        )
+
+    ir_system = load_ir_system(args)
+    ir_metric_calculator = {
+        "native": ir.NativeMetricCalculator,
+        "trectools": ir.TrecToolsMetricCalculator,
+    }[args.metric_calculator](args.qrel)
+    if args.precompute_metrics or cache_metrics:
+        ir_metric_calculator = ir.PrecomputedMetricCalculator(ir_metric_calculator)
+    if args.precompute_metrics:
+        # the facet source decides which facet descriptions are final queries
+        facet_source = args.facet
+        if args.enhanced_rep:
+            facet_source += "+" + utils.file_digest([args.enhanced_rep_path])
+        metric_table_signature = "%s:%s:%s:%s:%s:%s" % (
+            utils.file_digest([args.qrel]),
+            args.metric_calculator,
+            type(ir_system).__name__,
+            facet_source,
+            # the indexes the rankings come from
+            os.path.abspath(args.ql_data_root),
+            os.path.abspath(args.ql_index_path),
+        )
+        if args.metric_table is not None and args.metric_table.exists():
+            ir_metric_calculator.load(args.metric_table, metric_table_signature)
+        if ir_metric_calculator.precompute(
+            ir_system, dataset.topics, facet_retriever, workers=args.workers
+        ):
+            if args.metric_table is not None:
+                ir_metric_calculator.save(args.metric_table, metric_table_signature)
+
+    profile.end_stage()
+    return {
+        "dataset": dataset,
+        "matcher": matcher,
+        "facet_retriever": facet_retriever,
+        "ir_system": ir_system,
+        "ir_metric_calculator": ir_metric_calculator,
+        "profile": profile,
+    }
+
+
+def profiled_components(resources: tp.Dict) -> tp.Dict:
+    """The shared components wrapped to time every call, with the counters of
+    their caches registered in the profile."""
+    profile = resources["profile"]
+    matcher = {}
+    for which, caching_matcher in resources["matcher"].items():
+        name = "matcher.%s" % which
+        matcher[which] = match.ProfiledSentenceMatcher(caching_matcher, profile, name)
+        profile.add_cache(name, caching_matcher.stats)
+        profile.add_counters(
+            name, caching_matcher, ["hits", "persistent_hits", "misses"]
+        )
+        if isinstance(caching_matcher.matcher, match.BOVSentenceMatcher):
+            profile.add_cache(
+                name + ".word_rep", caching_matcher.matcher.word_rep_stats
+            )
+            # only lexvec's cached word_rep is counted
+            if caching_matcher.matcher.word_rep_stats() is not None:
+                profile.add_counters(
+                    name + ".word_rep",
+                    caching_matcher.matcher,
+                    ["word_rep_hits", "word_rep_misses"],
+                )
+    facet_retriever = resources["facet_retriever"]
+    # suggestions are cached by the Bing retrievers, possibly under enhanced reps
+    bing_cache = getattr(
+        getattr(facet_retriever, "facet_retriever", facet_retriever), "cache", None
+    )
+    if isinstance(bing_cache, facet_retrieval.BingSuggestionCache):
+        profile.add_cache("bing", bing_cache.stats)
+        profile.add_counters("bing", bing_cache, ["hits", "misses"])
+    return {
+        "matcher": matcher,
+        "facet_retriever": facet_retrieval.ProfiledFacetRetriever(
+            facet_retriever, profile, "facet_retriever"
+        ),
+        "ir_system": ir.ProfiledInformationRetriever(
+            resources["ir_system"], profile, "ir_system"
+        ),
+        "ir_metric_calculator": ir.ProfiledMetricCalculator(
+            resources["ir_metric_calculator"], profile, "ir_metric_calculator"
+        ),
+    }
+
+
+def build_clarify(args: argparse.Namespace, resources: tp.Dict) -> clarify.Clarify:
+    profile = resources["profile"]
+    components = resources
+    if profile.enabled:
+        components = profiled_components(resources)
+    matcher = components["matcher"]
 
     # user simulator
     cooperativeness_fn = user_simulator.cooperativeness_fn(
@@ -123,52 +341,45 @@ if __name__ == "__main__":
     informative_no_extractor = informative_no_extraction.DummyInformativeNoExtractor()
     if args.facet_ranker == "similarity":
         facet_ranker = facet_ranking.SimilarityFacetRanker(
-            matcher["clarify"], alpha=args.facet_ranker_alpha
+            matcher["clarify"],
+            alpha=args.facet_ranker_alpha,
+            reranker=matcher.get("rerank"),
+            rerank_top=args.rerank_top,
         )
     elif args.facet_ranker == "random":
         facet_ranker = facet_ranking.RandomFacetRanker()
     else:
         raise Exception("invalid ranker")
-
-    facet_retriever = {
-        "qulac": lambda: facet_retrieval.QulacFacetRetriever(dataset),
-        "bing": lambda: facet_retrieval.BingFacetRetriever(
-            args.bing_key,
-            args.bing_cache,
-            max_depth=1,
-            chars=[],
-            bing_sleep=args.bing_sleep,
-            endpoint=args.bing_endpoint,
-        ),
-        "graph-bing": lambda: facet_retrieval.BingFacetRetriever(
-            args.bing_key,
-            args.bing_cache,
-            max_depth=1,
-            bing_sleep=args.bing_sleep,
-            endpoint=args.bing_endpoint,
-        ),
-    }[args.facet]()
-    if args.enhanced_rep:
-        facet_retriever = facet_retrieval.EnhancedFacetsFacetRetriever(
-            args.enhanced_rep_path, facet_retriever
+    if profile.enabled:
+        facet_ranker = facet_ranking.ProfiledFacetRanker(
+            facet_ranker, profile, "facet_ranker"
         )
 
-    ir_system = ir.QLInformationRetriever(ql.QL.QL(True, True, "data/ql/"))
-    ir_metric_calculator = ir.TrecToolsMetricCalculator(args.qrel)
-
     clarif = clarify.Clarify(
         question_generator=question_generator,
         user_simulator=user_sim,
         yes_no_detector=yes_no_detector,
         informative_no_extractor=informative_no_extractor,
         facet_ranker=facet_ranker,
-        facet_retriever=facet_retriever,
-        ir_system=ir_system,
-        ir_metric_calculator=ir_metric_calculator,
+        facet_retriever=components["facet_retriever"],
+        ir_system=components["ir_system"],
+        ir_metric_calculator=components["ir_metric_calculator"],
         cooperativeness_fn=cooperativeness_fn,
+        max_tree_nodes=args.max_tree_nodes,
+        profile=profile if profile.enabled else None,
     )
 
-    json_out = clarif.run(args.epochs, dataset.topics)
+    return clarif
+
+
+def run(
+    args: argparse.Namespace,
+    resources: tp.Dict,
+    clarif: clarify.Clarify,
+    out: tp.TextIO,
+) -> tp.Dict:
+    ir_system = resources["ir_system"]
+    ir_metric_calculator = resources["ir_metric_calculator"]
 
     def dumper(obj):
         try:
@@ -176,5 +387,45 @@ if __name__ == "__main__":
         except AttributeError:
             return str(obj)
 
+    writer = None
+    if args.output_format == "jsonl":
+
+        def writer(record):
+            out.write(json.dumps(record, default=dumper) + "\n")
+
+    profile = resources["profile"]
+    with profile.stage("simulation"):
+        json_out = clarif.run(
+            args.epochs,
+            resources["dataset"].topics,
+            workers=args.workers,
+            seed=args.seed,
+            writer=writer,
+            median=args.median,
+            exact=args.simulation == "exact",
+            batched=args.batch_epochs,
+        )
+    if profile.enabled:
+        json_out["profile"] = profile.result()
+
+    if isinstance(ir_metric_calculator, ir.PrecomputedMetricCalculator):
+        json_out["metric_table"] = ir_metric_calculator.stats()
+    json_out["ql_index_cache"] = ir_system.indexes.stats()
     json_out["args"] = vars(args)
-    json.dump(json_out, sys.stdout, default=dumper, indent=4)
+    if writer is not None:
+        # aggregate metrics and run information come last
+        writer({"type": "summary", **json_out})
+    else:
+        json.dump(json_out, out, default=dumper, indent=4)
+    return json_out
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    resources = load_resources(args)
+    run(args, resources, build_clarify(args, resources), sys.stdout)
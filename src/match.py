@@ -10,19 +10,35 @@
 #  and limitations under the License.
 
 import numpy as np
+import os
 import torch
 import pathlib
 import sys
 import scipy
 import random
+import sqlite3
+import time
+import typing as tp
+import weakref
+import zlib
 from abc import ABC, abstractmethod
 
 import utils
+import lexvec_mmap
+import profiling
+import transformer_onnx
 from thirdparty import lexvec
 import transformers
 
 
 class SentenceMatcher(ABC):
+    # whether scoring a pair costs enough to be worth caching per pair; matchers
+    # that cache per-sentence embeddings instead score matrices directly
+    cache_pairs = True
+    # whether similarity_matrix reads pairs from a cache that similarity_batch
+    # fills, so that scoring pairs ahead of time saves work later
+    pair_cache = False
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -30,73 +46,594 @@ class SentenceMatcher(ABC):
     def similarity(self, sent1: str, sent2: str) -> float:
         pass
 
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        return [self.similarity(sent1, sent2) for sent1, sent2 in pairs]
+
+    def similarity_matrix(
+        self, sents1: tp.List[str], sents2: tp.List[str]
+    ) -> np.ndarray:
+        pairs = [(sent1, sent2) for sent1 in sents1 for sent2 in sents2]
+        similarities = np.array(self.similarity_batch(pairs), dtype=float)
+        return similarities.reshape(len(sents1), len(sents2))
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # identifies the model behind this matcher so that its scores can be
+        # shared across runs; None means scores must not be persisted
+        return None
+
 
 class RandomSentenceMatcher(SentenceMatcher):
+    def __init__(
+        self, path: tp.Optional[pathlib.Path] = None, seed: tp.Optional[int] = None
+    ):
+        # with a seed, each pair's score is derived from the pair itself, so it
+        # does not depend on which pairs were scored (or cached) before
+        self.seed = seed
+
     def similarity(self, sent1: str, sent2: str) -> float:
-        return random.random()
+        if self.seed is None:
+            return random.random()
+        return utils.derive_seed(self.seed, sent1, sent2) / 2**32
 
 
 class BOVSentenceMatcher(SentenceMatcher):
+    cache_pairs = False
+
     def __init__(self, lexvec_path: pathlib.Path):
+        self.lexvec_path = pathlib.Path(lexvec_path)
         self.lexvec = lexvec.Model(lexvec_path)
+        # unit-norm (or all-zero) sentence embeddings
+        self.embeddings = {}  # type: tp.Dict[str, np.ndarray]
+        # lookups in lexvec's own word_rep cache, counted per process (a profile
+        # merges in those of forked workers)
+        self.word_rep_hits = 0
+        self.word_rep_misses = 0
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # vector files are gigabytes, so they are not hashed whole
+        return "bov:%s:%s" % (self.lexvec_path, utils.file_stamp(self.lexvec_path))
 
     def similarity(self, sent1: str, sent2: str) -> float:
-        rep1 = self.encode(sent1)
-        rep2 = self.encode(sent2)
-        norm = np.linalg.norm(rep1) * np.linalg.norm(rep2)
-        if norm == 0:
+        rep1 = self.embed(sent1)
+        rep2 = self.embed(sent2)
+        if not rep1.any() or not rep2.any():
             return 0
-        sim = (1 + np.dot(rep1, rep2) / norm) / 2
-        return sim
+        return (1 + np.dot(rep1, rep2)) / 2
+
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        if not pairs:
+            return []
+        reps1 = self.embed_many([sent1 for sent1, _ in pairs])
+        reps2 = self.embed_many([sent2 for _, sent2 in pairs])
+        similarities = self._rescale(np.einsum("ij,ij->i", reps1, reps2), reps1, reps2)
+        return similarities.tolist()
+
+    def similarity_matrix(
+        self, sents1: tp.List[str], sents2: tp.List[str]
+    ) -> np.ndarray:
+        reps1 = self.embed_many(sents1)
+        reps2 = self.embed_many(sents2)
+        cosines = reps1 @ reps2.T
+        return self._rescale(cosines, reps1[:, None, :], reps2[None, :, :])
+
+    def _rescale(
+        self, cosines: np.ndarray, reps1: np.ndarray, reps2: np.ndarray
+    ) -> np.ndarray:
+        # map cosine to [0, 1]; empty sentences (zero vectors) score 0
+        nonzero = reps1.any(axis=-1) & reps2.any(axis=-1)
+        return np.where(nonzero, (1 + cosines) / 2, 0.0)
+
+    def embed(self, sent: str) -> np.ndarray:
+        if sent not in self.embeddings:
+            rep = self.encode(sent)
+            norm = np.linalg.norm(rep)
+            self.embeddings[sent] = rep / norm if norm else np.zeros(self.lexvec._dim)
+        return self.embeddings[sent]
+
+    def embed_many(self, sents: tp.List[str]) -> np.ndarray:
+        if not sents:
+            return np.zeros((0, self.lexvec._dim))
+        return np.stack([self.embed(sent) for sent in sents])
 
     def encode(self, sent: str) -> np.ndarray:
         tokens = utils.strip_punctuation(sent).lower().split()
         weights = np.ones(len(tokens))
         if weights.sum():
             weights /= weights.sum()
+        cache_info = getattr(self.lexvec.word_rep, "cache_info", None)
+        before = cache_info() if cache_info is not None else None
         vectors = [
             weight * self.lexvec.word_rep(word) for word, weight in zip(tokens, weights)
         ]
+        if before is not None:
+            after = cache_info()
+            self.word_rep_hits += after.hits - before.hits
+            self.word_rep_misses += after.misses - before.misses
         return np.sum(vectors, axis=0)
 
+    def word_rep_stats(self) -> tp.Optional[tp.Dict[str, float]]:
+        # None unless word vectors come from lexvec's cached word_rep
+        if not hasattr(self.lexvec.word_rep, "cache_info"):
+            return None
+        return utils.hit_stats(self.word_rep_hits, self.word_rep_misses)
+
+
+class MMapBOVSentenceMatcher(BOVSentenceMatcher):
+    def __init__(self, lexvec_path: pathlib.Path):
+        self.lexvec_path = pathlib.Path(lexvec_path)
+        self.lexvec = lexvec_mmap.load(lexvec_path)
+        self.embeddings = {}  # type: tp.Dict[str, np.ndarray]
+
+    def fingerprint(self) -> tp.Optional[str]:
+        fingerprint = super().fingerprint()
+        return fingerprint + ":f32" if self.lexvec.float32 else fingerprint
+
+    def encode(self, sent: str) -> np.ndarray:
+        tokens = utils.strip_punctuation(sent).lower().split()
+        if not tokens:
+            return np.zeros(self.lexvec._dim)
+        return self.lexvec.word_reps(tokens).mean(axis=0)
+
+
+class HashedWordVectors:
+    """Pseudo-random word vectors seeded by a hash of each word, with the part
+    of the lexvec.Model interface BOVSentenceMatcher uses."""
+
+    def __init__(self, dim: int = 300):
+        self._dim = dim
+        self.vectors = {}  # type: tp.Dict[str, np.ndarray]
+
+    def word_rep(self, word: str) -> np.ndarray:
+        if word not in self.vectors:
+            rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")))
+            self.vectors[word] = rng.standard_normal(self._dim)
+        return self.vectors[word]
+
+
+class HashedBOVSentenceMatcher(BOVSentenceMatcher):
+    """Bag of vectors over HashedWordVectors: sentences sharing words are
+    similar, which is enough for benchmarks and synthetic data, and no model
+    has to be loaded."""
+
+    def __init__(self, path: tp.Optional[pathlib.Path] = None, dim: int = 300):
+        self.lexvec = HashedWordVectors(dim)
+        self.embeddings = {}  # type: tp.Dict[str, np.ndarray]
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return "hashed-bov:%d" % self.lexvec._dim
+
+
+def length_buckets(lengths: tp.List[int], batch_size: int) -> tp.List[tp.List[int]]:
+    """Indices of inputs grouped into batches of equal length, so that nothing is
+    padded and each score is independent of the inputs it is batched with."""
+    by_length = {}  # type: tp.Dict[int, tp.List[int]]
+    for i, length in enumerate(lengths):
+        by_length.setdefault(length, []).append(i)
+    buckets = []
+    for length in sorted(by_length):
+        indices = by_length[length]
+        for start in range(0, len(indices), batch_size):
+            buckets.append(indices[start : start + batch_size])
+    return buckets
+
 
 class TransformerSentenceMatcher(SentenceMatcher):
-    def __init__(self, transformer_path):
+    def __init__(self, transformer_path, batch_size: int = 32):
+        assert batch_size > 0
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model = transformers.AutoModelForSequenceClassification.from_pretrained(
             transformer_path
         )
         self.model.to(self.device)
+        self.model.eval()
         self.tokenizer = transformers.AutoTokenizer.from_pretrained(transformer_path)
+        self.transformer_path = pathlib.Path(transformer_path)
+        self.batch_size = batch_size
+        self._weights_digest = None  # type: tp.Optional[str]
+
+    def weights_digest(self) -> str:
+        if self._weights_digest is None:
+            weights = [
+                path
+                for pattern in ["*.bin", "*.safetensors", "config.json"]
+                for path in self.transformer_path.glob(pattern)
+            ]
+            self._weights_digest = utils.file_digest(weights)
+        return self._weights_digest
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return "transformer:%s:%s" % (self.transformer_path, self.weights_digest())
 
     def similarity(self, sent1: str, sent2: str) -> float:
-        inputs = self.tokenizer(
-            sent1, sent2, padding=False, truncation=True, return_tensors="pt"
-        ).to(self.device)
+        return self.similarity_batch([(sent1, sent2)])[0]
+
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        if not pairs:
+            return []
+        encodings = self.tokenizer(
+            [sent1 for sent1, _ in pairs],
+            [sent2 for _, sent2 in pairs],
+            padding=False,
+            truncation=True,
+        )
+        features = [
+            {k: encodings[k][i] for k in encodings.keys()} for i in range(len(pairs))
+        ]
+        lengths = [len(feature["input_ids"]) for feature in features]
+        scores = [0.0] * len(pairs)
+        for bucket in length_buckets(lengths, self.batch_size):
+            preds = self.predict([features[i] for i in bucket])
+            for i, pred in zip(bucket, preds):
+                scores[i] = float(pred)
+        return scores
+
+    def predict(self, features: tp.List[tp.Dict[str, tp.List[int]]]) -> np.ndarray:
+        inputs = self.tokenizer.pad(features, padding=True, return_tensors="pt").to(
+            self.device
+        )
         with torch.no_grad():
             outputs = self.model(**inputs)
             preds = outputs.logits.detach().cpu().numpy()
             preds = preds[:, 1]
-            preds = scipy.special.expit(preds)
-        return float(preds.squeeze())
+            return scipy.special.expit(preds)
+
+
+class ONNXTransformerSentenceMatcher(TransformerSentenceMatcher):
+    """TransformerSentenceMatcher on CPU through ONNX Runtime. The classifier is
+    exported once to an onnx/ directory next to its weights and, with int8, its
+    weights are quantized to int8 as well. Sessions are opened per process, as
+    ONNX Runtime's thread pools do not survive a fork: an open session is closed
+    before every fork, or the child can deadlock opening its own."""
+
+    _instances = weakref.WeakSet()  # type: weakref.WeakSet
+
+    def __init__(
+        self,
+        transformer_path,
+        batch_size: int = 32,
+        int8: bool = False,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+    ):
+        assert batch_size > 0
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(transformer_path)
+        self.transformer_path = pathlib.Path(transformer_path)
+        self.batch_size = batch_size
+        self._weights_digest = None
+        self.int8 = int8
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.onnx_path = transformer_onnx.ensure_exported(
+            self.transformer_path, self.weights_digest(), int8=int8
+        )
+        self.session = None
+        self.pid = None
+        ONNXTransformerSentenceMatcher._instances.add(self)
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # scores differ slightly from the PyTorch model's, so they are not shared
+        return "transformer-onnx:%s:%s:%s" % (
+            self.transformer_path,
+            self.weights_digest(),
+            "int8" if self.int8 else "fp32",
+        )
+
+    def _session(self):
+        if self.pid != os.getpid():
+            self.session = transformer_onnx.load_session(
+                self.onnx_path, self.intra_op_threads, self.inter_op_threads
+            )
+            self.pid = os.getpid()
+        return self.session
+
+    def close(self):
+        # reopened on the next predict
+        self.session = None
+        self.pid = None
+
+    @classmethod
+    def close_all(cls):
+        for matcher in list(cls._instances):
+            matcher.close()
+
+    def predict(self, features: tp.List[tp.Dict[str, tp.List[int]]]) -> np.ndarray:
+        session = self._session()
+        inputs = self.tokenizer.pad(features, padding=True, return_tensors="np")
+        feed = {
+            node.name: inputs[node.name].astype(np.int64)
+            for node in session.get_inputs()
+        }
+        logits = session.run(["logits"], feed)[0]
+        return scipy.special.expit(logits[:, 1])
+
+
+os.register_at_fork(before=ONNXTransformerSentenceMatcher.close_all)
+
+
+class BiEncoderSentenceMatcher(TransformerSentenceMatcher):
+    """Embeds each sentence once with a transformer encoder (mean-pooled and
+    normalized) and scores pairs by cosine similarity mapped to [0, 1], so that
+    N facets against M context items cost N + M encodings rather than N * M
+    cross-encoder passes."""
+
+    cache_pairs = False
+
+    def __init__(
+        self,
+        transformer_path,
+        batch_size: int = 32,
+    ):
+        assert batch_size > 0
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = transformers.AutoModel.from_pretrained(transformer_path)
+        self.model.to(self.device)
+        self.model.eval()
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(transformer_path)
+        self.transformer_path = pathlib.Path(transformer_path)
+        self.batch_size = batch_size
+        self._weights_digest = None
+        # unit-norm sentence embeddings
+        self.embeddings = {}  # type: tp.Dict[str, np.ndarray]
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return "bi-encoder:%s:%s" % (self.transformer_path, self.weights_digest())
+
+    def similarity(self, sent1: str, sent2: str) -> float:
+        return self.similarity_batch([(sent1, sent2)])[0]
+
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        if not pairs:
+            return []
+        reps1 = self.embed_many([sent1 for sent1, _ in pairs])
+        reps2 = self.embed_many([sent2 for _, sent2 in pairs])
+        return ((1 + np.einsum("ij,ij->i", reps1, reps2)) / 2).tolist()
+
+    def similarity_matrix(
+        self, sents1: tp.List[str], sents2: tp.List[str]
+    ) -> np.ndarray:
+        reps1 = self.embed_many(sents1)
+        reps2 = self.embed_many(sents2)
+        return (1 + reps1 @ reps2.T) / 2
+
+    def embed_many(self, sents: tp.List[str]) -> np.ndarray:
+        missing = [sent for sent in dict.fromkeys(sents) if sent not in self.embeddings]
+        if missing:
+            self.embeddings.update(zip(missing, self.encode(missing)))
+        if not sents:
+            return np.zeros((0, self.model.config.hidden_size))
+        return np.stack([self.embeddings[sent] for sent in sents])
+
+    def encode(self, sents: tp.List[str]) -> np.ndarray:
+        features = self.tokenizer(sents, padding=False, truncation=True)
+        lengths = [len(ids) for ids in features["input_ids"]]
+        reps = np.zeros((len(sents), self.model.config.hidden_size))
+        for bucket in length_buckets(lengths, self.batch_size):
+            inputs = self.tokenizer.pad(
+                [{k: features[k][i] for k in features.keys()} for i in bucket],
+                padding=True,
+                return_tensors="pt",
+            ).to(self.device)
+            with torch.no_grad():
+                hidden = self.model(**inputs)[0]
+                mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+                reps[bucket] = pooled.cpu().numpy()
+        norms = np.linalg.norm(reps, axis=1, keepdims=True)
+        return reps / np.where(norms > 0, norms, 1)
+
+
+class SqliteSimilarityCache:
+    """Similarity scores persisted across runs, bounded to max_entries rows with
+    least-recently-used eviction. Rows are keyed by matcher fingerprint so that
+    scores from different models never mix."""
+
+    # pairs (or rows) per statement, within SQLite's default of 999 parameters
+    chunk_size = 400
+
+    def __init__(self, path: pathlib.Path, max_entries: int = 5000000):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.path = pathlib.Path(path)
+        self.conn = None  # type: tp.Optional[sqlite3.Connection]
+        self.pid = None  # type: tp.Optional[int]
+        self.size = self._count()
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork, so every process opens its own
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(str(self.path), timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS similarity ("
+                "matcher TEXT NOT NULL, sent1 TEXT NOT NULL, sent2 TEXT NOT NULL, "
+                "value REAL NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (matcher, sent1, sent2))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS similarity_last_used "
+                "ON similarity (last_used)"
+            )
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def _count(self) -> int:
+        conn = self._connection()
+        return conn.execute("SELECT COUNT(*) FROM similarity").fetchone()[0]
+
+    def get_many(
+        self, matcher: str, pairs: tp.List[tp.Tuple[str, str]]
+    ) -> tp.Dict[tp.Tuple[str, str], float]:
+        conn = self._connection()
+        found = {}
+        rowids = []
+        for chunk in self._chunks(pairs):
+            # a join, so that each pair is looked up in the primary key index
+            rows = conn.execute(
+                "SELECT s.rowid, s.sent1, s.sent2, s.value "
+                "FROM (VALUES %s) AS k JOIN similarity AS s "
+                "ON s.matcher = ? AND s.sent1 = k.column1 AND s.sent2 = k.column2"
+                % ", ".join(["(?, ?)"] * len(chunk)),
+                [sent for pair in chunk for sent in pair] + [matcher],
+            )
+            for rowid, sent1, sent2, value in rows:
+                found[(sent1, sent2)] = value
+                rowids.append(rowid)
+        if rowids:
+            now = time.time()
+            for chunk in self._chunks(rowids):
+                conn.execute(
+                    "UPDATE similarity SET last_used = ? WHERE rowid IN (%s)"
+                    % ", ".join(["?"] * len(chunk)),
+                    [now] + chunk,
+                )
+            conn.commit()
+        return found
+
+    def put_many(
+        self, matcher: str, items: tp.List[tp.Tuple[tp.Tuple[str, str], float]]
+    ):
+        conn = self._connection()
+        now = time.time()
+        rows = [(matcher, sent1, sent2, value, now) for (sent1, sent2), value in items]
+        # only rows that were not there yet add to the size
+        changes = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO similarity VALUES (?, ?, ?, ?, ?)", rows
+        )
+        inserted = conn.total_changes - changes
+        if inserted < len(rows):
+            conn.executemany(
+                "UPDATE similarity SET value = ?, last_used = ? "
+                "WHERE matcher = ? AND sent1 = ? AND sent2 = ?",
+                [row[3:] + row[:3] for row in rows],
+            )
+        self.size += inserted
+        if self.size > self.max_entries:
+            self.evict()
+        conn.commit()
+
+    def _chunks(self, items: tp.List) -> tp.Iterator[tp.List]:
+        for start in range(0, len(items), self.chunk_size):
+            yield items[start : start + self.chunk_size]
+
+    def evict(self):
+        # other processes may share the file, so recount before deleting
+        self.size = self._count()
+        excess = self.size - self.max_entries
+        if excess <= 0:
+            return
+        # evict some slack so that eviction does not run on every insert
+        excess += self.max_entries // 10
+        self._connection().execute(
+            "DELETE FROM similarity WHERE rowid IN "
+            "(SELECT rowid FROM similarity ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self.size = self._count()
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+        self.pid = None
 
 
 class CachingSentenceMatcher(SentenceMatcher):
-    def __init__(self, matcher):
+    def __init__(
+        self,
+        matcher: SentenceMatcher,
+        persistent_cache: tp.Optional[SqliteSimilarityCache] = None,
+    ):
         self.matcher = matcher
         self.cache = {}
+        self.persistent_cache = None
+        self.cache_pairs = matcher.cache_pairs
+        self.pair_cache = matcher.cache_pairs
+        # counted per process (a profile merges in those of forked workers)
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        if persistent_cache is not None:
+            self.matcher_fingerprint = matcher.fingerprint()
+            if self.matcher_fingerprint is not None:
+                self.persistent_cache = persistent_cache
 
     def similarity(self, sent1: str, sent2: str) -> float:
         key = (sent1, sent2)
         if key in self.cache:
+            self.hits += 1
             return self.cache[key]
-        value = self.matcher.similarity(sent1, sent2)
-        self.cache[key] = value
-        return value
+        return self.similarity_batch([key])[0]
+
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        misses = list(dict.fromkeys(key for key in pairs if key not in self.cache))
+        self.hits += len(pairs) - len(misses)
+        if misses and self.persistent_cache is not None:
+            found = self.persistent_cache.get_many(self.matcher_fingerprint, misses)
+            self.cache.update(found)
+            self.persistent_hits += len(found)
+            misses = [key for key in misses if key not in found]
+        if misses:
+            self.misses += len(misses)
+            values = self.matcher.similarity_batch(misses)
+            self.cache.update(zip(misses, values))
+            if self.persistent_cache is not None:
+                self.persistent_cache.put_many(
+                    self.matcher_fingerprint, list(zip(misses, values))
+                )
+        return [self.cache[key] for key in pairs]
+
+    def similarity_matrix(
+        self, sents1: tp.List[str], sents2: tp.List[str]
+    ) -> np.ndarray:
+        if self.cache_pairs:
+            return super().similarity_matrix(sents1, sents2)
+        return self.matcher.similarity_matrix(sents1, sents2)
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return self.matcher.fingerprint()
+
+    def stats(self) -> tp.Dict[str, float]:
+        stats = utils.hit_stats(self.hits + self.persistent_hits, self.misses)
+        stats["persistent_hits"] = self.persistent_hits
+        return stats
+
+
+class ProfiledSentenceMatcher(SentenceMatcher):
+    def __init__(self, matcher: SentenceMatcher, profile: profiling.Profile, name: str):
+        self.matcher = matcher
+        self.cache_pairs = matcher.cache_pairs
+        self.pair_cache = matcher.pair_cache
+        self.timings = {
+            method: profile.timing("%s.%s" % (name, method))
+            for method in ["similarity", "similarity_batch", "similarity_matrix"]
+        }
+
+    def similarity(self, sent1: str, sent2: str) -> float:
+        with self.timings["similarity"]:
+            return self.matcher.similarity(sent1, sent2)
+
+    def similarity_batch(self, pairs: tp.List[tp.Tuple[str, str]]) -> tp.List[float]:
+        with self.timings["similarity_batch"]:
+            return self.matcher.similarity_batch(pairs)
+
+    def similarity_matrix(
+        self, sents1: tp.List[str], sents2: tp.List[str]
+    ) -> np.ndarray:
+        with self.timings["similarity_matrix"]:
+            return self.matcher.similarity_matrix(sents1, sents2)
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return self.matcher.fingerprint()
 
 
 MATCHERS = {
     "transformer": TransformerSentenceMatcher,
+    "transformer-onnx": ONNXTransformerSentenceMatcher,
+    "bi-encoder": BiEncoderSentenceMatcher,
     "bov": BOVSentenceMatcher,
+    "bov-mmap": MMapBOVSentenceMatcher,
+    "hashed-bov": HashedBOVSentenceMatcher,
     "random": RandomSentenceMatcher,
 }
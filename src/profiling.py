@@ -0,0 +1,188 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import contextlib
+import copy
+import time
+import tracemalloc
+import typing as tp
+
+import aggregation
+
+
+class Timing:
+    """Call count, total time and a t-digest of the latencies of one method.
+    Used as a context manager around each call; not reentrant."""
+
+    def __init__(self):
+        self.start = 0.0
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.latencies = aggregation.TDigest()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.calls += 1
+        self.seconds += elapsed
+        self.latencies.add(elapsed)
+
+    def merge(self, other: "Timing"):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.latencies.merge(other.latencies)
+
+    def result(self) -> tp.Dict[str, float]:
+        out = {"calls": self.calls, "seconds": self.seconds}
+        if self.calls:
+            out["mean_ms"] = 1000 * self.seconds / self.calls
+            for q in [50, 90, 99]:
+                out["p%d_ms" % q] = 1000 * self.latencies.quantile(q / 100)
+        return out
+
+
+def _reset_peak() -> int:
+    # traced memory the stage starts from
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    # before Python 3.9, the peak can only be reset by forgetting all traces
+    tracemalloc.clear_traces()
+    return 0
+
+
+class Profile:
+    """Where the time of a run goes: latencies of the components wrapped by
+    build_clarify in main.py, counters of the caches they use and, with memory
+    set, the peak memory allocated by each stage as traced by tracemalloc.
+    Timings and cache counters are kept per process; those of forked workers
+    are drained back with their results and merged."""
+
+    def __init__(self, enabled: bool = True, memory: bool = False):
+        self.enabled = enabled or memory
+        self.memory = memory
+        self.timings = {}  # type: tp.Dict[str, Timing]
+        self.caches = {}  # type: tp.Dict[str, tp.Callable[[], tp.Optional[tp.Dict]]]
+        self.counters = {}  # type: tp.Dict[str, tp.Tuple[tp.Any, tp.List[str]]]
+        self.stages = {}  # type: tp.Dict[str, tp.Dict[str, float]]
+        self.stage_name = None  # type: tp.Optional[str]
+        self.stage_start = 0.0
+        self.memory_start = 0
+
+    def timing(self, name: str) -> Timing:
+        if name not in self.timings:
+            self.timings[name] = Timing()
+        return self.timings[name]
+
+    def add_cache(self, name: str, stats: tp.Callable[[], tp.Optional[tp.Dict]]):
+        self.caches[name] = stats
+
+    def add_counters(self, name: str, owner: tp.Any, attrs: tp.List[str]):
+        # integer attributes of owner that its stats are computed from
+        self.counters[name] = (owner, attrs)
+
+    def begin_stage(self, name: str):
+        if not self.enabled:
+            return
+        self.stage_name = name
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.memory_start = _reset_peak()
+        self.stage_start = time.perf_counter()
+
+    def end_stage(self):
+        if not self.enabled or self.stage_name is None:
+            return
+        stage = self.stages.setdefault(self.stage_name, {"seconds": 0.0})
+        stage["seconds"] += time.perf_counter() - self.stage_start
+        if self.memory:
+            self.record_peak(stage, "peak_mb")
+        self.stage_name = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self.begin_stage(name)
+        try:
+            yield
+        finally:
+            self.end_stage()
+
+    def record_peak(self, stage: tp.Dict[str, float], key: str):
+        peak = tracemalloc.get_traced_memory()[1] - self.memory_start
+        peak_mb = peak / 1024 / 1024
+        stage[key] = max(stage.get(key, 0.0), peak_mb)
+
+    def start_worker(self):
+        # a forked worker reports only what it does itself; timings are reset in
+        # place as the wrapped components hold on to them
+        for timing in self.timings.values():
+            timing.reset()
+        for owner, attrs in self.counters.values():
+            for attr in attrs:
+                setattr(owner, attr, 0)
+        if self.memory:
+            self.memory_start = _reset_peak()
+
+    def drain(self) -> tp.Dict:
+        """The timings and counts recorded since the last drain (and, when tracing
+        memory, the worker's peak so far within the current stage), for merge."""
+        drained = {"timings": {}, "counters": {}, "stages": {}}
+        for name, timing in self.timings.items():
+            if timing.calls:
+                drained["timings"][name] = copy.copy(timing)
+                timing.reset()
+        for name, (owner, attrs) in self.counters.items():
+            drained["counters"][name] = {attr: getattr(owner, attr) for attr in attrs}
+            for attr in attrs:
+                setattr(owner, attr, 0)
+        if self.memory and self.stage_name is not None:
+            drained["stages"][self.stage_name] = {}
+            self.record_peak(drained["stages"][self.stage_name], "worker_peak_mb")
+        return drained
+
+    def merge(self, drained: tp.Dict):
+        for name, timing in drained["timings"].items():
+            self.timing(name).merge(timing)
+        for name, counts in drained["counters"].items():
+            owner, _ = self.counters[name]
+            for attr, count in counts.items():
+                setattr(owner, attr, getattr(owner, attr) + count)
+        for name, values in drained["stages"].items():
+            stage = self.stages.setdefault(name, {"seconds": 0.0})
+            for key, value in values.items():
+                stage[key] = max(stage.get(key, 0.0), value)
+
+    def reset(self):
+        for timing in self.timings.values():
+            timing.reset()
+        for owner, attrs in self.counters.values():
+            for attr in attrs:
+                setattr(owner, attr, 0)
+        self.stages = {}
+
+    def result(self) -> tp.Dict:
+        caches = {name: stats() for name, stats in self.caches.items()}
+        return {
+            "stages": self.stages,
+            "calls": {
+                name: timing.result()
+                for name, timing in self.timings.items()
+                if timing.calls
+            },
+            "caches": {name: stats for name, stats in caches.items() if stats},
+        }
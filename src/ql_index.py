@@ -0,0 +1,264 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+import argparse
+import collections
+import multiprocessing
+import pathlib
+import pickle
+import shutil
+import sys
+import typing as tp
+import numpy as np
+import scipy.sparse
+
+ARRAYS = ["terms", "term_ptr", "doc_idx", "tfs", "doc_lengths", "doc_ids"]
+
+
+class TopicIndex:
+    """Term-major (CSR) view of a QL topic index: the postings of terms[i] are
+    doc_idx[term_ptr[i]:term_ptr[i + 1]] with frequencies tfs[...]. Stopwords
+    are removed at conversion time and doc_lengths already exclude them."""
+
+    def __init__(self, path: pathlib.Path, mmap_mode: tp.Optional[str] = "r"):
+        for name in ARRAYS:
+            array = np.load(pathlib.Path(path) / f"{name}.npy", mmap_mode=mmap_mode)
+            setattr(self, name, array)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def term_id(self, term: str) -> int:
+        i = int(np.searchsorted(self.terms, term))
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return -1
+
+    def postings(self, term: str) -> tp.Tuple[np.ndarray, np.ndarray]:
+        i = self.term_id(term)
+        if i < 0:
+            return self.doc_idx[:0], self.tfs[:0]
+        start, end = self.term_ptr[i], self.term_ptr[i + 1]
+        return self.doc_idx[start:end], self.tfs[start:end]
+
+
+class TopicIndexCache:
+    """Keeps the most recently used topic indexes loaded while their total
+    size stays within budget_mb; the most recent one is always kept."""
+
+    def __init__(
+        self,
+        load: tp.Callable[[int], tp.Any],
+        nbytes: tp.Callable[[tp.Any], int],
+        budget_mb: float,
+    ):
+        self.load = load
+        self.nbytes = nbytes
+        self.budget = budget_mb * 1024 * 1024
+        self.indexes = collections.OrderedDict()  # type: tp.Dict[int, tp.Any]
+        self.sizes = {}  # type: tp.Dict[int, int]
+        # shared memory, so that loads in forked workers are counted too
+        self.hits = multiprocessing.Value("q", 0)
+        self.misses = multiprocessing.Value("q", 0)
+        self.evictions = multiprocessing.Value("q", 0)
+
+    def get(self, topic_id: int):
+        if topic_id in self.indexes:
+            self._increment(self.hits)
+            self.indexes.move_to_end(topic_id)
+            return self.indexes[topic_id]
+        self._increment(self.misses)
+        index = self.load(topic_id)
+        self.indexes[topic_id] = index
+        self.sizes[topic_id] = self.nbytes(index)
+        while len(self.indexes) > 1 and sum(self.sizes.values()) > self.budget:
+            evicted, _ = self.indexes.popitem(last=False)
+            del self.sizes[evicted]
+            self._increment(self.evictions)
+        return index
+
+    def _increment(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def reset_stats(self):
+        # loaded indexes are kept
+        for counter in [self.hits, self.misses, self.evictions]:
+            with counter.get_lock():
+                counter.value = 0
+
+    def stats(self) -> tp.Dict[str, int]:
+        return {
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+            "evictions": self.evictions.value,
+            "loaded": len(self.indexes),
+            "loaded_mb": sum(self.sizes.values()) / 1024 / 1024,
+        }
+
+
+def inverted_index_nbytes(inverted_index: tp.Dict[str, tp.Dict]) -> int:
+    # rough footprint of the dict-of-dicts built by QL.load_topic_index, down to
+    # its terms and counts (strings and ints shared between documents are
+    # counted once per document)
+    nbytes = sys.getsizeof(inverted_index)
+    for doc, entry in inverted_index.items():
+        nbytes += sys.getsizeof(doc) + sys.getsizeof(entry)
+        nbytes += sum(sys.getsizeof(value) for value in entry.values())
+        nbytes += sum(
+            sys.getsizeof(term) + sys.getsizeof(tf)
+            for term, tf in entry["terms"].items()
+        )
+    return nbytes
+
+
+def convert_topic_index(
+    pickle_path: pathlib.Path, out_dir: pathlib.Path, stopwords: tp.Iterable[str]
+):
+    with open(pickle_path, "rb") as f:
+        inverted_index = pickle.load(f)
+    stopwords = set(stopwords)
+    # documents keep the pickle's order, which QL ranks equal scores in
+    doc_ids = list(inverted_index)
+    postings = collections.defaultdict(list)
+    doc_lengths = np.zeros(len(doc_ids), dtype=np.int64)
+    for i, doc in enumerate(doc_ids):
+        length = inverted_index[doc]["length"]
+        for term, tf in inverted_index[doc]["terms"].items():
+            if term in stopwords:
+                length -= tf
+            else:
+                postings[term].append((i, tf))
+        doc_lengths[i] = length
+    terms = sorted(postings)
+    term_ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_ptr[1:] = np.cumsum([len(postings[term]) for term in terms])
+    arrays = {
+        "terms": np.array(terms, dtype=str),
+        "term_ptr": term_ptr,
+        "doc_idx": np.array(
+            [i for term in terms for i, _ in postings[term]], dtype=np.int32
+        ),
+        "tfs": np.array([tf for term in terms for _, tf in postings[term]], np.int32),
+        "doc_lengths": doc_lengths,
+        "doc_ids": np.array(doc_ids, dtype=str),
+    }
+    # write next to the destination and rename, so readers never see half an index
+    out_dir = pathlib.Path(out_dir)
+    tmp_dir = out_dir.with_name(out_dir.name + ".tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", array)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    tmp_dir.rename(out_dir)
+
+
+def query_lang_model(
+    ql_, query: str, question: str, alpha: float = 0.5
+) -> tp.Dict[str, float]:
+    # same mixture as QL.update_query_lang_model
+    query_tokens, qlen = ql_._preprocess(query)
+    other_tokens, other_len = ql_._preprocess(question.strip())
+    lm = {}
+    for term in set(query_tokens) | set(other_tokens):
+        weight = 0.0
+        if qlen:
+            weight += alpha * query_tokens.get(term, 0) / qlen
+        if other_len:
+            weight += (1 - alpha) * other_tokens.get(term, 0) / other_len
+        lm[term] = weight
+    return lm
+
+
+def ql_scores(
+    index: TopicIndex,
+    query_lms: tp.List[tp.Dict[str, float]],
+    term_stats: tp.Dict[str, int],
+    total_terms: int,
+    mu: float,
+) -> np.ndarray:
+    """Dirichlet-smoothed query likelihood of every document for each query,
+    as a (queries x docs) matrix. Each term contributes
+        q_t * log((tf + mu * p_t) / (len + mu))
+      = q_t * (log(mu * p_t) + log1p(tf / (mu * p_t)) - log(len + mu)),
+    so only the log1p part depends on postings: it is gathered into a sparse
+    (terms x docs) matrix for the union of the queries' terms and all queries
+    are scored with one product. Terms with no collection frequency are left
+    out, as in QL.get_result_df: their likelihood would be 0 in every document."""
+    terms = sorted(
+        {t for lm in query_lms for t, w in lm.items() if w and term_stats.get(t, 0)}
+    )
+    column = {t: i for i, t in enumerate(terms)}
+    background = mu * np.array([term_stats[t] for t in terms], dtype=float)
+    background /= total_terms
+    weights = np.zeros((len(query_lms), len(terms)))
+    for i, lm in enumerate(query_lms):
+        for t, w in lm.items():
+            if t in column:
+                weights[i, column[t]] = w
+    log_norm = np.log(index.doc_lengths + mu)
+    scores = weights @ np.log(background) if terms else np.zeros(len(query_lms))
+    scores = scores[:, None] - weights.sum(axis=1)[:, None] * log_norm[None, :]
+    term_ids = np.array([index.term_id(t) for t in terms], dtype=np.int64)
+    present = np.flatnonzero(term_ids >= 0)
+    if len(present):
+        starts = index.term_ptr[term_ids[present]]
+        ends = index.term_ptr[term_ids[present] + 1]
+        indptr = np.zeros(len(present) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(ends - starts)
+        doc_idx = np.concatenate([index.doc_idx[s:e] for s, e in zip(starts, ends)])
+        tf_weights = np.concatenate(
+            [
+                np.log1p(index.tfs[s:e] / background[i])
+                for i, s, e in zip(present, starts, ends)
+            ]
+        )
+        postings = scipy.sparse.csr_matrix(
+            (tf_weights, doc_idx, indptr), shape=(len(present), index.n_docs)
+        )
+        scores += (postings.T @ weights[:, present].T).T
+    return scores
+
+
+def top_k(
+    index: TopicIndex, scores: np.ndarray, k: int
+) -> tp.Tuple[np.ndarray, np.ndarray]:
+    if k < len(scores):
+        # every document scoring at least the k-th best, so that the ones tied
+        # with it are cut by position rather than by the partition
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    # rank by score, ties by position in the index, as QL.get_result_df does
+    candidates = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+    return index.doc_ids[candidates], scores[candidates]
+
+
+if __name__ == "__main__":
+    import nltk
+    import tqdm
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-root", type=pathlib.Path, default="data/ql/")
+    parser.add_argument("--out", type=pathlib.Path, default="data/ql/topic_indexes_npy")
+    args = parser.parse_args()
+    stopwords = nltk.corpus.stopwords.words("english")
+    for pickle_path in tqdm.tqdm(
+        sorted((args.data_root / "topic_indexes").glob("*.pkl"))
+    ):
+        convert_topic_index(pickle_path, args.out / pickle_path.stem, stopwords)
@@ -13,57 +13,221 @@ import typing as tp
 import json
 import collections
 import pathlib
+import pickle
 import csv
 
 import clarify_types
+import utils
+
+# the columns topics are built from; any others are skipped when streaming
+COLUMNS = ["topic_id", "topic", "facet_id", "facet_desc", "question", "answer"]
+# bumped whenever the layout of snapshots changes
+SNAPSHOT_VERSION = 1
+
+# (topic id, query, [(facet id, facet description, [(question, answer)])])
+TopicRow = tp.Tuple[int, str, tp.List[tp.Tuple[int, str, tp.List[tp.Tuple[str, str]]]]]
+
+
+class JSONStreamReader:
+    """Decodes a JSON document one value at a time from a file read in chunks,
+    so that a large object can be walked without holding its text in memory."""
+
+    def __init__(self, file_obj: tp.TextIO, chunk_size: int = 1 << 20):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.file_obj.read(self.chunk_size)
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self) -> str:
+        # the next non-whitespace character, or "" at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos : self.pos + 1]
+            self._fill()
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                "expected %r, found %r" % (chars, self.buf[self.pos : self.pos + 20])
+            )
+        self.pos += 1
+        return char
+
+    def value(self) -> tp.Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # incomplete until more of the file is read
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # a number at the end of the buffer may go on in the next chunk,
+            # even past where it seems to end (the "1" of "1.5", or "1." of it)
+            if not self.eof and not self.buf[end:].lstrip("0123456789+-.eE"):
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def keys(self) -> tp.Iterator[str]:
+        """Keys of the object at the current position; the caller reads (or
+        walks) each key's value before asking for the next key."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+
+def stream_columns(
+    file_obj: tp.TextIO, chunk_size: int = 1 << 20
+) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+    """The COLUMNS of a Qulac file, read value by value. Rows of a topic all
+    repeat its query and facet descriptions, so equal strings are stored once."""
+    reader = JSONStreamReader(file_obj, chunk_size)
+    columns = {}  # type: tp.Dict[str, tp.Dict[str, tp.Any]]
+    strings = {}  # type: tp.Dict[str, str]
+    for name in reader.keys():
+        if name not in COLUMNS:
+            reader.value()
+            continue
+        column = columns[name] = {}
+        for row in reader.keys():
+            value = reader.value()
+            if isinstance(value, str):
+                value = strings.setdefault(value, value)
+            column[strings.setdefault(row, row)] = value
+    if reader.peek():
+        raise ValueError("unexpected data after the Qulac object")
+    return columns
+
+
+def topic_rows(j: tp.Dict[str, tp.Dict[str, tp.Any]]) -> tp.List[TopicRow]:
+    l = list(j["answer"].keys())
+    topics = collections.defaultdict(
+        lambda: {}
+    )  # type: tp.Dict[str, tp.Dict[str, tp.List[tp.Tuple[str, str]]]]
+    topics_ids = {}
+    facets_ids = collections.defaultdict(
+        lambda: {}
+    )  # type: tp.Dict[str, tp.Dict[str, tp.List[tp.Tuple[str, str]]]]
+    for k in l:
+        topic = j["topic"][k]
+        facet = j["facet_desc"][k]
+        if facet not in topics[topic]:
+            topics[topic][facet] = []
+        topics[topic][facet].append((j["question"][k], j["answer"][k]))
+        topics_ids[topic] = j["topic_id"][k]
+        facets_ids[topic][facet] = j["facet_id"][k]
+
+    rows = []  # type: tp.List[TopicRow]
+    for topic_desc, v in topics.items():
+        facets = []
+        for facet_desc, questions in v.items():
+            questions_answers = []  # type: tp.List[tp.Tuple[str, str]]
+            for i, t in enumerate(sorted(questions, key=lambda x: x[0])):
+                q, a = t
+                if not q:
+                    continue
+                questions_answers.append((q, a))
+            facets.append(
+                (facets_ids[topic_desc][facet_desc], facet_desc, questions_answers)
+            )
+        rows.append((topics_ids[topic_desc], topic_desc, facets))
+    return rows
+
+
+def snapshot_path(path: pathlib.Path) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.with_name(path.name + ".snapshot.pkl")
 
 
 class Qulac:
-    def __init__(self, file_obj: tp.TextIO):
-        j = json.load(file_obj)
-        l = list(j["answer"].keys())
-        topics = collections.defaultdict(
-            lambda: {}
-        )  # type: tp.Dict[str, tp.Dict[str, tp.List[tp.Tuple[str, str]]]]
-        topics_desc = {}
-        topics_ids = {}
-        facets_ids = collections.defaultdict(
-            lambda: {}
-        )  # type: tp.Dict[str, tp.Dict[str, tp.List[tp.Tuple[str, str]]]]
-        for k in l:
-            topic = j["topic"][k]
-            topics_desc[topic] = j["topic_desc"][k]
-            facet = j["facet_desc"][k]
-            if facet not in topics[topic]:
-                topics[topic][facet] = []
-            topics[topic][facet].append((j["question"][k], j["answer"][k]))
-            topics_ids[topic] = j["topic_id"][k]
-            facets_ids[topic][facet] = j["facet_id"][k]
+    def __init__(self, file_obj: tp.TextIO, stream: bool = False):
+        j = stream_columns(file_obj) if stream else json.load(file_obj)
+        self._index(topic_rows(j))
+
+    @classmethod
+    def from_rows(cls, rows: tp.List[TopicRow]) -> "Qulac":
+        dataset = cls.__new__(cls)
+        dataset._index(rows)
+        return dataset
 
+    @classmethod
+    def load(
+        cls, path: pathlib.Path, snapshot: bool = False, stream: bool = False
+    ) -> "Qulac":
+        """With snapshot, topics are read from a pickle next to the file, which
+        is (re)written whenever the file's digest no longer matches it."""
+        path = pathlib.Path(path)
+        if not snapshot:
+            with path.open() as f:
+                return cls(f, stream=stream)
+        digest = utils.file_digest([path])
+        cached = snapshot_path(path)
+        if cached.exists():
+            with cached.open("rb") as f:
+                saved = pickle.load(f)
+            if saved["version"] == SNAPSHOT_VERSION and saved["digest"] == digest:
+                return cls.from_rows(saved["topics"])
+        with path.open() as f:
+            rows = topic_rows(stream_columns(f) if stream else json.load(f))
+        # write next to the destination and rename, so readers never see half of it
+        tmp = cached.with_name(cached.name + ".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(
+                {"version": SNAPSHOT_VERSION, "digest": digest, "topics": rows},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        tmp.rename(cached)
+        return cls.from_rows(rows)
+
+    def _index(self, rows: tp.List[TopicRow]):
         self.topics = []  # type: tp.List[clarify_types.Topic]
         self.topic_query2obj = {}  # type: tp.Dict[str,clarify_types.Topic]
-        for topic_desc, v in topics.items():
-            facets = []  # type: tp.List[clarify_types.Facet]
-            for facet_desc, questions in v.items():
-                questions_answers = []  # type: tp.List[tp.Tuple[str, str]]
-                for i, t in enumerate(sorted(questions, key=lambda x: x[0])):
-                    q, a = t
-                    if not q:
-                        continue
-                    questions_answers.append((q, a))
-                facet = clarify_types.Facet(
-                    facets_ids[topic_desc][facet_desc], facet_desc, questions_answers
-                )
-                facets.append(facet)
-            topic = clarify_types.Topic(topics_ids[topic_desc], topic_desc, facets)
+        self.topic_id2obj = {}  # type: tp.Dict[int, clarify_types.Topic]
+        # facet ids are only unique within a topic
+        self.facet_id2obj = {}  # type: tp.Dict[tp.Tuple[int, int], clarify_types.Facet]
+        for topic_id, query, facets in rows:
+            topic = clarify_types.Topic(
+                topic_id,
+                query,
+                [clarify_types.Facet(*facet) for facet in facets],
+            )
             self.topics.append(topic)
             self.topic_query2obj[topic.query] = topic
+            self.topic_id2obj.setdefault(topic.id, topic)
+            for facet in topic.facets:
+                self.facet_id2obj.setdefault((topic.id, facet.id), facet)
 
     def get_topic_by_query(self, query: str) -> clarify_types.Topic:
         return self.topic_query2obj[query]
 
     def get_topic_by_id(self, id: str) -> clarify_types.Topic:
-        return [topic for topic in self.topics if topic.id == int(id)][0]
+        return self.topic_id2obj[int(id)]
+
+    def get_facet_by_id(self, topic_id: str, facet_id: str) -> clarify_types.Facet:
+        return self.facet_id2obj[(int(topic_id), int(facet_id))]
 
 
 if __name__ == "__main__":
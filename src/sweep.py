@@ -0,0 +1,101 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import argparse
+import itertools
+import json
+import pathlib
+import random
+import typing as tp
+import numpy as np
+
+import main
+
+# arguments that only affect the simulated user, the facet ranker and the
+# simulation itself, so that all cells of a sweep can share the loaded resources
+SWEEPABLE = [
+    "patience",
+    "cooperativeness",
+    "cooperativeness_fn",
+    "facet_ranker",
+    "facet_ranker_alpha",
+    "threshold_user",
+    "epochs",
+    "seed",
+    "simulation",
+    "max_tree_nodes",
+    "batch_epochs",
+    "median",
+]
+
+
+def grid_configs(grid: tp.Union[tp.Dict, tp.List[tp.Dict]]) -> tp.List[tp.Dict]:
+    """A grid maps argument names to lists of values and expands to their
+    cartesian product; a list of grids expands to the union of theirs."""
+    if isinstance(grid, list):
+        return [config for subgrid in grid for config in grid_configs(subgrid)]
+    grid = {key.replace("-", "_"): values for key, values in grid.items()}
+    for key, values in grid.items():
+        if key not in SWEEPABLE:
+            raise ValueError("%s cannot vary within a sweep" % key)
+        if not isinstance(values, list):
+            grid[key] = [values]
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def config_name(config: tp.Dict) -> str:
+    return ",".join("%s=%s" % (key, value) for key, value in config.items())
+
+
+def reset_stats(resources: tp.Dict):
+    # caches keep their contents across cells, but each cell reports its own
+    # lookups; loading is profiled in the first cell only
+    resources["profile"].reset()
+    resources["ir_metric_calculator"].reset_stats()
+    resources["ir_system"].indexes.reset_stats()
+
+
+if __name__ == "__main__":
+    parser = main.build_parser()
+    parser.description = (
+        "Runs every cell of --grid with the resources and caches of one load. "
+        "With --workers > 1, similarity scores and IR metrics computed by worker "
+        "processes are not returned to the sweep, so later cells only reuse "
+        "them through --similarity-cache and --precompute-metrics."
+    )
+    parser.add_argument("--grid", type=pathlib.Path, required=True)
+    parser.add_argument("--out-dir", type=pathlib.Path, default="sweep")
+    args = parser.parse_args()
+
+    configs = grid_configs(json.loads(args.grid.read_text()))
+    # IR metrics are kept across cells as well, as most queries repeat
+    resources = main.load_resources(args, cache_metrics=True)
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    suffix = ".jsonl" if args.output_format == "jsonl" else ".json"
+    index = []
+    for i, config in enumerate(configs):
+        if i:
+            reset_stats(resources)
+        cell_args = argparse.Namespace(**{**vars(args), **config})
+        if cell_args.seed is not None:
+            random.seed(cell_args.seed)
+            np.random.seed(cell_args.seed)
+        path = args.out_dir / (config_name(config) + suffix)
+        with path.open("w") as out:
+            json_out = main.run(
+                cell_args, resources, main.build_clarify(cell_args, resources), out
+            )
+        index.append(
+            {"config": config, "path": path.name, "metrics": json_out["metrics"]}
+        )
+        with (args.out_dir / "sweep.json").open("w") as f:
+            json.dump(index, f, indent=4)
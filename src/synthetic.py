@@ -0,0 +1,204 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import argparse
+import collections
+import json
+import pathlib
+import pickle
+import random
+import typing as tp
+import pandas as pd
+
+import ql_index
+
+CONSONANTS = "bdfgklmnprtvz"
+VOWELS = "aiou"
+# a few stopwords in every document, which QL removes when loading an index
+STOPWORDS = ["the", "of", "and", "to", "in", "a"]
+TEMPLATES = [
+    "are you interested in {}",
+    "do you want to know about {}",
+    "would you like information on {}",
+]
+
+
+def make_words(rng: random.Random, n: int, syllables: int = 3) -> tp.List[str]:
+    # made-up words of consonant-vowel syllables, which stemmers leave alone
+    words = set()  # type: tp.Set[str]
+    while len(words) < n:
+        words.add(
+            "".join(
+                rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(syllables)
+            )
+        )
+    return sorted(words)
+
+
+def generate(
+    out_dir: pathlib.Path,
+    topics: int = 20,
+    facets_per_topic: int = 4,
+    questions_per_facet: int = 3,
+    docs_per_topic: int = 200,
+    doc_length: int = 150,
+    vocab_size: int = 5000,
+    seed: int = 0,
+) -> tp.Dict:
+    """Writes a Qulac-format dataset, its qrels and QL topic indexes (pickled
+    and converted by ql_index.py) under out_dir, laid out like data/ so that
+    main.py runs on it with --dataset, --qrel, --ql-data-root and
+    --ql-index-path. As in Qulac, every question of a topic is answered under
+    each of its facets: yes with the facet's words if the question was written
+    for that facet, no with them otherwise."""
+    rng = random.Random(seed)
+    out_dir = pathlib.Path(out_dir)
+    words_per_facet = 3
+    n_words = vocab_size + topics * (2 + facets_per_topic * words_per_facet)
+    words = make_words(rng, n_words)
+    rng.shuffle(words)
+    background, words = words[:vocab_size], words[vocab_size:]
+
+    columns = collections.defaultdict(dict)  # type: tp.Dict[str, tp.Dict]
+    qrels = []
+    indexes = {}  # type: tp.Dict[int, tp.Dict[str, tp.Dict]]
+    collection = collections.Counter()  # type: tp.Dict[str, int]
+    row = 0
+    for topic_id in range(1, topics + 1):
+        query = [words.pop() for _ in range(2)]
+        facets = [
+            [words.pop() for _ in range(words_per_facet)]
+            for _ in range(facets_per_topic)
+        ]
+        questions = [
+            (
+                i,
+                rng.choice(TEMPLATES).format(
+                    " ".join(rng.sample(facet, rng.randint(1, len(facet))))
+                ),
+            )
+            for i, facet in enumerate(facets)
+            for _ in range(questions_per_facet)
+        ]
+        for facet_id, facet in enumerate(facets, 1):
+            for question_facet, question in questions:
+                if question_facet == facet_id - 1:
+                    answer = "yes " + " ".join(facet)
+                else:
+                    answer = "no i am looking for " + " ".join(facet)
+                for key, value in [
+                    ("topic_id", topic_id),
+                    ("facet_id", facet_id),
+                    ("topic_facet_id", "%d-%d" % (topic_id, facet_id)),
+                    ("topic", " ".join(query)),
+                    ("topic_desc", "information about " + " ".join(query)),
+                    ("facet_desc", " ".join(facet)),
+                    ("question", question),
+                    ("answer", answer),
+                ]:
+                    columns[key][str(row)] = value
+                row += 1
+
+        # documents mix the query, one facet (relevant to it when the mix is
+        # strong) and background words
+        index = {}
+        for i in range(docs_per_topic):
+            doc_id = "synthetic-%04d-%05d" % (topic_id, i)
+            facet_id = rng.randrange(facets_per_topic)
+            focus = rng.random()
+            length = rng.randint(doc_length // 2, doc_length * 3 // 2)
+            terms = collections.Counter()  # type: tp.Dict[str, int]
+            for _ in range(length):
+                r = rng.random()
+                if r < 0.1:
+                    terms[rng.choice(query)] += 1
+                elif r < 0.1 + 0.3 * focus:
+                    terms[rng.choice(facets[facet_id])] += 1
+                elif r < 0.6:
+                    terms[rng.choice(STOPWORDS)] += 1
+                else:
+                    # roughly Zipfian background
+                    terms[background[int(rng.paretovariate(1)) % vocab_size]] += 1
+            index[doc_id] = {"terms": dict(terms), "length": length}
+            collection.update(terms)
+            if focus > 0.5:
+                rel = 2 if focus > 0.8 else 1
+                qrels.append("%d-%d 0 %s %d" % (topic_id, facet_id + 1, doc_id, rel))
+        indexes[topic_id] = index
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with (out_dir / "qulac.json").open("w") as f:
+        json.dump(columns, f)
+    (out_dir / "faceted.qrel").write_text("\n".join(qrels) + "\n")
+
+    ql_root = out_dir / "ql"
+    stats_dir = ql_root / "clueweb_stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    # every made-up word occurs in the background collection, so that all
+    # query terms carry a background probability
+    counts = {word: 1 for word in background + words}
+    counts.update({term: 1 + 1000 * n for term, n in collection.items()})
+    term_stats = pd.DataFrame({1: pd.Series(counts)})
+    for name in ["term_stats.pkl", "term_stats.krovetz.pkl"]:
+        term_stats.to_pickle(stats_dir / name)
+    (ql_root / "topic_indexes").mkdir(exist_ok=True)
+    for topic_id, index in indexes.items():
+        pickle_path = ql_root / "topic_indexes" / ("%d.pkl" % topic_id)
+        with pickle_path.open("wb") as f:
+            pickle.dump(index, f)
+        ql_index.convert_topic_index(
+            pickle_path, ql_root / "topic_indexes_npy" / str(topic_id), STOPWORDS
+        )
+
+    manifest = {
+        "topics": topics,
+        "facets_per_topic": facets_per_topic,
+        "questions_per_facet": questions_per_facet,
+        "docs_per_topic": docs_per_topic,
+        "doc_length": doc_length,
+        "vocab_size": vocab_size,
+        "seed": seed,
+    }
+    with (out_dir / "manifest.json").open("w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--topics", type=int, default=20)
+    parser.add_argument("--facets-per-topic", type=int, default=4)
+    parser.add_argument("--questions-per-facet", type=int, default=3)
+    parser.add_argument("--docs-per-topic", type=int, default=200)
+    parser.add_argument("--doc-length", type=int, default=150)
+    parser.add_argument("--vocab-size", type=int, default=5000)
+    parser.add_argument("--data-seed", type=int, default=0)
+
+
+def generate_from_args(out_dir: pathlib.Path, args: argparse.Namespace) -> tp.Dict:
+    return generate(
+        out_dir,
+        topics=args.topics,
+        facets_per_topic=args.facets_per_topic,
+        questions_per_facet=args.questions_per_facet,
+        docs_per_topic=args.docs_per_topic,
+        doc_length=args.doc_length,
+        vocab_size=args.vocab_size,
+        seed=args.data_seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=pathlib.Path, default="data/synthetic")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(generate_from_args(args.out, args), indent=4))
@@ -0,0 +1,107 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import inspect
+import pathlib
+import typing as tp
+import torch
+import transformers
+
+
+class LogitsOnly(torch.nn.Module):
+    # exported graphs take positional tensors and return tensors, not model outputs
+    def __init__(self, model: torch.nn.Module, input_names: tp.List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs)))[0]
+
+
+def onnx_path(transformer_path: pathlib.Path, digest: str, quantize: bool):
+    # keyed by the digest of the weights, so retrained models are exported anew
+    suffix = ".int8.onnx" if quantize else ".onnx"
+    return pathlib.Path(transformer_path) / "onnx" / ("model-%s%s" % (digest, suffix))
+
+
+def export(transformer_path: pathlib.Path, out: pathlib.Path, opset: int = 11):
+    model = transformers.AutoModelForSequenceClassification.from_pretrained(
+        transformer_path
+    )
+    model.eval()
+    tokenizer = transformers.AutoTokenizer.from_pretrained(transformer_path)
+    example = tokenizer(["is it a question"], ["it is"], return_tensors="pt")
+    input_names = list(example.keys())
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    # write next to the destination and rename, so readers never see half a model
+    tmp = out.with_name(out.name + ".tmp")
+    tmp.parent.mkdir(parents=True, exist_ok=True)
+    # torch 2's default dynamo exporter cannot convert dynamic_axes, so the
+    # TorchScript exporter is asked for where there is a choice
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            LogitsOnly(model, input_names),
+            tuple(example[name] for name in input_names),
+            str(tmp),
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes={**dynamic_axes, "logits": {0: "batch"}},
+            opset_version=opset,
+            do_constant_folding=True,
+            **options,
+        )
+    tmp.rename(out)
+
+
+def quantize(model: pathlib.Path, out: pathlib.Path):
+    # weights of linear layers to int8; activations are quantized on the fly
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp = out.with_name(out.name + ".tmp")
+    quantize_dynamic(str(model), str(tmp), weight_type=QuantType.QInt8)
+    tmp.rename(out)
+
+
+def ensure_exported(
+    transformer_path: pathlib.Path, digest: str, int8: bool = False
+) -> pathlib.Path:
+    path = onnx_path(transformer_path, digest, False)
+    if not path.exists():
+        export(transformer_path, path)
+    if not int8:
+        return path
+    int8_path = onnx_path(transformer_path, digest, True)
+    if not int8_path.exists():
+        quantize(path, int8_path)
+    return int8_path
+
+
+def load_session(
+    path: pathlib.Path, intra_op_threads: int = 0, inter_op_threads: int = 0
+):
+    """ONNX Runtime session on CPU; 0 threads lets ONNX Runtime decide. Operators
+    only run concurrently (on inter_op_threads) in parallel execution mode."""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    return onnxruntime.InferenceSession(
+        str(path), options, providers=["CPUExecutionProvider"]
+    )
@@ -10,6 +10,7 @@
 #  and limitations under the License.
 
 from collections import defaultdict
+import copy
 import typing as tp
 import numpy as np
 
@@ -55,6 +56,12 @@ class UserSimulatorState:
     def ran_out_of_patience(self):
         return self.turns == self.patience
 
+    def copy(self) -> "UserSimulatorState":
+        state = copy.copy(self)
+        state.questions = self.questions[:]
+        state.answers = self.answers[:]
+        return state
+
 
 class UserSimulator:
     def __init__(
@@ -96,6 +103,90 @@ class UserSimulator:
             "similarity": similarity,
         }
 
+    def feedback_batch(
+        self,
+        states: tp.List[UserSimulatorState],
+        questions: tp.List[str],
+        rng: np.random.Generator,
+    ) -> tp.List[tp.Dict]:
+        """feedback for many dialogues at once: similarities are computed in one
+        matcher batch and answers are drawn from their distributions with rng,
+        one vectorized draw per distinct distribution."""
+        patient = [
+            i for i, state in enumerate(states) if not state.ran_out_of_patience()
+        ]
+        for i in patient:
+            states[i].cooperativeness = self.cooperativeness_fn(states[i].turns)
+            states[i].turns += 1
+        similarities = [0.0] * len(states)
+        batch = self.matcher.similarity_batch(
+            [
+                (states[i].topic.query + " . " + states[i].facet.desc, questions[i])
+                for i in patient
+            ]
+        )
+        for i, similarity in zip(patient, batch):
+            similarities[i] = similarity
+        answers = [None] * len(states)  # type: tp.List[tp.Optional[str]]
+        groups = defaultdict(list)
+        for i in patient:
+            state = states[i]
+            key = (state.topic, state.facet, state.cooperativeness, similarities[i])
+            groups[key].append(i)
+        draws = rng.random(len(states))
+        for (topic, facet, cooperativeness, similarity), indices in groups.items():
+            if not self.answer_generator.enumerable:
+                for i in indices:
+                    answers[i] = self.answer_generator.generate_answer(
+                        topic, facet, cooperativeness, similarity
+                    )
+                continue
+            choices = self.answer_generator.answer_distribution(
+                topic, facet, cooperativeness, similarity
+            )
+            cumulative = np.cumsum([p for _, p in choices])
+            picks = np.searchsorted(cumulative, draws[indices], side="right")
+            for i, pick in zip(indices, np.minimum(picks, len(choices) - 1)):
+                answers[i] = choices[pick][0]
+        feedbacks = []
+        for state, question, answer, similarity in zip(
+            states, questions, answers, similarities
+        ):
+            state.add_question(question)
+            state.add_answer(answer)
+            feedback = {"answer": answer, "state": state, "similarity": similarity}
+            feedbacks.append(feedback)
+        return feedbacks
+
+    def feedback_distribution(
+        self, state: UserSimulatorState, question: str
+    ) -> tp.List[tp.Tuple[tp.Dict, float]]:
+        """Every feedback that feedback could give, with its probability. Each
+        comes with its own copy of the state, which is left untouched."""
+        cooperativeness, turns = state.cooperativeness, state.turns
+        if state.ran_out_of_patience():
+            answers = [(None, 1.0)]
+            similarity = 0.0
+        else:
+            cooperativeness = self.cooperativeness_fn(state.turns)
+            turns += 1
+            similarity = self.matcher.similarity(
+                state.topic.query + " . " + state.facet.desc, question
+            )
+            answers = self.answer_generator.answer_distribution(
+                state.topic, state.facet, cooperativeness, similarity
+            )
+        feedbacks = []
+        for answer, probability in answers:
+            branch = state.copy()
+            branch.cooperativeness = cooperativeness
+            branch.turns = turns
+            branch.add_question(question)
+            branch.add_answer(answer)
+            feedback = {"answer": answer, "state": branch, "similarity": similarity}
+            feedbacks.append((feedback, probability))
+        return feedbacks
+
     def build_state(
         self, topic: clarify_types.Topic, facet: clarify_types.Facet
     ) -> UserSimulatorState:
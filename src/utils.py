@@ -9,10 +9,16 @@
 #  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
 #  and limitations under the License.
 
+import hashlib
+import pathlib
+import random
 import re
 import string
+import typing as tp
 import numpy as np
 
+import aggregation
+
 regex = re.compile("[%s]" % re.escape(string.punctuation))
 
 
@@ -26,10 +32,51 @@ def remove_prefix(text: str, prefix: str) -> str:
     return text
 
 
-def compute_metrics(metrics_per_run):
-    metrics = {}
+def compute_metrics(
+    metrics_per_run: tp.Dict[str, tp.Iterable[float]], median: str = "exact"
+) -> tp.Dict[str, tp.Dict[str, float]]:
+    aggregator = aggregation.MetricAggregator(median)
     for metric, values in metrics_per_run.items():
-        metrics[metric] = {}
-        for name, fn in [("mean", np.mean), ("median", np.median), ("std", np.std)]:
-            metrics[metric][name] = fn(values)
-    return metrics
+        for value in values:
+            aggregator.add(metric, value)
+    return aggregator.result()
+
+
+def file_digest(paths: tp.Iterable[pathlib.Path], chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    for path in sorted(pathlib.Path(p) for p in paths):
+        h.update(path.name.encode())
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stamp(path: pathlib.Path, block_size: int = 1 << 20) -> str:
+    """Identifies a file too large to hash by its size, modification time and
+    the digest of its first block (which holds the header of a vector file)."""
+    path = pathlib.Path(path)
+    stat = path.stat()
+    h = hashlib.sha1()
+    with path.open("rb") as f:
+        h.update(f.read(block_size))
+    return "%d:%d:%s" % (stat.st_size, stat.st_mtime_ns, h.hexdigest())
+
+
+def derive_seed(seed: int, *keys) -> int:
+    key = "-".join(str(k) for k in (seed,) + keys)
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], "little")
+
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def hit_stats(hits: int, misses: int) -> tp.Dict[str, float]:
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+    }
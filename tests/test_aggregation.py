@@ -0,0 +1,126 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import numpy as np
+import pytest
+
+import aggregation
+
+
+def values(n=5000, seed=0):
+    return np.random.RandomState(seed).lognormal(size=n)
+
+
+def shards(x, sizes=(1, 10, 989, 4000)):
+    return np.split(x, np.cumsum(sizes)[:-1])
+
+
+def stats_of(x, median, weights=None):
+    stats = aggregation.RunningStats(median)
+    for i, value in enumerate(x):
+        stats.add(value, 1.0 if weights is None else weights[i])
+    return stats
+
+
+def rank(x, value, weights=None):
+    weights = np.ones(len(x)) if weights is None else weights
+    return weights[x <= value].sum() / weights.sum()
+
+
+@pytest.mark.parametrize("median", aggregation.MEDIANS)
+def test_stats_match_numpy(median):
+    x = values()
+    result = stats_of(x, median).result()
+    assert result["mean"] == pytest.approx(np.mean(x))
+    assert result["std"] == pytest.approx(np.std(x))
+    if median == "exact":
+        assert result["median"] == np.median(x)
+        assert stats_of(x[:4], median).result()["median"] == np.median(x[:4])
+    else:
+        assert rank(x, result["median"]) == pytest.approx(0.5, abs=0.01)
+
+
+@pytest.mark.parametrize("median", aggregation.MEDIANS)
+def test_merged_uneven_shards_match_numpy(median):
+    x = values()
+    merged = aggregation.RunningStats(median)
+    for shard in shards(x):
+        merged.merge(stats_of(shard, median))
+    # merging into an empty shard, and merging an empty shard, change nothing
+    merged.merge(aggregation.RunningStats(median))
+    result = merged.result()
+    assert result["mean"] == pytest.approx(np.mean(x))
+    assert result["std"] == pytest.approx(np.std(x))
+    if median == "exact":
+        assert result["median"] == np.median(x)
+    else:
+        assert rank(x, result["median"]) == pytest.approx(0.5, abs=0.01)
+
+
+@pytest.mark.parametrize("median", aggregation.MEDIANS)
+def test_weighted_stats_match_repeated_values(median):
+    x = values(2000)
+    weights = np.random.RandomState(1).randint(1, 5, size=len(x)).astype(float)
+    repeated = np.repeat(x, weights.astype(int))
+    merged = aggregation.RunningStats(median)
+    for shard, shard_weights in zip(
+        shards(x, (3, 97, 1900)), shards(weights, (3, 97, 1900))
+    ):
+        merged.merge(stats_of(shard, median, shard_weights))
+    result = merged.result()
+    assert merged.count == weights.sum()
+    assert result["mean"] == pytest.approx(np.average(x, weights=weights))
+    assert result["std"] == pytest.approx(np.std(repeated))
+    if median == "exact":
+        assert result["median"] == np.median(repeated)
+    else:
+        assert rank(x, result["median"], weights) == pytest.approx(0.5, abs=0.01)
+
+
+def test_exact_weighted_median_splits_ties_like_numpy():
+    # with weights 2, 1, 1 the repeated values are [1, 1, 2, 3]
+    quantiles = aggregation.ExactQuantiles()
+    for value, weight in [(2.0, 1.0), (1.0, 2.0), (3.0, 1.0)]:
+        quantiles.add(value, weight)
+    assert quantiles.quantile(0.5) == np.median([1.0, 1.0, 2.0, 3.0])
+
+
+def test_tdigest_is_bounded_and_keeps_the_extremes():
+    x = values(20000)
+    digest = aggregation.TDigest()
+    for shard in shards(x, (7, 13000, 6993)):
+        shard_digest = aggregation.TDigest()
+        for value in shard:
+            shard_digest.add(value)
+        digest.merge(shard_digest)
+    digest.compress()
+    assert len(digest.means) <= digest.compression
+    assert digest.weights.sum() == len(x)
+    assert digest.quantile(0.0) == x.min()
+    assert digest.quantile(1.0) == x.max()
+    for q in [0.1, 0.25, 0.75, 0.9]:
+        assert rank(x, digest.quantile(q)) == pytest.approx(q, abs=0.01)
+
+
+def test_aggregator_merge_matches_adding_in_order():
+    x = values(100)
+    added = aggregation.MetricAggregator()
+    merged = aggregation.MetricAggregator()
+    for shard in shards(x, (1, 30, 69)):
+        shard_metrics = aggregation.MetricAggregator()
+        for value in shard:
+            added.update({"a": value, "b": -value})
+            shard_metrics.update({"a": value, "b": -value})
+        merged.merge(shard_metrics)
+    assert list(merged.result()) == ["a", "b"]
+    for metric, result in added.result().items():
+        assert merged.result()[metric] == pytest.approx(result)
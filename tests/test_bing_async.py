@@ -0,0 +1,172 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import asyncio
+import socket
+import threading
+import time
+import typing as tp
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import clarify_types
+import facet_retrieval
+
+
+class StubBing:
+    """Local stand-in for the autosuggest endpoint. Each query is answered with
+    its scripted failure statuses first and then with two suggestions."""
+
+    def __init__(self, failures: tp.Dict[str, tp.List[int]]):
+        self.failures = failures
+        # (arrival time, query, client port, status)
+        self.requests = []  # type: tp.List[tp.Tuple[float, str, int, int]]
+        self.url = ""
+
+    async def suggestions(self, request: web.Request) -> web.Response:
+        query = request.query["q"]
+        attempt = sum(1 for _, q, _, _ in self.requests if q == query)
+        failures = self.failures.get(query, [])
+        status = failures[attempt] if attempt < len(failures) else 200
+        port = request.transport.get_extra_info("peername")[1]
+        self.requests.append((time.monotonic(), query, port, status))
+        if status != 200:
+            return web.Response(status=status)
+        return web.json_response(
+            {
+                "suggestionGroups": [
+                    {
+                        "searchSuggestions": [
+                            {"query": query + " one"},
+                            {"query": query + " two"},
+                        ]
+                    }
+                ]
+            }
+        )
+
+    def arrivals(self, query: str) -> tp.List[float]:
+        return [t for t, q, _, _ in self.requests if q == query]
+
+
+@pytest.fixture
+def serve():
+    # the server runs in its own thread and loop, as prefetch runs its own loop
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    def start(failures: tp.Dict[str, tp.List[int]]) -> StubBing:
+        stub = StubBing(failures)
+        app = web.Application()
+        app.router.add_get("/v7.0/Suggestions", stub.suggestions)
+        runner = web.AppRunner(app)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+
+        async def setup():
+            await runner.setup()
+            await web.SockSite(runner, sock).start()
+
+        asyncio.run_coroutine_threadsafe(setup(), loop).result()
+        runners.append(runner)
+        stub.url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+        return stub
+
+    yield start
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def retriever(stub: StubBing, tmp_path, **kwargs):
+    options = dict(bing_sleep=0.001, chars=[], backoff=0.05, concurrency=4)
+    options.update(kwargs)
+    return facet_retrieval.AsyncBingFacetRetriever(
+        "key", tmp_path / "suggestions.sqlite", endpoint=stub.url, **options
+    )
+
+
+def topics(*queries: str) -> tp.List[clarify_types.Topic]:
+    return [clarify_types.Topic(i, query, []) for i, query in enumerate(queries)]
+
+
+def test_retries_429_and_5xx_with_backoff(serve, tmp_path):
+    stub = serve({"alpha": [429, 503, 500]})
+    retriever(stub, tmp_path).prefetch(topics("alpha"))
+    assert [status for _, _, _, status in stub.requests] == [429, 503, 500, 200]
+    arrivals = stub.arrivals("alpha")
+    for attempt, (before, after) in enumerate(zip(arrivals, arrivals[1:])):
+        assert after - before >= 0.9 * 0.05 * 2**attempt
+
+
+def test_gives_up_after_max_retries(serve, tmp_path):
+    stub = serve({"alpha": [503, 503, 503]})
+    with pytest.raises(Exception, match="503"):
+        retriever(stub, tmp_path, max_retries=2).prefetch(topics("alpha"))
+    assert len(stub.requests) == 3
+
+
+def test_does_not_retry_other_errors(serve, tmp_path):
+    stub = serve({"alpha": [404]})
+    with pytest.raises(Exception, match="404"):
+        retriever(stub, tmp_path).prefetch(topics("alpha"))
+    assert len(stub.requests) == 1
+
+
+def test_requests_are_spaced_at_the_token_bucket_rate(serve, tmp_path):
+    stub = serve({})
+    queries = ["q%d" % i for i in range(6)]
+    retriever(stub, tmp_path, bing_sleep=0.05, concurrency=6).prefetch(topics(*queries))
+    arrivals = sorted(t for t, _, _, _ in stub.requests)
+    assert len(arrivals) == len(queries)
+    for before, after in zip(arrivals, arrivals[1:]):
+        assert after - before >= 0.8 * 0.05
+
+
+def test_one_session_and_its_connections_are_reused(serve, tmp_path, monkeypatch):
+    sessions = []
+    client_session = aiohttp.ClientSession
+
+    def counting_session(*args, **kwargs):
+        sessions.append(client_session(*args, **kwargs))
+        return sessions[-1]
+
+    monkeypatch.setattr(facet_retrieval.aiohttp, "ClientSession", counting_session)
+    stub = serve({})
+    queries = ["q%d" % i for i in range(8)]
+    retriever(stub, tmp_path, bing_sleep=0.01, concurrency=2).prefetch(topics(*queries))
+    assert len(sessions) == 1
+    ports = {port for _, _, port, _ in stub.requests}
+    assert len(stub.requests) == len(queries)
+    assert len(ports) <= 2
+
+
+def test_results_are_written_to_the_suggestion_cache(serve, tmp_path):
+    stub = serve({"beta": [429]})
+    retriever(stub, tmp_path).prefetch(topics("alpha", "beta"))
+    # a fresh cache on the same file sees every response
+    cache = facet_retrieval.BingSuggestionCache(tmp_path / "suggestions.sqlite")
+    assert cache["alpha"] == ["alpha one", "alpha two"]
+    assert cache["beta"] == ["beta one", "beta two"]
+    # and nothing is requested again
+    requests = len(stub.requests)
+    again = retriever(stub, tmp_path)
+    again.prefetch(topics("alpha", "beta"))
+    assert len(stub.requests) == requests
+    facets = again.facets_for_topic(topics("alpha")[0])
+    assert [facet.desc for facet, _ in facets] == ["alpha one", "alpha two"]
@@ -0,0 +1,329 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import itertools
+import json
+import typing as tp
+
+import pytest
+
+import answer_generation
+import clarify
+import clarify_types
+import facet_ranking
+import facet_retrieval
+import informative_no_extraction
+import ir
+import match
+import question_generation
+import user_simulator
+import utils
+import yes_no_detection
+
+
+class QueryMetricCalculator(ir.MetricCalculator):
+    # whether the dialogue ended on the facet's own description
+    def calculate_metrics(self, ir_sys, topic, facet, query) -> tp.Dict[str, float]:
+        return {"found": float(query == facet.desc)}
+
+
+def topics(n_topics: int = 4, n_facets: int = 4) -> tp.List[clarify_types.Topic]:
+    return [
+        clarify_types.Topic(
+            "t%d" % t,
+            "topic %d" % t,
+            [
+                clarify_types.Facet(
+                    "t%d-f%d" % (t, f),
+                    # shared by topics, so a worker's cache differs from the
+                    # serial run's
+                    "facet %d" % f,
+                    [
+                        ("is it facet %d?" % f, "yes it is facet %d" % f),
+                        ("is it not facet %d?" % f, "no I want facet %d" % f),
+                    ],
+                )
+                for f in range(n_facets)
+            ],
+        )
+        for t in range(n_topics)
+    ]
+
+
+def build_clarify(
+    user_matcher: match.SentenceMatcher,
+    facet_ranker: facet_ranking.FacetRanker,
+    patience: int = 3,
+    cooperativeness: float = 0.5,
+    threshold: float = 0.6,
+    clarify_class: tp.Type[clarify.Clarify] = clarify.Clarify,
+    **kwargs
+) -> clarify.Clarify:
+    yes_no_detector = yes_no_detection.DummyYesNoDetector()
+
+    def cooperativeness_fn(turns: int) -> float:
+        return cooperativeness
+
+    return clarify_class(
+        question_generator=question_generation.DummyQuestionGenerator(),
+        user_simulator=user_simulator.UserSimulator(
+            matcher=user_matcher,
+            patience=patience,
+            cooperativeness=cooperativeness,
+            cooperativeness_fn=cooperativeness_fn,
+            yes_no_detector=yes_no_detector,
+            answer_generator=answer_generation.QulacAnswerGenerator(
+                yes_no_detector, perfect_match_threshold=threshold
+            ),
+        ),
+        yes_no_detector=yes_no_detector,
+        informative_no_extractor=(
+            informative_no_extraction.DummyInformativeNoExtractor()
+        ),
+        facet_ranker=facet_ranker,
+        facet_retriever=facet_retrieval.QulacFacetRetriever(None),
+        ir_system=ir.DummyInformationRetriever(),
+        ir_metric_calculator=QueryMetricCalculator(),
+        cooperativeness_fn=cooperativeness_fn,
+        **kwargs
+    )
+
+
+def random_clarify(seed: int) -> clarify.Clarify:
+    def matcher():
+        return match.CachingSentenceMatcher(match.RandomSentenceMatcher(seed=seed))
+
+    return build_clarify(matcher(), facet_ranking.SimilarityFacetRanker(matcher()))
+
+
+def dumps(out: tp.Dict) -> str:
+    return json.dumps(out, default=lambda obj: obj.to_json(), sort_keys=True)
+
+
+def test_seeded_runs_do_not_depend_on_the_worker_count():
+    outs = [
+        dumps(random_clarify(7).run(5, topics(), workers=workers, seed=7))
+        for workers in [1, 3]
+    ]
+    assert outs[0] == outs[1]
+    # and the seed does matter
+    assert dumps(random_clarify(8).run(5, topics(), seed=8)) != outs[0]
+
+
+def test_streamed_records_start_each_topic():
+    outs = []
+    for workers in [1, 3]:
+        records = []  # type: tp.List[tp.Dict]
+        random_clarify(7).run(
+            3, topics(), workers=workers, seed=7, writer=records.append
+        )
+        outs.append(json.loads(dumps({"records": records}))["records"])
+    assert outs[0] == outs[1]
+    facet_records = ["dialogue"] * 3 + ["facet"]
+    assert [record["type"] for record in outs[0]] == (["topic"] + facet_records * 4) * 4
+    in_memory = json.loads(dumps(random_clarify(7).run(3, topics(), seed=7)))
+    topic_records = [record for record in outs[0] if record["type"] == "topic"]
+    for record, topic_out in zip(topic_records, in_memory["topics"]):
+        assert record["topic_id"] == topic_out["topic"]["id"]
+        assert record["query"] == topic_out["topic"]["query"]
+        assert record["facets"] == topic_out["topic"]["facets"]
+
+
+class OverlapMatcher(match.SentenceMatcher):
+    # share of the words of sent2 that are also in sent1
+    def similarity(self, sent1: str, sent2: str) -> float:
+        words1 = set(utils.strip_punctuation(sent1).lower().split())
+        words2 = set(utils.strip_punctuation(sent2).lower().split())
+        return len(words1 & words2) / len(words2)
+
+
+def tied_topic() -> clarify_types.Topic:
+    # every facet ties at first, and facets sharing a word with those already
+    # asked about fall behind the others, so later ties mix facets that lost
+    # earlier ties with facets that did not
+    return clarify_types.Topic(
+        "t",
+        "topic",
+        [
+            clarify_types.Facet(
+                name,
+                "%s %s" % (name, word),
+                [("q", "yes it is %s" % name), ("q", "no I want %s" % name)],
+            )
+            for name, word in zip("abcde", "xyyxy")
+        ],
+    )
+
+
+def exact_clarify(**kwargs) -> clarify.Clarify:
+    # the user only says yes to their own facet; facets are ranked by how
+    # little they overlap the facets already asked about
+    return build_clarify(
+        OverlapMatcher(),
+        facet_ranking.SimilarityFacetRanker(OverlapMatcher(), alpha=0.0),
+        threshold=0.3,
+        **kwargs
+    )
+
+
+class FixedTiebreakClarify(clarify.Clarify):
+    """Dialogues with given tie-break keys: the tied facet with the highest key
+    is always the one asked about."""
+
+    keys = {}  # type: tp.Dict[clarify_types.Facet, float]
+
+    def build_state(self, topic, tiebreaks=None):
+        facets = self.topic_facets(topic)
+        return super().build_state(topic, [self.keys[f] for f, _ in facets])
+
+    def tie_probabilities(self, ties, tied):
+        best = max(tied, key=self.keys.get)
+        return [float(facet is best) for facet in tied]
+
+
+def key_orders(elements, ties):
+    # orders of elements, first popped first, that agree with every tie
+    return [
+        order
+        for order in itertools.permutations(elements)
+        if all(
+            order.index(winner) < order.index(loser)
+            for winner, losers in ties
+            for loser in losers
+        )
+    ]
+
+
+def test_count_orders_counts_permutations():
+    elements = tuple("abcde")
+    for ties in [
+        (),
+        (("a", frozenset("bc")),),
+        (("a", frozenset("bcd")), ("b", frozenset("c")), ("e", frozenset("d"))),
+        (("a", frozenset("b")), ("b", frozenset("a"))),
+    ]:
+        assert clarify.count_orders(elements, ties) == len(key_orders(elements, ties))
+
+
+def test_tie_probabilities_match_permutations():
+    a, b, c, d = tied_topic().facets[:4]
+    clarify_ = exact_clarify()
+    # by hand: a came before b and c, so d is as likely as both to come first
+    ties = ((a, frozenset([b, c])),)
+    assert clarify_.tie_probabilities(ties, [b, c, d]) == pytest.approx(
+        [1 / 4, 1 / 4, 1 / 2]
+    )
+    # a came first and b before c: of the orders b c d, b d c and d b c, c only
+    # beats d in the first
+    ties = ((a, frozenset([b, c, d])), (b, frozenset([c])))
+    assert clarify_.tie_probabilities(ties, [c, d]) == pytest.approx([1 / 3, 2 / 3])
+    for ties, tied in [
+        (((a, frozenset([b, c])),), [b, c, d]),
+        (((a, frozenset([b, c, d])), (b, frozenset([c]))), [c, d]),
+        (((b, frozenset([a])), (c, frozenset([d]))), [a, d]),
+    ]:
+        orders = key_orders((a, b, c, d), ties)
+        firsts = [min(tied, key=order.index) for order in orders]
+        expected = [firsts.count(facet) / len(orders) for facet in tied]
+        assert clarify_.tie_probabilities(ties, tied) == pytest.approx(expected)
+    # ties that do not tell the tied facets apart leave them equally likely
+    assert (
+        clarify_.tie_probabilities(((a, frozenset([b, c, d])),), [b, c, d])
+        == [1 / 3] * 3
+    )
+
+
+def test_enumerated_dialogues_match_every_tiebreak_order():
+    topic = tied_topic()
+    exact = exact_clarify()
+    brute_force = exact_clarify(clarify_class=FixedTiebreakClarify)
+    for facet in topic.facets:
+        expected = {}
+        orders = list(itertools.permutations(range(len(topic.facets))))
+        for keys in orders:
+            brute_force.keys = dict(zip(topic.facets, keys))
+            outcomes = brute_force.enumerate_dialogues(topic, facet)
+            for outcome, p in outcomes.items():
+                expected[outcome] = expected.get(outcome, 0.0) + p / len(orders)
+        outcomes = exact.enumerate_dialogues(topic, facet)
+        assert sum(outcomes.values()) == pytest.approx(1.0)
+        assert dict(outcomes) == pytest.approx(expected)
+
+
+def test_merged_feedbacks_merge_answers_with_the_same_effect():
+    facet = clarify_types.Facet(
+        "e",
+        "e z",
+        [
+            ("q", "yes it is"),
+            ("q", "yes indeed"),
+            ("q", "no I want e"),
+            ("q", "no, I want e"),
+            ("q", "no I want f"),
+        ],
+    )
+    topic = clarify_types.Topic("t", "topic", [facet] + tied_topic().facets)
+    clarify_ = exact_clarify(cooperativeness=0.6)
+    user_state = clarify_.user_simulator.build_state(topic, facet)
+    questions = clarify_.question_generator.generate_question
+    yes = clarify_.merged_feedbacks(user_state, questions(topic, facet))
+    assert [p for _, p in yes] == [1.0]
+    no = clarify_.merged_feedbacks(user_state, questions(topic, topic.facets[1]))
+    extracted = [
+        clarify_.informative_no_extractor.extract(feedback["answer"])
+        for feedback, _ in no
+    ]
+    assert extracted == ["I want e", "I want f", ""]
+    assert [p for _, p in no] == pytest.approx([0.4, 0.2, 0.4])
+    # each branch has its own user state, and the one passed in is untouched
+    assert user_state.turns == 0
+    assert len({id(feedback["state"]) for feedback, _ in no}) == 3
+
+
+def test_exact_means_match_sampled_means():
+    topics_ = [tied_topic()]
+    exact = exact_clarify().run(1, topics_, exact=True)
+    assert exact["simulations"] == {"exact": 5}
+    sampled = exact_clarify().run(3000, topics_, seed=3)
+    assert exact["metrics"].keys() == sampled["metrics"].keys()
+    for metric, value in exact["metrics"].items():
+        assert value["mean"] == pytest.approx(
+            sampled["metrics"][metric]["mean"], abs=0.05
+        )
+
+
+def test_tree_limits_raise_and_fall_back_to_sampling():
+    topic = tied_topic()
+    facet = topic.facets[3]
+    expected = exact_clarify().enumerate_dialogues(topic, facet)
+    nodes = 1
+    while True:
+        try:
+            outcomes = exact_clarify(max_tree_nodes=nodes).enumerate_dialogues(
+                topic, facet
+            )
+            break
+        except clarify.DialogueTreeTooLarge:
+            nodes += 1
+    assert nodes > 1 and outcomes == expected
+    with pytest.raises(clarify.DialogueTreeTooLarge):
+        exact_clarify(max_tree_nodes=nodes - 1).enumerate_dialogues(topic, facet)
+    # ties on the third turn involve all five facets
+    assert exact_clarify(max_tie_facets=5).enumerate_dialogues(topic, facet) == expected
+    with pytest.raises(clarify.DialogueTreeTooLarge):
+        exact_clarify(max_tie_facets=4).enumerate_dialogues(topic, facet)
+    out = exact_clarify(max_tie_facets=4).run(2, [topic], exact=True)
+    assert out["simulations"] == {"sampled": 5}
+    assert all(
+        facet_out["simulation"] == "sampled" and len(facet_out["dialogues"]) == 2
+        for facet_out in out["topics"][0]["facets"]
+    )
@@ -0,0 +1,140 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import random
+import typing as tp
+
+import pytest
+
+import clarify_types
+
+
+def facets(n: int = 8) -> tp.List[clarify_types.Facet]:
+    return [clarify_types.Facet("f%d" % i, "facet %d" % i, []) for i in range(n)]
+
+
+class SortedCandidates:
+    """The selection the queue replaced: candidates sorted by score and then by
+    tie-break key, best first, and the first one popped."""
+
+    def __init__(self, scored_facets, tiebreaks: tp.Dict):
+        self.scores = dict(scored_facets)
+        self.tiebreaks = tiebreaks
+
+    def snapshot(self):
+        facets = sorted(
+            self.scores,
+            key=lambda facet: (self.scores[facet], self.tiebreaks[facet]),
+            reverse=True,
+        )
+        return [(facet, self.scores[facet]) for facet in facets]
+
+    def pop(self):
+        facet, score = self.snapshot()[0]
+        del self.scores[facet]
+        return facet, score
+
+
+def queues(rng: random.Random, n: int = 8):
+    # few distinct scores, so that most pops break a tie
+    scored = [(facet, rng.choice([0.0, 0.5, 1.0])) for facet in facets(n)]
+    tiebreaks = [rng.random() for _ in scored]
+    queue = clarify_types.CandidateQueue(scored, tiebreaks)
+    keys = {facet: tiebreak for (facet, _), tiebreak in zip(scored, tiebreaks)}
+    return queue, SortedCandidates(scored, keys)
+
+
+def test_pop_order_matches_sorting():
+    rng = random.Random(0)
+    for _ in range(50):
+        queue, expected = queues(rng)
+        assert queue.snapshot() == expected.snapshot()
+        while expected.scores:
+            top = expected.snapshot()[0][1]
+            assert set(queue.best()) == {
+                facet for facet, score in expected.snapshot() if score == top
+            }
+            assert queue.pop() == expected.pop()
+        assert len(queue) == 0
+        with pytest.raises(IndexError):
+            queue.pop()
+
+
+def test_updates_removals_and_rescores_match_sorting():
+    rng = random.Random(1)
+    for _ in range(50):
+        queue, expected = queues(rng)
+        while expected.scores:
+            op = rng.choice(["pop", "update", "remove", "rescore"])
+            facet = rng.choice(list(expected.scores))
+            if op == "pop":
+                assert queue.pop() == expected.pop()
+            elif op == "update":
+                score = rng.choice([0.0, 0.5, 1.0])
+                queue.update(facet, score)
+                expected.scores[facet] = score
+            elif op == "remove":
+                assert queue.remove(facet) == expected.scores.pop(facet)
+            else:
+                rescored = [(f, rng.choice([0.0, 0.5, 1.0])) for f in expected.scores]
+                queue.rescore(rescored)
+                expected.scores = dict(rescored)
+            assert len(queue) == len(expected.scores)
+            assert queue.snapshot() == expected.snapshot()
+
+
+def test_stale_entries_are_skipped():
+    a, b, c = facets(3)
+    queue = clarify_types.CandidateQueue([(a, 1.0), (b, 0.5), (c, 0.0)])
+    queue.update(a, 0.0)
+    queue.update(c, 0.2)
+    queue.remove(b)
+    # the old entries of a, b and c are still in the heap
+    assert len(queue.heap) == 5 and len(queue) == 2
+    assert queue.pop() == (c, 0.2)
+    assert queue.pop() == (a, 0.0)
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_tiebreaks_are_drawn_once_per_facet():
+    random.seed(3)
+    queue = clarify_types.CandidateQueue([(facet, 1.0) for facet in facets()])
+    order = [facet for facet, _ in queue.snapshot()]
+    state = random.getstate()
+    # rescoring, updating and copying keep every facet's key
+    queue.rescore([(facet, 0.0) for facet in reversed(order)])
+    queue.update(order[-1], 0.0)
+    copy = queue.copy()
+    assert random.getstate() == state
+    assert [facet for facet, _ in copy.snapshot()] == order
+    assert [copy.pop()[0] for _ in order] == order
+    # a re-pushed facet keeps its key, and so still wins its ties
+    queue.update(order[0], -1.0)
+    queue.update(order[0], 0.0)
+    assert set(queue.best()) == set(order) and queue.pop()[0] == order[0]
+
+
+def test_copies_are_independent():
+    rng = random.Random(4)
+    queue, expected = queues(rng)
+    copy = queue.copy()
+    assert copy.snapshot() == queue.snapshot()
+    assert copy.tiebreaks == queue.tiebreaks
+    facet, _ = copy.pop()
+    copy.update(expected.snapshot()[-1][0], 2.0)
+    copy.remove(expected.snapshot()[1][0])
+    assert queue.snapshot() == expected.snapshot()
+    assert [queue.pop() for _ in range(len(queue))] == [
+        expected.pop() for _ in range(len(expected.scores))
+    ]
+    assert facet not in copy.facets()
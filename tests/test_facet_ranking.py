@@ -0,0 +1,115 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import typing as tp
+
+import clarify_types
+import facet_ranking
+import match
+
+
+class TableMatcher(match.SentenceMatcher):
+    # scores pairs from a table and records every pair it scores
+    def __init__(self, table: tp.Dict[tp.Tuple[str, str], float]):
+        self.table = table
+        self.scored = []  # type: tp.List[tp.Tuple[str, str]]
+
+    def similarity(self, sent1: str, sent2: str) -> float:
+        self.scored.append((sent1, sent2))
+        return self.table.get((sent1, sent2), 0.0)
+
+
+def state_after_no(
+    descs: tp.List[str], no: str
+) -> tp.Tuple[clarify_types.ClarifyState, tp.List[clarify_types.Facet]]:
+    facets = [clarify_types.Facet(i, desc, []) for i, desc in enumerate(descs)]
+    topic = clarify_types.Topic(1, "topic", facets)
+    state = clarify_types.ClarifyState(topic, [(facet, 0.0) for facet in facets])
+    state.informative_no_db.append(no)
+    return state, facets
+
+
+def scores(
+    facets: tp.List[clarify_types.Facet], values: tp.List[float], item: str
+) -> tp.Dict[tp.Tuple[str, str], float]:
+    return {(facet.full_rep, item): value for facet, value in zip(facets, values)}
+
+
+def test_rerank_reorders_only_the_top_facets():
+    state, facets = state_after_no(["a", "b", "c", "d", "e"], "not this")
+    matcher = TableMatcher(scores(facets, [0.9, 0.8, 0.7, 0.6, 0.5], "not this"))
+    reranker = TableMatcher(scores(facets, [0.1, 0.2, 0.9, 1.0, 0.0], "not this"))
+    ranker = facet_ranking.SimilarityFacetRanker(
+        matcher, reranker=reranker, rerank_top=3
+    )
+    ranking = ranker.rank_facets(state)
+    a, b, c, d, e = facets
+    assert [facet for facet, _ in ranking] == [c, b, a, d, e]
+    # positions keep their scores, so the queue keeps the reranked order
+    assert [score for _, score in ranking] == [0.9, 0.8, 0.7, 0.6, 0.5]
+    assert {sent1 for sent1, _ in reranker.scored} == {
+        a.full_rep,
+        b.full_rep,
+        c.full_rep,
+    }
+
+
+def test_rerank_does_not_depend_on_how_the_context_grew():
+    descs = ["a", "b", "c", "d"]
+    _, facets = state_after_no(descs, "first")
+    table = scores(facets, [0.9, 0.8, 0.7, 0.1], "first")
+    table.update(scores(facets, [0.2, 0.1, 0.9, 0.3], "second"))
+    rerank_table = scores(facets, [0.1, 0.9, 0.5, 1.0], "first")
+    rerank_table.update(scores(facets, [0.3, 0.1, 0.8, 1.0], "second"))
+
+    def ranker():
+        return facet_ranking.SimilarityFacetRanker(
+            TableMatcher(table), reranker=TableMatcher(rerank_table), rerank_top=3
+        )
+
+    # one turn at a time, so the second ranking only scores the new item
+    state, _ = state_after_no(descs, "first")
+    incremental = ranker()
+    incremental.rank_facets(state)
+    state.informative_no_db.append("second")
+    # both items at once
+    fresh, _ = state_after_no(descs, "first")
+    fresh.informative_no_db.append("second")
+
+    def by_desc(ranking):
+        return [(facet.desc, score) for facet, score in ranking]
+
+    ranking = by_desc(incremental.rank_facets(state))
+    assert ranking == by_desc(ranker().rank_facets(fresh))
+    assert [desc for desc, _ in ranking] == ["c", "b", "a", "d"]
+
+
+def test_without_context_the_ranking_is_left_alone():
+    state, facets = state_after_no(["a", "b"], "not this")
+    state.informative_no_db.clear()
+    reranker = TableMatcher({})
+    ranker = facet_ranking.SimilarityFacetRanker(
+        TableMatcher({}), reranker=reranker, rerank_top=2
+    )
+    assert [facet for facet, _ in ranker.rank_facets(state)] == facets
+    assert reranker.scored == []
+
+
+def test_batch_scores_each_pair_once():
+    for caching in [False, True]:
+        state, facets = state_after_no(["a", "b", "c"], "not this")
+        table = TableMatcher({})
+        matcher = match.CachingSentenceMatcher(table) if caching else table
+        facet_ranking.SimilarityFacetRanker(matcher).rank_facets_batch([state])
+        assert sorted(table.scored) == sorted(
+            (facet.full_rep, "not this") for facet in facets
+        )
@@ -0,0 +1,85 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import random
+import typing as tp
+
+import numpy as np
+import pytest
+
+import clarify_types
+import ir
+
+QRELS = [
+    # graded judgments, some of them not relevant
+    ("1-1", "d03", 2),
+    ("1-1", "d07", 1),
+    ("1-1", "d10", 1),
+    ("1-1", "d11", 0),
+    ("1-1", "d2", 1),
+    ("1-1", "d25", 2),
+    # judged, but nothing is relevant
+    ("1-2", "d03", 0),
+    ("1-2", "d04", 0),
+    # a single relevant document
+    ("1-3", "d19", 1),
+]
+
+
+class RankingRetriever(ir.InformationRetriever):
+    # returns the ranking it was given for every query
+    def __init__(self, ranking: tp.List[tp.Tuple[str, float]]):
+        self.ranking = ranking
+
+    def search(self, topic, query) -> tp.List[tp.Tuple[ir.Document, float]]:
+        return [(ir.Document(doc_id, "dummy"), score) for doc_id, score in self.ranking]
+
+
+def rankings() -> tp.Iterator[tp.List[tp.Tuple[str, float]]]:
+    docs = ["d%02d" % i for i in range(30)] + ["d2", "x1", "x2"]
+    yield [("d03", 3.0), ("d07", 2.0), ("d11", 1.0)]
+    # ties, around and across the depth cutoffs, with unjudged documents
+    yield [(doc, 1.0) for doc in docs[:12]] + [("d25", 0.5), ("d2", 0.5)]
+    yield [("x1", 2.0), ("d10", 2.0), ("d03", 2.0), ("d07", 1.0), ("x2", 1.0)]
+    # nothing judged, and nothing at all
+    yield [("x1", 1.0), ("x2", 0.5)]
+    yield []
+    rng = random.Random(0)
+    for _ in range(20):
+        ranked = rng.sample(docs, rng.randint(1, len(docs)))
+        yield [(doc, float(rng.randint(0, 4))) for doc in ranked]
+
+
+@pytest.fixture(scope="module")
+def calculators(tmp_path_factory):
+    qrel_path = tmp_path_factory.mktemp("qrels") / "qrels.txt"
+    with qrel_path.open("w") as f:
+        for query_id, doc_id, rel in QRELS:
+            print(query_id, 0, doc_id, rel, file=f)
+    return ir.NativeMetricCalculator(qrel_path), ir.TrecToolsMetricCalculator(qrel_path)
+
+
+# facet 4 has no judgments at all
+@pytest.mark.parametrize("facet_id", [1, 2, 3, 4])
+def test_native_metrics_match_trectools(calculators, facet_id):
+    native, trectools = calculators
+    topic = clarify_types.Topic(1, "topic", [])
+    facet = clarify_types.Facet(facet_id, "facet", [])
+    for ranking in rankings():
+        retriever = RankingRetriever(ranking)
+        expected = trectools.calculate_metrics(retriever, topic, facet, "query")
+        metrics = native.calculate_metrics(retriever, topic, facet, "query")
+        assert metrics.keys() == expected.keys()
+        for metric, value in expected.items():
+            # trectools gives nan for an empty ranking, which scores 0 natively
+            value = 0.0 if not ranking and np.isnan(value) else value
+            assert metrics[metric] == pytest.approx(value), (ranking, metric)
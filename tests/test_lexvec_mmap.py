@@ -0,0 +1,84 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import struct
+
+import numpy as np
+import pytest
+
+import lexvec_mmap
+
+HEADER = b"fake lexvec header"
+
+
+class FakeModel:
+    """Reads vectors the way lexvec does: seeking to each row of the open file
+    and hashing subwords with plain-Python FNV-1a."""
+
+    def __init__(self, path: str):
+        self._f = open(path, "rb")
+        self._dim = 3
+        self._vocab = {"cat": 0, "dog": 1}
+        self._vocab_size = 2
+        self._buckets = 11
+        self._minn = 2
+        self._maxn = 3
+        self._matrix_base_offset = len(HEADER)
+
+    def _row(self, i: int) -> np.ndarray:
+        self._f.seek(self._matrix_base_offset + i * self._dim * 8)
+        return np.array(struct.unpack("<3d", self._f.read(self._dim * 8)))
+
+    def word_rep(self, w: str) -> np.ndarray:
+        rows = [self._row(self._vocab[w])] if w in self._vocab else []
+        padded = "<" + w + ">"
+        for n in range(self._minn, self._maxn + 1):
+            for i in range(len(padded) - n + 1):
+                h = lexvec_mmap.FNV_OFFSET
+                for byte in padded[i : i + n].encode("utf-8"):
+                    h = ((h ^ byte) * lexvec_mmap.FNV_PRIME) & 0xFFFFFFFF
+                rows.append(self._row(self._vocab_size + h % self._buckets))
+        return np.mean(rows, axis=0)
+
+
+@pytest.fixture
+def model_path(tmp_path, monkeypatch):
+    opened = []
+
+    class Model(FakeModel):
+        def __init__(self, path: str):
+            super().__init__(path)
+            opened.append(self)
+
+    monkeypatch.setattr(lexvec_mmap.lexvec, "Model", Model, raising=False)
+    matrix = np.random.RandomState(0).randn(13, 3)
+    path = tmp_path / "model.bin"
+    path.write_bytes(HEADER + matrix.astype("<f8").tobytes())
+    return path, opened
+
+
+def test_matches_lexvec_and_closes_it(model_path):
+    path, opened = model_path
+    model = lexvec_mmap.MMapModel(path)
+    assert [m._f.closed for m in opened] == [True]
+    assert not hasattr(model, "model")
+    reference = FakeModel(str(path))
+    for word in ["cat", "dog", "bird", ""]:
+        np.testing.assert_allclose(model.word_rep(word), reference.word_rep(word))
+
+
+def test_verify_failure_still_closes(model_path, monkeypatch):
+    path, opened = model_path
+    monkeypatch.setattr(lexvec_mmap.MMapModel, "subwords", lambda self, w: [w])
+    with pytest.raises(ValueError):
+        lexvec_mmap.MMapModel(path)
+    assert [m._f.closed for m in opened] == [True]
@@ -0,0 +1,59 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import pathlib
+
+import pytest
+import transformers
+
+import match
+
+
+def test_length_buckets_never_mix_lengths():
+    lengths = [3, 5, 3, 3, 5, 4, 3]
+    buckets = match.length_buckets(lengths, batch_size=2)
+    assert buckets == [[0, 2], [3, 6], [5], [1, 4]]
+    for bucket in buckets:
+        assert len({lengths[i] for i in bucket}) == 1
+
+
+def test_random_scores_depend_only_on_the_pair():
+    matcher = match.RandomSentenceMatcher(seed=1)
+    first = matcher.similarity_batch([("a", "b"), ("c", "d")])
+    assert matcher.similarity_batch([("c", "d"), ("a", "b")]) == first[::-1]
+    assert match.RandomSentenceMatcher(seed=2).similarity("a", "b") != first[0]
+    assert all(0 <= score < 1 for score in first)
+
+
+@pytest.fixture(scope="module")
+def tiny_transformer(tmp_path_factory) -> pathlib.Path:
+    path = tmp_path_factory.mktemp("tiny-transformer")
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list("abcdefgh")
+    (path / "vocab.txt").write_text("\n".join(words) + "\n")
+    transformers.BertTokenizerFast(str(path / "vocab.txt")).save_pretrained(path)
+    config = transformers.BertConfig(
+        vocab_size=len(words),
+        hidden_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    transformers.BertForSequenceClassification(config).save_pretrained(path)
+    return path
+
+
+def test_transformer_scores_do_not_depend_on_the_batch(tiny_transformer):
+    matcher = match.TransformerSentenceMatcher(tiny_transformer, batch_size=4)
+    pairs = [("a " * n, "b c " * (n % 3 + 1)) for n in range(1, 12)]
+    batched = matcher.similarity_batch(pairs)
+    assert batched == [matcher.similarity(*pair) for pair in pairs]
+    assert matcher.similarity_batch(pairs[::-1]) == batched[::-1]
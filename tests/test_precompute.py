@@ -0,0 +1,85 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import typing as tp
+
+import clarify_types
+import facet_retrieval
+import ir
+
+
+class QueryMetricCalculator(ir.MetricCalculator):
+    def calculate_metrics(self, ir_sys, topic, facet, query) -> tp.Dict[str, float]:
+        return {"length": float(len(query))}
+
+
+class CountingFacetRetriever(facet_retrieval.FacetRetriever):
+    def __init__(self):
+        self.calls = 0
+
+    def facets_for_topic(
+        self, topic: clarify_types.Topic
+    ) -> tp.List[tp.Tuple[clarify_types.Facet, float]]:
+        self.calls += 1
+        return [(facet, 1.0) for facet in topic.facets]
+
+
+def topics() -> tp.List[clarify_types.Topic]:
+    return [
+        clarify_types.Topic(
+            topic_id,
+            "topic %d" % topic_id,
+            [clarify_types.Facet(i, "facet %d.%d" % (topic_id, i), []) for i in [1, 2]],
+        )
+        for topic_id in [1, 2, 3]
+    ]
+
+
+def test_precompute_fills_in_facet_queries_once_per_topic():
+    calculator = ir.PrecomputedMetricCalculator(QueryMetricCalculator())
+    # a table that only has the topic queries, e.g. from another facet source
+    for topic in topics():
+        for facet in topic.facets:
+            calculator.table[(topic.id, facet.id, topic.query)] = {"length": 0.0}
+    retriever = CountingFacetRetriever()
+    computed = calculator.precompute(
+        ir.DummyInformationRetriever(), topics(), retriever, workers=2
+    )
+    assert computed == 3 * 3 * 2
+    assert retriever.calls == 3
+    assert calculator.table[(1, 2, "facet 1.1")] == {"length": 9.0}
+    assert (
+        calculator.precompute(ir.DummyInformationRetriever(), topics(), retriever) == 0
+    )
+
+
+class CountingRetriever(ir.InformationRetriever):
+    def __init__(self):
+        self.searches = []
+
+    def search(self, topic, query):
+        self.searches.append((topic.id, query))
+        return [(ir.Document("doc", "dummy"), 1.0)]
+
+
+class SearchingMetricCalculator(ir.MetricCalculator):
+    # reads rankings through search, as TrecToolsMetricCalculator does
+    def calculate_metrics(self, ir_sys, topic, facet, query) -> tp.Dict[str, float]:
+        return {"docs": float(len(ir_sys.search(topic, query)))}
+
+
+def test_precompute_searches_each_query_once():
+    calculator = ir.PrecomputedMetricCalculator(SearchingMetricCalculator())
+    retriever = CountingRetriever()
+    calculator.precompute(retriever, topics(), CountingFacetRetriever())
+    assert len(retriever.searches) == len(set(retriever.searches)) == 3 * 3
+    assert calculator.table[(1, 1, "facet 1.2")] == {"docs": 1.0}
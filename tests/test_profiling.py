@@ -0,0 +1,39 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import copy
+
+import profiling
+
+
+class Counts:
+    def __init__(self, hits: int, misses: int):
+        self.hits = hits
+        self.misses = misses
+
+
+def test_worker_counts_are_drained_and_merged():
+    profile = profiling.Profile()
+    parent = Counts(3, 1)
+    profile.add_counters("cache", parent, ["hits", "misses"])
+    # a forked worker starts from a copy of the parent's counts
+    worker_profile = copy.deepcopy(profile)
+    worker_profile.start_worker()
+    worker, _ = worker_profile.counters["cache"]
+    assert (worker.hits, worker.misses) == (0, 0)
+    worker.hits += 5
+    worker.misses += 2
+    profile.merge(worker_profile.drain())
+    assert (parent.hits, parent.misses) == (8, 3)
+    assert (worker.hits, worker.misses) == (0, 0)
+    profile.merge(worker_profile.drain())
+    assert (parent.hits, parent.misses) == (8, 3)
@@ -0,0 +1,181 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import collections
+import math
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ir
+import ql_index
+
+
+class FakeQL:
+    # loads a made-up inverted index per topic, like QL.load_topic_index
+    def __init__(self):
+        self.current_topic_id = None
+        self._inverted_index = {}
+
+    def load_topic_index(self, topic_id: int):
+        self.current_topic_id = topic_id
+        self._inverted_index = {
+            "doc%d" % i: {"terms": {"term%d" % i: i, "topic": topic_id}, "length": i}
+            for i in range(10)
+        }
+
+
+def test_inverted_index_nbytes_counts_terms():
+    large = {"doc": {"terms": {"term%d" % i: i for i in range(1000)}, "length": 1}}
+    terms = large["doc"]["terms"]
+    assert ql_index.inverted_index_nbytes(large) > sum(
+        sys.getsizeof(term) for term in terms
+    ) + sys.getsizeof(terms)
+
+
+def test_searches_of_the_current_topic_are_cache_hits():
+    ir_sys = ir.QLInformationRetriever(FakeQL())
+    for topic_id in [1, 1, 1, 2, 1]:
+        ir_sys.load_topic_index(topic_id)
+        assert ir_sys.ql._inverted_index["doc1"]["terms"]["topic"] == topic_id
+    stats = ir_sys.indexes.stats()
+    assert (stats["hits"], stats["misses"]) == (3, 2)
+
+
+class ReferenceQL(FakeQL):
+    """Scores like QL.get_result_df, one document at a time: the query model
+    mixes the query's and the question's term frequencies, documents are ranked
+    by their Dirichlet-smoothed likelihood under it and the topk best kept, in
+    index order among equal scores. Terms with no collection frequency would
+    have a likelihood of 0 in every document, so they are left out."""
+
+    mu = 1500.0
+    alpha = 0.5
+    stopwords = ["the", "of", "a"]
+
+    def __init__(self, index_root, term_stats):
+        super().__init__()
+        self.index_root = index_root
+        self._term_stats = term_stats
+        self._total_terms = sum(term_stats.values())
+
+    def _preprocess(self, text):
+        tokens = [t for t in text.lower().split() if t not in self.stopwords]
+        return collections.Counter(tokens), len(tokens)
+
+    def load_topic_index(self, topic_id: int):
+        with open(self.index_root / ("%d.pkl" % topic_id), "rb") as f:
+            self._inverted_index = pickle.load(f)
+        for entry in self._inverted_index.values():
+            for stopword in self.stopwords:
+                entry["length"] -= entry["terms"].pop(stopword, 0)
+        self.current_topic_id = topic_id
+
+    def update_query_lang_model(self, query, question, answer=""):
+        query_tokens, qlen = self._preprocess(query)
+        other_tokens, other_len = self._preprocess(question + " " + answer)
+        self.query_lm = {
+            term: self.alpha * query_tokens[term] / max(qlen, 1)
+            + (1 - self.alpha) * other_tokens[term] / max(other_len, 1)
+            for term in set(query_tokens) | set(other_tokens)
+        }
+
+    def get_result_df(self, topk, query_id):
+        scores = []
+        for doc, entry in self._inverted_index.items():
+            score = 0.0
+            for term, weight in self.query_lm.items():
+                if term not in self._term_stats:
+                    continue
+                p = self._term_stats[term] / self._total_terms
+                tf = entry["terms"].get(term, 0)
+                score += weight * math.log(
+                    (tf + self.mu * p) / (entry["length"] + self.mu)
+                )
+            scores.append((doc, score))
+        scores.sort(key=lambda x: x[1], reverse=True)
+        return pd.DataFrame(scores[:topk])
+
+
+def doc(length, **terms):
+    return {"terms": terms, "length": length}
+
+
+# documents out of id order, with copies of one another and documents that
+# match no query term, so that scores tie at every cutoff
+INDEX = {
+    "d9": doc(12, apple=3, pie=1, the=4),
+    "d3": doc(9, pie=2, crust=1, the=1),
+    "d5": doc(12, apple=3, pie=1, the=4),
+    "d1": doc(5, banana=2),
+    "d8": doc(9, pie=2, crust=1, the=1),
+    "d2": doc(5, cherry=2),
+    "d7": doc(12, apple=3, pie=1, the=4),
+    "d0": doc(3, the=2, of=1),
+    # a term the collection statistics do not know
+    "d6": doc(7, apple=1, strudel=4),
+    "d4": doc(5, banana=2),
+}
+TERM_STATS = {"apple": 50, "pie": 20, "crust": 5, "banana": 40, "cherry": 10, "tart": 7}
+QUERIES = [
+    ("apple pie", "is it about the crust"),
+    ("apple pie", "apple strudel"),
+    # unseen terms: one only in documents, one nowhere
+    ("strudel", "zzz"),
+    ("tart of the day", "cherry tart"),
+    ("the", "of a"),
+]
+
+
+@pytest.fixture(scope="module")
+def reference(tmp_path_factory):
+    root = tmp_path_factory.mktemp("ql")
+    (root / "topic_indexes").mkdir()
+    with open(root / "topic_indexes" / "1.pkl", "wb") as f:
+        pickle.dump(INDEX, f)
+    ql_index.convert_topic_index(
+        root / "topic_indexes" / "1.pkl", root / "npy" / "1", ReferenceQL.stopwords
+    )
+    return ReferenceQL(root / "topic_indexes", TERM_STATS), root / "npy"
+
+
+def test_sparse_scores_match_ql(reference):
+    ql, npy_root = reference
+    index = ql_index.TopicIndex(npy_root / "1")
+    for query, question in QUERIES:
+        query_lm = ql_index.query_lang_model(ql, query, question)
+        ql.load_topic_index(1)
+        ql.update_query_lang_model(query=query, question=question)
+        assert query_lm == pytest.approx(ql.query_lm)
+        scores = ql_index.ql_scores(
+            index, [query_lm], ql._term_stats, ql._total_terms, ql.mu
+        )[0]
+        for k in range(1, len(INDEX) + 2):
+            expected = ql.get_result_df(topk=k, query_id="dummy")
+            doc_ids, top_scores = ql_index.top_k(index, scores, k)
+            assert list(doc_ids) == list(expected[0]), (query, question, k)
+            np.testing.assert_allclose(top_scores, expected[1], rtol=1e-12)
+
+
+def test_mmap_retriever_matches_ql_retriever(reference):
+    ql, npy_root = reference
+    topic = ir.clarify_types.Topic(1, "apple pie", [])
+    for _, question in QUERIES:
+        expected = ir.QLInformationRetriever(ql).search(topic, question)
+        results = ir.MMapQLInformationRetriever(ql, npy_root).search(topic, question)
+        assert [d.id for d, _ in results] == [d.id for d, _ in expected]
+        np.testing.assert_allclose(
+            [score for _, score in results], [score for _, score in expected]
+        )
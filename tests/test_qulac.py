@@ -0,0 +1,108 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import io
+import json
+import pickle
+
+import pytest
+
+import qulac
+
+ROWS = [
+    # topic id, query, facet id, facet description, question, answer
+    (1, "café au lait", 1, 'a "quoted" \\ backslash', "is it 1?", "yes it is"),
+    (1, "café au lait", 1, 'a "quoted" \\ backslash', "", ""),
+    (1, "café au lait", 2, "tabs\tand\nnewlines", "is it 2?", "no, ☕ only"),
+    (2, "東京 🗼", 1, "emoji 🙂 and é́", "what about  ?", "no"),
+    (2, "東京 🗼", 3, "1234567890", "is it 3?", "yes 12345"),
+]
+
+
+def document(rows=ROWS, **kwargs) -> str:
+    columns = {name: {} for name in ["extra"] + qulac.COLUMNS}  # type: dict
+    for i, row in enumerate(rows):
+        # unused columns may hold anything
+        columns["extra"][str(i)] = {"nested": [i, -1.5e3, None, True, "x\\y"]}
+        for name, value in zip(qulac.COLUMNS, row):
+            columns[name][str(i)] = value
+    return json.dumps(columns, **kwargs)
+
+
+def topics(dataset: qulac.Qulac):
+    return [
+        (t.id, t.query, [(f.id, f.desc, f.questions_answers) for f in t.facets])
+        for t in dataset.topics
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"ensure_ascii": False}, {"indent": 2}, {"separators": (",", ":")}]
+)
+def test_stream_columns_match_json_load(chunk_size, kwargs):
+    text = document(**kwargs)
+    expected = json.loads(text)
+    del expected["extra"]
+    columns = qulac.stream_columns(io.StringIO(text), chunk_size)
+    assert columns == expected
+    assert list(columns) == qulac.COLUMNS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7])
+def test_stream_reader_values(chunk_size):
+    values = [12345678901234567890, -0.5e-3, '\\"é😀', [], {}, None]
+    text = " \n".join(json.dumps(value) for value in values)
+    reader = qulac.JSONStreamReader(io.StringIO(text), chunk_size)
+    assert [reader.value() for _ in values] == values
+    assert reader.peek() == ""
+
+
+def test_stream_columns_reject_trailing_data():
+    with pytest.raises(ValueError):
+        qulac.stream_columns(io.StringIO(document() + " {}"), 7)
+
+
+def test_streamed_and_loaded_topics_match():
+    loaded = qulac.Qulac(io.StringIO(document()))
+    streamed = qulac.Qulac(io.StringIO(document()), stream=True)
+    assert topics(streamed) == topics(loaded)
+    assert [len(t.facets) for t in loaded.topics] == [2, 2]
+    assert loaded.get_facet_by_id("2", "3").desc == "1234567890"
+
+
+def test_stale_snapshots_are_rebuilt(tmp_path):
+    path = tmp_path / "qulac.json"
+    path.write_text(document())
+    snapshot = qulac.snapshot_path(path)
+    expected = topics(qulac.Qulac.load(path))
+    assert topics(qulac.Qulac.load(path, snapshot=True)) == expected
+    assert snapshot.exists()
+    # the snapshot is read back rather than the file
+    saved = pickle.loads(snapshot.read_bytes())
+    saved["topics"][0] = (1, "from the snapshot", [])
+    snapshot.write_bytes(pickle.dumps(saved))
+    assert qulac.Qulac.load(path, snapshot=True).topics[0].query == (
+        "from the snapshot"
+    )
+    # a changed file has another digest, so its snapshot is rebuilt
+    path.write_text(document(ROWS[2:]))
+    expected = topics(qulac.Qulac.load(path))
+    assert topics(qulac.Qulac.load(path, snapshot=True, stream=True)) == expected
+    assert pickle.loads(snapshot.read_bytes())["topics"] == expected
+    # and so is a snapshot of another layout
+    saved = pickle.loads(snapshot.read_bytes())
+    saved["version"] = qulac.SNAPSHOT_VERSION + 1
+    saved["topics"] = []
+    snapshot.write_bytes(pickle.dumps(saved))
+    assert topics(qulac.Qulac.load(path, snapshot=True)) == expected
+    assert pickle.loads(snapshot.read_bytes())["version"] == qulac.SNAPSHOT_VERSION
@@ -0,0 +1,107 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import multiprocessing
+import os
+import typing as tp
+
+import match
+
+_cache = None
+_parent_conn = None
+
+
+def _put_and_get(worker: int) -> tp.Tuple[int, bool]:
+    pairs = [("worker %d" % worker, "item %d" % i) for i in range(50)]
+    _cache.put_many("m", [(pair, worker + i / 100) for i, pair in enumerate(pairs)])
+    found = len(_cache.get_many("m", pairs + [("parent", "item")]))
+    own = _cache.pid == os.getpid() and _cache.conn is not _parent_conn
+    return found, own
+
+
+def test_forked_workers_use_their_own_connections(tmp_path):
+    global _cache, _parent_conn
+    _cache = match.SqliteSimilarityCache(tmp_path / "similarity.sqlite")
+    # the parent's connection is open when the workers are forked
+    _cache.put_many("m", [(("parent", "item"), 0.5)])
+    _parent_conn = _cache.conn
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        results = pool.map(_put_and_get, range(8))
+    assert results == [(51, True)] * 8
+    assert _cache.get_many("m", [("worker 7", "item 49")]) == {
+        ("worker 7", "item 49"): 7.49
+    }
+    assert _cache._count() == 8 * 50 + 1
+    _cache.close()
+
+
+def test_eviction_keeps_recently_used_rows(tmp_path):
+    cache = match.SqliteSimilarityCache(tmp_path / "similarity.sqlite", max_entries=10)
+    cache.put_many("m", [(("old", str(i)), 0.0) for i in range(10)])
+    cache.get_many("m", [("old", "0")])
+    cache.put_many("m", [(("new", str(i)), 1.0) for i in range(5)])
+    assert cache._count() <= 10
+    assert ("old", "0") in cache.get_many("m", [("old", "0")])
+    assert cache.get_many("m", [("old", "1")]) == {}
+
+
+def test_lookups_span_chunks(tmp_path):
+    cache = match.SqliteSimilarityCache(tmp_path / "similarity.sqlite")
+    cache.chunk_size = 3
+    stored = {("a", str(i)): i / 10 for i in range(10)}
+    cache.put_many("m", list(stored.items()))
+    cache.put_many("other", [(("a", "0"), 1.0), (("a", "10"), 1.0)])
+    pairs = [("a", str(i)) for i in range(12)] + [("a", "1"), ("b", "0")]
+    assert cache.get_many("m", pairs) == stored
+    assert cache.get_many("other", pairs) == {("a", "0"): 1.0, ("a", "10"): 1.0}
+    cache.close()
+
+
+def test_size_counts_new_rows_only(tmp_path):
+    cache = match.SqliteSimilarityCache(tmp_path / "similarity.sqlite")
+    cache.put_many("m", [(("a", str(i)), 0.0) for i in range(5)])
+    # rows already there are updated, not counted again
+    cache.put_many("m", [(("a", str(i)), 1.0) for i in range(3, 8)])
+    assert cache.size == cache._count() == 8
+    assert cache.get_many("m", [("a", "2"), ("a", "3")]) == {
+        ("a", "2"): 0.0,
+        ("a", "3"): 1.0,
+    }
+    assert match.SqliteSimilarityCache(tmp_path / "similarity.sqlite").size == 8
+    cache.close()
+
+
+def test_bov_fingerprint_reads_only_the_first_block(tmp_path):
+    path = tmp_path / "vectors.txt"
+    path.write_bytes(b"header\n" + b"x" * (1 << 21))
+    matcher = match.BOVSentenceMatcher.__new__(match.BOVSentenceMatcher)
+    matcher.lexvec_path = path
+    fingerprint = matcher.fingerprint()
+    stat = path.stat()
+    # the same size and time, with a change past the first block
+    with path.open("r+b") as f:
+        f.seek(1 << 21)
+        f.write(b"y")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert matcher.fingerprint() == fingerprint
+    # a change to the header, or to the size or time, is noticed
+    with path.open("r+b") as f:
+        f.write(b"H")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    changed_header = matcher.fingerprint()
+    assert changed_header != fingerprint
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert matcher.fingerprint() not in [fingerprint, changed_header]
+    with path.open("ab") as f:
+        f.write(b"z")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert matcher.fingerprint() not in [fingerprint, changed_header]
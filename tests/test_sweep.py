@@ -0,0 +1,53 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import clarify_types
+import ir
+import profiling
+import ql_index
+import sweep
+
+
+class Counts:
+    def __init__(self):
+        self.hits = 4
+
+
+class ConstantMetricCalculator(ir.MetricCalculator):
+    def calculate_metrics(self, ir_sys, topic, facet, query):
+        return {"metric": 1.0}
+
+
+def test_cells_report_their_own_cache_lookups():
+    profile = profiling.Profile()
+    counts = Counts()
+    profile.add_counters("cache", counts, ["hits"])
+    calculator = ir.PrecomputedMetricCalculator(ConstantMetricCalculator())
+    facet = clarify_types.Facet(1, "facet", [])
+    topic = clarify_types.Topic(1, "topic", [facet])
+    for _ in range(3):
+        calculator.calculate_metrics(None, topic, facet, "query")
+    ir_system = ir.DummyInformationRetriever()
+    ir_system.indexes = ql_index.TopicIndexCache(lambda topic_id: {}, len, 1)
+    ir_system.indexes.get(1)
+    ir_system.indexes.get(1)
+    resources = {
+        "profile": profile,
+        "ir_metric_calculator": calculator,
+        "ir_system": ir_system,
+    }
+    sweep.reset_stats(resources)
+    assert counts.hits == 0
+    assert calculator.stats()["hits"] == calculator.stats()["misses"] == 0
+    assert calculator.stats()["size"] == 1
+    stats = ir_system.indexes.stats()
+    assert (stats["hits"], stats["misses"], stats["loaded"]) == (0, 0, 1)
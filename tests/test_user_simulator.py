@@ -0,0 +1,42 @@
+#  Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance
+#  with the License. A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0/
+#
+#  or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+#  OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions
+#  and limitations under the License.
+
+
+import numpy as np
+
+import answer_generation
+import clarify_types
+import match
+import user_simulator
+
+
+class ConstantMatcher(match.SentenceMatcher):
+    def similarity(self, sent1: str, sent2: str) -> float:
+        return 0.5
+
+
+class EchoAnswerGenerator(answer_generation.AnswerGenerator):
+    # answers with the facet description; its distribution is not declared
+    def generate_answer(self, topic, facet, cooperativeness, similarity) -> str:
+        return facet.desc
+
+
+def test_feedback_batch_generates_answers_without_a_distribution():
+    facets = [clarify_types.Facet(i, desc, []) for i, desc in enumerate("ab")]
+    topic = clarify_types.Topic(1, "topic", facets)
+    simulator = user_simulator.UserSimulator(
+        ConstantMatcher(), 3, 0.5, lambda turns: 0.5, None, EchoAnswerGenerator()
+    )
+    states = [simulator.build_state(topic, facet) for facet in facets]
+    feedbacks = simulator.feedback_batch(
+        states, ["question", "question"], np.random.default_rng(0)
+    )
+    assert [feedback["answer"] for feedback in feedbacks] == ["a", "b"]